@@ -1,34 +1,248 @@
 __author__ = 'nykh'
 
-from sys import exit
+from sys import exit, stdout
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pytoml
 
 from qbackup import qauth
-from qbackup.qbackup import EventLogger
+from qbackup.governor import TransferBudget
+from qbackup.hashcache import HashCache
+from qbackup.manifest import SyncManifest
+from qbackup.qbackup import EventLogger, BucketLogger, QiniuBackup, \
+    QiniuFlatBackup
 from qbackup.qbackup_scaled import QiniuBackupScaled
+from qbackup.retry import RetryPolicy
+from qbackup.verify import Verifier
+from qbackup.watch import Watcher
+
+
+def engine_class(name):
+    """
+    :param name: value of the `engine` option
+    :return: the backup class of that engine
+    """
+    if name == 'async':
+        # needs aiohttp, which the other engines do without
+        from qbackup.qbackup_async import QiniuBackupAsync
+        return QiniuBackupAsync
+    engines = {'scaled': QiniuBackupScaled, 'flat': QiniuFlatBackup,
+               'base': QiniuBackup}
+    if name not in engines:
+        raise ValueError('unknown engine ' + repr(name))
+    return engines[name]
+
 
 class MultipleBackupDriver:
-    def __init__(self, config, auth, backup_class):
+    def __init__(self, config, auth, backup_class=None):
+        """
+        :param backup_class: engine of every bucket, None to pick it from
+                             the `engine` option of each bucket
+        """
         self.auth = auth
         self.QBackupClass = backup_class
 
         verbose = config['options'].get('verbose', True)
-        log = config['options'].get('verbose', False)
-        self.logger = EventLogger(verbose=verbose,
-                                  log_to_file=log)
+        log = config['options'].get('log', False)
+        self.logger = EventLogger(
+            verbose=verbose, log_to_file=log,
+            level=config['options'].get('log_level', 'debug'),
+            json_lines=config['options'].get('log_format', 'text') == 'json')
         self.config = config
 
+        # number of buckets synched at the same time, they all share the
+        # same limits on concurrent transfers and bandwidth
+        self.parallel = config['options'].get('parallel_buckets', 1)
+        self.budget = TransferBudget.from_options(config['options'])
+        # a single circuit breaker: when the cloud is down, it is down for
+        # every bucket
+        self.retry = RetryPolicy.from_options(config['options'], self.logger)
+
         self.tasks = []
         for b in self.config['buckets']:
-            b.update(self.config['options'])
-            self.tasks.append(b)
+            # the settings of a bucket override the global options
+            task = dict(self.config['options'])
+            task.update(b)
+            self.tasks.append(task)
 
     def synch_all(self):
-        for task in self.tasks:
-            qbackup = self.QBackupClass(task, self.auth, self.logger)
+        """
+        synch every bucket, a failing bucket does not stop the others
+        :return: True if every bucket has been synched
+        """
+        if self.parallel > 1:
+            with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+                results = list(executor.map(self.synch_one, self.tasks))
+        else:
+            results = [self.synch_one(task) for task in self.tasks]
+
+        self.report(results)
+        return all(result['error'] is None for result in results)
+
+    def backup_for(self, task, logger):
+        """
+        :return: the engine instance of the bucket of task
+        """
+        backup_class = self.QBackupClass or \
+            engine_class(task.get('engine', 'scaled'))
+        return backup_class(task, self.auth, logger, budget=self.budget,
+                            retry=self.retry)
+
+    def synch_one(self, task):
+        logger = self.logger
+        if self.parallel > 1:
+            logger = BucketLogger(self.logger, task['bucketname'])
+
+        result = {'bucket': task['bucketname'], 'error': None,
+                  'counters': {}}
+        start = time.time()
+        try:
+            qbackup = self.backup_for(task, logger)
+            result['counters'] = qbackup.counters
             qbackup.synch()
+        except Exception as e:
+            logger('ERROR', 'synch of bucket ' + task['bucketname']
+                   + ' failed: ' + repr(e))
+            result['error'] = e
+        result['elapsed'] = time.time() - start
+        return result
+
+    def verify_all(self, out, saved=False):
+        """
+        check every bucket against its listing, one after the other (the
+        hashing already runs on every CPU)
+        :param out: file the mismatches are written to, a json object per
+                    line
+        :param saved: use the listings saved in the manifests instead of
+                      listing the buckets
+        :return: True if every bucket was checked and matches its listing
+        """
+        ok = True
+        for task in self.tasks:
+            try:
+                ok &= self.verify_one(task, out, saved)
+            except Exception as e:
+                self.logger('ERROR', 'verification of bucket '
+                            + task['bucketname'] + ' failed: ' + repr(e))
+                ok = False
+        return ok
+
+    def verify_one(self, task, out, saved):
+        """
+        :return: True if the bucket matches its listing
+        """
+        backup = self.backup_for(task, self.logger)
+        manifest_path = None
+        if saved:
+            manifest_path = SyncManifest.path_for(
+                task.get('manifest_dir', QiniuBackupScaled.MANIFEST_DIR),
+                task['bucketname'])
+        start = time.time()
+        with HashCache(backup.hash_cache, backup.hash_workers,
+                       logger=backup.logger) as hashes:
+            verifier = Verifier(backup, hashes, manifest_path)
+            for mismatch in verifier:
+                mismatch['bucket'] = task['bucketname']
+                out.write(json.dumps(mismatch, ensure_ascii=False) + '\n')
+            self.logger('INFO', '{0}: checked {1} keys in {2:.1f}s, {3} '
+                        'mismatches, {4} files hashed'.format(
+                            task['bucketname'], verifier.checked,
+                            time.time() - start, verifier.mismatches,
+                            hashes.hashed))
+        return verifier.mismatches == 0
+
+    def watch_all(self, stop=None):
+        """
+        upload the local changes of every bucket as they happen, each bucket
+        on its own thread, until stop is set or Ctrl-C is pressed
+        :param stop: threading.Event ending the watch
+        :return: True if every bucket was watched until the end
+        """
+        stop = stop if stop is not None else threading.Event()
+        failed = []
+
+        def watch(task):
+            logger = BucketLogger(self.logger, task['bucketname'])
+            try:
+                Watcher(self.backup_for(task, logger), task, stop).run()
+            except Exception as e:
+                logger('ERROR', 'watch of bucket ' + task['bucketname']
+                       + ' failed: ' + repr(e))
+                failed.append(task['bucketname'])
+
+        threads = [threading.Thread(target=watch, args=(task,),
+                                    name='qbackup-watch-' + task['bucketname'])
+                   for task in self.tasks]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            self.logger('INFO', 'stopping the watch')
+            stop.set()
+            for thread in threads:
+                thread.join()
+        return not failed
+
+    def report(self, results):
+        for result in results:
+            counters = result['counters']
+            self.logger('INFO', '{0}: {1} in {2:.1f}s, downloaded {3} files '
+                        '({4} bytes), uploaded {5} files ({6} bytes)'.format(
+                            result['bucket'],
+                            'FAILED' if result['error'] else 'ok',
+                            result['elapsed'],
+                            counters.get('downloaded', 0),
+                            counters.get('downloaded_bytes', 0),
+                            counters.get('uploaded', 0),
+                            counters.get('uploaded_bytes', 0)))
+            if counters.get('reused'):
+                self.logger('INFO', '{0}: {1} files copied from local content '
+                            'instead of downloaded, {2} bytes saved'.format(
+                                result['bucket'], counters['reused'],
+                                counters['reused_bytes']))
+            if counters.get('copied') or counters.get('moved'):
+                self.logger('INFO', '{0}: {1} files copied and {2} moved '
+                            'within the bucket instead of uploaded, {3} '
+                            'bytes saved'.format(
+                                result['bucket'], counters.get('copied', 0),
+                                counters.get('moved', 0),
+                                counters.get('copied_bytes', 0)
+                                + counters.get('moved_bytes', 0)))
+        if self.budget.adaptive:
+            self.logger('INFO', 'adaptive transfers: settled on {0} in '
+                        'flight, {1} throttled responses'.format(
+                            self.budget.concurrency(),
+                            self.budget.adaptive.throttled))
+        stats = self.retry.stats()
+        self.logger('INFO', 'retries: {0} failed attempts retried after '
+                    '{1:.1f}s of backoff, {2} requests given up, circuit '
+                    'breaker opened {3} times for {4:.1f}s'.format(
+                        stats['retries'], stats['backoff'],
+                        stats['given_up'], stats['breaker_trips'],
+                        stats['paused']))
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='incremental backup of Qiniu buckets')
+    parser.add_argument('command', nargs='?', default='synch',
+                        choices=('synch', 'verify', 'watch'),
+                        help='synch the buckets (default), check the '
+                             'local folders against them, or upload the '
+                             'local changes as they happen')
+    parser.add_argument('--saved', action='store_true',
+                        help='verify against the listing saved by the last '
+                             'run instead of listing the buckets')
+    parser.add_argument('--output',
+                        help='write the mismatches found by verify to this '
+                             'file instead of stdout')
+    args = parser.parse_args()
+
     config = None
     try:
         with open('config.toml') as conffile:
@@ -38,5 +252,14 @@ if __name__ == '__main__':
         exit(1)
 
     my_auth = qauth.get_authentication()
-    multibackup = MultipleBackupDriver(config, my_auth, QiniuBackupScaled)
-    multibackup.synch_all()
+    multibackup = MultipleBackupDriver(config, my_auth)
+    if args.command == 'watch':
+        exit(0 if multibackup.watch_all() else 1)
+    if args.command == 'verify':
+        out = open(args.output, 'w') if args.output else stdout
+        try:
+            exit(0 if multibackup.verify_all(out, args.saved) else 1)
+        finally:
+            if args.output:
+                out.close()
+    exit(0 if multibackup.synch_all() else 1)
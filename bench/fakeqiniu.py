@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+A local stand-in for Qiniu, enough to run the backup engines offline.
+
+`FakeQiniu` serves, on a single port:
+  - GET /list               the rsf listing API, with marker, limit, prefix
+                            and delimiter
+  - GET /cdn/<key>          the public bucket domain, with Range support
+  - POST /                  form upload
+  - POST /mkblk/<size>      resumable upload, block
+  - POST /mkfile/<size>/... resumable upload, file
+  - POST /stat/<entry>      metadata of a key
+  - POST /batch             stat, copy and move operations, at most 1000
+Every request can be delayed by `latency` seconds and fails with a 503 with
+probability `error_rate`. The requests served are counted per endpoint.
+
+Authentication is not checked.
+"""
+
+import base64
+import email.parser
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import qiniu
+from qiniu.config import Zone
+
+from qbackup.qetag import QEtag
+
+ENDPOINTS = ('list', 'get', 'form', 'mkblk', 'mkfile', 'stat', 'batch')
+
+
+def qetag_of(data):
+    etag = QEtag()
+    etag.update(data)
+    return etag.hexdigest()
+
+
+class FakeBucket:
+    """
+    the objects of a bucket: key -> (data, hash, putTime)
+    """
+
+    def __init__(self, objects=None):
+        self.objects = {}
+        self.lock = threading.Lock()
+        for key, data in (objects or {}).items():
+            self.put(key, data)
+
+    def put(self, key, data):
+        with self.lock:
+            self.objects[key] = (data, qetag_of(data),
+                                 int(time.time() * 10e6))
+        return self.objects[key][1]
+
+    def get(self, key):
+        with self.lock:
+            return self.objects.get(key)
+
+    def copy(self, source, target, move=False):
+        """
+        :return: the status of the operation, 612 if source is missing and
+                 614 if target exists
+        """
+        with self.lock:
+            if source not in self.objects:
+                return 612
+            if target in self.objects:
+                return 614
+            data, hash, _ = self.objects[source]
+            self.objects[target] = (data, hash, int(time.time() * 10e6))
+            if move:
+                del self.objects[source]
+        return 200
+
+    def list(self, prefix='', marker=None, limit=1000, delimiter=None):
+        """
+        :return: (items, common prefixes, next marker or None)
+        """
+        with self.lock:
+            keys = sorted(k for k in self.objects if k.startswith(prefix))
+            start = _decode_marker(marker) if marker else None
+            items, prefixes = [], []
+            last = None
+            for key in keys:
+                if start is not None and key <= start:
+                    continue
+                if len(items) + len(prefixes) >= limit:
+                    return items, prefixes, _encode_marker(last)
+                last = key
+                if delimiter:
+                    cut = key.find(delimiter, len(prefix))
+                    if cut >= 0:
+                        common = key[:cut + len(delimiter)]
+                        if common not in prefixes:
+                            prefixes.append(common)
+                        # skip the whole "directory" at once
+                        last = common + '\U0010ffff'
+                        start = last
+                        continue
+                data, hash, put_time = self.objects[key]
+                items.append({'key': key, 'hash': hash, 'fsize': len(data),
+                              'putTime': put_time,
+                              'mimeType': 'application/octet-stream'})
+            return items, prefixes, None
+
+
+def _decode_entry(entry):
+    """
+    :return: the key of an encoded `bucket:key` entry
+    """
+    return base64.urlsafe_b64decode(entry.encode()).decode().split(':', 1)[1]
+
+
+def _encode_marker(key):
+    return base64.urlsafe_b64encode(json.dumps({'k': key}).encode()).decode()
+
+
+def _decode_marker(marker):
+    return json.loads(base64.urlsafe_b64decode(marker.encode()).decode())['k']
+
+
+class FakeQiniu:
+    def __init__(self, bucket=None, latency=0, error_rate=0, seed=None):
+        """
+        :param bucket: FakeBucket served, an empty one if None
+        :param latency: delay added to every request, in sec
+        :param error_rate: probability for a request to fail with 503
+        :param seed: seed of the error injection
+        """
+        self.bucket = bucket if bucket is not None else FakeBucket()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = {endpoint: 0 for endpoint in ENDPOINTS}
+        self.errors = 0
+        self.blocks = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def host(self):
+        return '127.0.0.1:{0}'.format(self.server.server_port)
+
+    @property
+    def bucketurl(self):
+        return 'http://{0}/cdn/'.format(self.host)
+
+    def start(self):
+        handler = type('Handler', (_Handler,), {'fake': self})
+        self.server = _Server(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever,
+                         name='fake-qiniu', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def configure_sdk(self):
+        """
+        point the qiniu SDK (listing and uploads) at this server
+        """
+        qiniu.config.set_default(default_rsf_host=self.host,
+                                 default_rs_host=self.host,
+                                 default_zone=Zone(self.host, self.host))
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = {endpoint: 0 for endpoint in ENDPOINTS}
+            self.errors = 0
+
+    def _admit(self, endpoint):
+        """
+        :return: False if the request is chosen to fail
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests[endpoint] += 1
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors += 1
+                return False
+        return True
+
+
+class _Server(ThreadingHTTPServer):
+    # the default backlog of 5 drops the connections of a client opening
+    # hundreds at once
+    request_queue_size = 1024
+
+
+class _Handler(BaseHTTPRequestHandler):
+    fake = None
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, don't let Nagle hold the body
+    # until the client acknowledges the headers
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/list':
+            self._list(parse_qs(url.query))
+        elif url.path.startswith('/cdn/'):
+            self._download(unquote(url.path[len('/cdn/'):]))
+        else:
+            self._reply(404, {'error': 'no such endpoint'})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        path = urlsplit(self.path).path
+        if path == '/':
+            self._form_upload(body)
+        elif path.startswith('/mkblk/'):
+            self._make_block(body)
+        elif path.startswith('/mkfile/'):
+            self._make_file(path, body)
+        elif path.startswith('/stat/'):
+            self._stat(path[len('/stat/'):])
+        elif path == '/batch':
+            self._batch(parse_qs(body.decode()).get('op', []))
+        else:
+            self._reply(404, {'error': 'no such endpoint'})
+
+    def _list(self, query):
+        if not self.fake._admit('list'):
+            return self._reply(503, {'error': 'injected failure'})
+        first = lambda name, default=None: query.get(name, [default])[0]
+        limit = int(first('limit', 1000))
+        if limit <= 0 or limit > 1000:  # like rsf, out of range means 1000
+            limit = 1000
+        items, prefixes, marker = self.fake.bucket.list(
+            first('prefix', ''), first('marker'), limit, first('delimiter'))
+        ret = {'items': items}
+        if prefixes:
+            ret['commonPrefixes'] = prefixes
+        if marker:
+            ret['marker'] = marker
+        self._reply(200, ret)
+
+    def _download(self, key):
+        if not self.fake._admit('get'):
+            return self._reply(503, {'error': 'injected failure'})
+        obj = self.fake.bucket.get(key)
+        if obj is None:
+            return self._reply(404, {'error': 'no such file or directory'})
+        data = obj[0]
+        start, status = 0, 200
+        ranged = self.headers.get('Range', '')
+        if ranged.startswith('bytes=') and ranged.endswith('-'):
+            start = int(ranged[len('bytes='):-1])
+            if start >= len(data) and data:
+                return self._reply(416, {'error': 'range not satisfiable'})
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data) - start))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, len(data) - 1, len(data)))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def _form_upload(self, body):
+        if not self.fake._admit('form'):
+            return self._reply(503, {'error': 'injected failure'})
+        header = 'Content-Type: {0}\r\n\r\n'.format(
+            self.headers['Content-Type']).encode()
+        message = email.parser.BytesParser().parsebytes(header + body)
+        fields = {part.get_param('name', header='content-disposition'):
+                  part.get_payload(decode=True)
+                  for part in message.get_payload()}
+        key = fields['key'].decode()
+        data = fields['file']
+        if 'crc32' in fields and \
+                int(fields['crc32']) != zlib.crc32(data) & 0xffffffff:
+            return self._reply(406, {'error': 'crc32 not match'})
+        hash = self.fake.bucket.put(key, data)
+        self._reply(200, {'key': key, 'hash': hash})
+
+    def _make_block(self, body):
+        if not self.fake._admit('mkblk'):
+            return self._reply(503, {'error': 'injected failure'})
+        with self.fake.lock:
+            ctx = 'ctx{0}'.format(len(self.fake.blocks))
+            self.fake.blocks[ctx] = body
+        self._reply(200, {'ctx': ctx, 'checksum': '', 'offset': len(body),
+                          'host': 'http://' + self.fake.host,
+                          'crc32': zlib.crc32(body) & 0xffffffff,
+                          'expired_at': int(time.time()) + 7 * 24 * 3600})
+
+    def _make_file(self, path, body):
+        if not self.fake._admit('mkfile'):
+            return self._reply(503, {'error': 'injected failure'})
+        parts = path.split('/')
+        params = dict(zip(parts[3::2], parts[4::2]))
+        key = base64.urlsafe_b64decode(params['key'].encode()).decode()
+        with self.fake.lock:
+            try:
+                data = b''.join(self.fake.blocks[ctx]
+                                for ctx in body.decode().split(','))
+            except KeyError:
+                data = None
+        if data is None or len(data) != int(parts[2]):
+            return self._reply(701, {'error': 'invalid block contexts'})
+        hash = self.fake.bucket.put(key, data)
+        self._reply(200, {'key': key, 'hash': hash})
+
+    def _stat(self, entry):
+        if not self.fake._admit('stat'):
+            return self._reply(503, {'error': 'injected failure'})
+        self._reply(*self._stat_entry(entry))
+
+    def _stat_entry(self, entry):
+        found = self.fake.bucket.get(_decode_entry(entry))
+        if found is None:
+            return 612, {'error': 'no such file or directory'}
+        data, hash, put_time = found
+        return 200, {'fsize': len(data), 'hash': hash, 'putTime': put_time,
+                     'mimeType': 'application/octet-stream'}
+
+    def _batch(self, operations):
+        if not self.fake._admit('batch'):
+            return self._reply(503, {'error': 'injected failure'})
+        if len(operations) > 1000:
+            return self._reply(400, {'error': 'too many operations'})
+        results = []
+        for operation in operations:
+            name, *entries = operation.split('/')
+            if name == 'stat':
+                status, data = self._stat_entry(entries[0])
+            elif name in ('copy', 'move'):
+                status = self.fake.bucket.copy(_decode_entry(entries[0]),
+                                               _decode_entry(entries[1]),
+                                               move=name == 'move')
+                data = {} if status == 200 else {'error': 'failed'}
+            else:
+                status, data = 400, {'error': 'unknown operation'}
+            results.append({'code': status, 'data': data})
+        self._reply(200 if all(result['code'] == 200 for result in results)
+                    else 298, results)
+
+    def _reply(self, status, ret):
+        data = json.dumps(ret).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+End-to-end benchmark of the backup engines against a FakeQiniu server.
+
+For every engine, three runs are timed on a synthetic bucket:
+  download  the local folder is empty, every object is downloaded
+  noop      the same synch again, nothing to transfer
+  upload    the bucket has been emptied, every file is uploaded
+Each run happens in a fresh process so that its peak RSS can be measured.
+
+usage, from the root of the repository:
+    python -m bench.run --keys 2000 --sizes lognormal:9:2 --latency 0.005
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from bench.fakeqiniu import FakeBucket, FakeQiniu
+from bench.synthetic import SHAPES, generate
+
+ENGINES = ('base', 'flat', 'scaled', 'async')
+SCENARIOS = ('download', 'noop', 'upload')
+
+
+def engine_class(name):
+    from qbackup.qbackup import QiniuBackup, QiniuFlatBackup
+    from qbackup.qbackup_scaled import QiniuBackupScaled
+    if name == 'async':
+        from qbackup.qbackup_async import QiniuBackupAsync
+        return QiniuBackupAsync
+    return {'base': QiniuBackup, 'flat': QiniuFlatBackup,
+            'scaled': QiniuBackupScaled}[name]
+
+
+def synch_once(engine, host, options):
+    """
+    run one synch, in the process of a ProcessPoolExecutor
+    :return: (metrics dict of the run, peak RSS in KB, error or None)
+    """
+    import qiniu
+    from qiniu.config import Zone
+    from qbackup.qbackup import EventLogger
+    qiniu.config.set_default(default_rsf_host=host, default_rs_host=host,
+                             default_zone=Zone(host, host))
+
+    backup = engine_class(engine)(options, qiniu.Auth('ak', 'sk'),
+                                  EventLogger(verbose=False))
+    error = None
+    try:
+        backup.synch()
+    except Exception as e:
+        error = repr(e)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return backup.metrics.to_dict(), peak, error
+
+
+def bench_engine(engine, objects, args):
+    """
+    :return: list of result dicts, one per scenario
+    """
+    workdir = tempfile.mkdtemp(prefix='qbackup-bench-')
+    localdir = os.path.join(workdir, 'local')
+    os.mkdir(localdir)
+    results = []
+    fake = FakeQiniu(FakeBucket(objects), latency=args.latency,
+                     error_rate=args.error_rate, seed=args.seed)
+    with fake:
+        options = {
+            'bucketname': 'bench', 'bucketurl': fake.bucketurl,
+            'localdir': localdir, 'verbose': False, 'log': False,
+            'manifest_dir': os.path.join(workdir, 'manifest'),
+            'hash_cache': os.path.join(workdir, 'manifest', 'hashes.sqlite'),
+            'upload_state_dir': os.path.join(workdir, 'manifest', 'uploads'),
+            'metrics_dir': '',
+            'download_workers': args.workers,
+            'list_shards': args.list_shards,
+            'upload_workers': args.workers,
+            'retry_delay': 0.05,
+            'breaker_threshold': 0,
+        }
+        context = get_context('spawn')
+        for scenario in SCENARIOS:
+            if scenario == 'upload':
+                fake.bucket = FakeBucket()
+            fake.reset_counters()
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                start = time.monotonic()
+                metrics, peak, error = executor.submit(
+                    synch_once, engine, fake.host, options).result()
+                wall = time.monotonic() - start
+            counters = metrics['counters']
+            transferred = counters['downloaded_bytes'] \
+                + counters['uploaded_bytes']
+            elapsed = metrics['elapsed'] or wall
+            results.append({
+                'engine': engine, 'scenario': scenario,
+                'objects': len(objects),
+                'elapsed': elapsed,
+                'objects_per_second': len(objects) / elapsed,
+                'mb_per_second': transferred / elapsed / 1024 / 1024,
+                'peak_rss_kb': peak,
+                'requests': dict(fake.requests),
+                'injected_errors': fake.errors,
+                'counters': counters,
+                'phases': metrics['phases'],
+                'retry': metrics['retry'],
+                'error': error,
+            })
+    shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def report(results, out=sys.stdout):
+    line = '{0:<7} {1:<9} {2:>8} {3:>9} {4:>9} {5:>10} {6:>9}  {7}'
+    print(line.format('engine', 'scenario', 'sec', 'obj/s', 'MB/s',
+                      'rss KB', 'requests', 'status'), file=out)
+    for r in results:
+        print(line.format(r['engine'], r['scenario'],
+                          '{0:.2f}'.format(r['elapsed']),
+                          '{0:.1f}'.format(r['objects_per_second']),
+                          '{0:.2f}'.format(r['mb_per_second']),
+                          r['peak_rss_kb'], sum(r['requests'].values()),
+                          r['error'] or 'ok'), file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='benchmark the backup engines against a fake Qiniu')
+    parser.add_argument('--engine', choices=ENGINES + ('all',),
+                        default='all')
+    parser.add_argument('--keys', type=int, default=1000,
+                        help='number of objects in the bucket')
+    parser.add_argument('--sizes', default='lognormal:9:2',
+                        help='fixed:N, uniform:A:B or lognormal:MU:SIGMA')
+    parser.add_argument('--max-size', type=int, default=16 * 1024 * 1024)
+    parser.add_argument('--shapes', default=','.join(SHAPES),
+                        help='key shapes, among ' + ', '.join(SHAPES))
+    parser.add_argument('--list-shards', type=int, default=1,
+                        help='prefixes of the bucket listed at once')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='delay added to every request, in sec')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='probability for a request to fail with 503')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='download_workers and upload_workers')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the results there')
+    args = parser.parse_args(argv)
+
+    objects = generate(args.keys, args.sizes, args.shapes.split(','),
+                       args.seed, args.max_size)
+    engines = ENGINES if args.engine == 'all' else (args.engine,)
+    results = []
+    for engine in engines:
+        results.extend(bench_engine(engine, objects, args))
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+    return 0 if all(r['error'] is None for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
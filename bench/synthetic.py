@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Synthetic bucket content for the benchmarks.
+
+Keys come in several shapes so that the key <-> local path encodings are
+exercised: flat names, nested paths with `/`, names with `@` (which the
+hierarchical layout escapes), empty path segments (`a//b`) and Unicode.
+
+Sizes follow a distribution given as a string:
+  fixed:N            every object is N bytes
+  uniform:A:B        between A and B bytes
+  lognormal:MU:SIGMA exp(normal(MU, SIGMA)) bytes, like most real buckets:
+                     many small files and a few big ones
+All sizes are capped by `max_size`.
+"""
+
+import math
+import random
+
+SHAPES = ('flat', 'nested', 'at', 'empty', 'unicode')
+
+
+def key_for(i, shape):
+    """
+    :param i: index of the object
+    :param shape: one of SHAPES
+    :return: a key of the given shape, unique for i
+    """
+    if shape == 'flat':
+        return 'file-{0:06d}.bin'.format(i)
+    if shape == 'nested':
+        return 'dir{0}/sub{1}/file-{2:06d}.bin'.format(i % 7, i % 3, i)
+    if shape == 'at':
+        return '@{0}/mail@host-{1:06d}@@.txt'.format(i % 5, i)
+    if shape == 'empty':
+        return 'gap{0}//file-{1:06d}'.format(i % 4, i)
+    if shape == 'unicode':
+        return '相册{0}/照片-{1:06d}-é.jpg'.format(i % 3, i)
+    raise ValueError('unknown key shape ' + shape)
+
+
+def size_sampler(spec, rng, max_size=64 * 1024 * 1024):
+    """
+    :param spec: size distribution, see the module documentation
+    :param rng: random.Random
+    :param max_size: cap of the sizes
+    :return: function returning a size at each call
+    """
+    kind, _, args = spec.partition(':')
+    args = [float(a) for a in args.split(':')] if args else []
+    if kind == 'fixed':
+        sample = lambda: args[0]
+    elif kind == 'uniform':
+        sample = lambda: rng.uniform(args[0], args[1])
+    elif kind == 'lognormal':
+        sample = lambda: math.exp(rng.gauss(args[0], args[1]))
+    else:
+        raise ValueError('unknown size distribution ' + spec)
+    return lambda: int(min(max(sample(), 0), max_size))
+
+
+def generate(n, sizes='lognormal:9:2', shapes=SHAPES, seed=0,
+             max_size=64 * 1024 * 1024):
+    """
+    :param n: number of objects
+    :param sizes: size distribution
+    :param shapes: key shapes, used in turn
+    :param seed: the same seed gives the same bucket
+    :param max_size: cap of the object sizes
+    :return: dict key -> content
+    """
+    rng = random.Random(seed)
+    size = size_sampler(sizes, rng, max_size)
+    objects = {}
+    for i in range(n):
+        key = key_for(i, shapes[i % len(shapes)])
+        objects[key] = _random_bytes(rng, size())
+    return objects
+
+
+def _random_bytes(rng, size):
+    return rng.getrandbits(8 * size).to_bytes(size, 'little') if size else b''
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Streaming diff between the bucket listing and the local folder.
+
+The bucket listing comes back in lexicographic key order. If the local files
+are scanned in the same order, the two sides can be merge-joined like two
+sorted files: both streams are advanced in step and every key is decided the
+moment it is seen on both sides (or known to be missing from one). Nothing
+has to be kept in memory but the current item of each stream, and the
+transfers can start while the listing is still going on.
+"""
+
+import os
+
+DOWNLOAD = 'download'
+UPLOAD = 'upload'
+SKIP = 'skip'
+CONFLICT = 'conflict'  # both copies changed, or which one is unknown
+
+_END = object()
+
+
+def merge_join(remote, local):
+    """
+    :param remote: iterable of listing items, sorted by key
+    :param local: iterable of (key, path, stat), sorted by key
+    :except ValueError: one of the streams is not sorted
+    :return: generator of (key, listing item or None, local tuple or None)
+    """
+    remote = _ordered(remote, lambda item: item['key'])
+    local = _ordered(local, lambda entry: entry[0])
+    r = next(remote, _END)
+    l = next(local, _END)
+    while r is not _END or l is not _END:
+        if l is _END or (r is not _END and r['key'] < l[0]):
+            yield r['key'], r, None
+            r = next(remote, _END)
+        elif r is _END or l[0] < r['key']:
+            yield l[0], None, l
+            l = next(local, _END)
+        else:
+            yield r['key'], r, l
+            r = next(remote, _END)
+            l = next(local, _END)
+
+
+def diff(remote, local, hash_of=None, keep=None, synched_of=None):
+    """
+    decide what to transfer, key by key, as the streams go
+    :param remote: iterable of listing items, sorted by key
+    :param local: iterable of (key, path, stat), sorted by key
+    :param hash_of: callable (path, stat) -> local qetag. Files present on
+                    both sides are compared by hash, then by timestamp to
+                    choose the direction. Without it only timestamps count.
+    :param keep: callable (listing item or None, local tuple or None) ->
+                 False for the keys to leave alone, they do not come out
+    :param synched_of: callable path -> qetag of the file after its last
+                       transfer, or None, see decide
+    :return: generator of (action, key, listing item or None,
+                           local tuple or None). Keys present on both sides
+             that need no transfer come out as SKIP.
+    """
+    for key, item, entry in merge_join(remote, local):
+        if keep is not None and not keep(item, entry):
+            continue
+        yield decide(item, entry, hash_of, synched_of), key, item, entry
+
+
+def decide(item, entry, hash_of=None, synched_of=None):
+    """
+    When the contents differ, the side that changed since the last transfer
+    of the key, according to synched_of, wins. Without that record, or if
+    both sides changed, local content is never downloaded over: a newer
+    local copy is uploaded, otherwise the key is a CONFLICT, left alone.
+    Only without hashes are timestamps trusted both ways.
+    :param item: listing item of a key, None if the key is only local
+    :param entry: (key, path, stat) of the local file, None if the key is
+                  only remote
+    :param hash_of: see diff
+    :param synched_of: see diff
+    :return: DOWNLOAD, UPLOAD, SKIP or CONFLICT
+    """
+    if entry is None:
+        return DOWNLOAD
+    if item is None:
+        return UPLOAD
+    _, path, stat = entry
+    # putTime is in units of 100ns, st_mtime in seconds
+    remote_newer = item['putTime'] // int(10e6) > int(stat.st_mtime)
+    if hash_of is None or item.get('hash') is None:
+        return DOWNLOAD if remote_newer else SKIP
+    local_hash = hash_of(path, stat)
+    if local_hash == item['hash']:
+        return SKIP  # same content
+    synched = synched_of(path) if synched_of is not None else None
+    if synched is None:
+        return CONFLICT if remote_newer else UPLOAD
+    if synched == item['hash']:  # only the local copy has been edited
+        return UPLOAD
+    if synched == local_hash:  # only the remote copy has changed
+        return DOWNLOAD
+    return CONFLICT
+
+
+def scan_sorted(root, decode, part_suffix=None, key_filter=None):
+    """
+    walk a local folder in the order of the keys the files stand for
+    :param root: folder to scan
+    :param decode: function translating a relative posix path into a key
+    :param part_suffix: skip the files ending with this suffix
+    :param key_filter: KeyFilter, the directories it cannot keep any key
+                       of are not walked, the keys it does not keep are
+                       skipped
+    :return: generator of (key, path, stat), sorted by key
+    """
+    return _scan_dir(str(root), '', decode, part_suffix, key_filter)
+
+
+def _scan_dir(directory, relative, decode, part_suffix, key_filter):
+    with os.scandir(directory) as it:
+        entries = []
+        for entry in it:
+            if part_suffix and entry.name.endswith(part_suffix):
+                continue
+            is_dir = entry.is_dir(follow_symlinks=False)
+            path = relative + entry.name + ('/' if is_dir else '')
+            # a directory sorts as the prefix of the keys inside it
+            key = decode(path)
+            if key_filter is not None and not (
+                    key_filter.wants_dir(key) if is_dir
+                    else key_filter.wants_key(key)):
+                continue
+            entries.append((key, is_dir, path, entry))
+    entries.sort(key=lambda e: e[0])
+    for key, is_dir, path, entry in entries:
+        if is_dir:
+            yield from _scan_dir(entry.path, path, decode, part_suffix,
+                                 key_filter)
+        else:
+            yield key, entry.path, entry.stat()
+
+
+def _ordered(items, key_of):
+    previous = None
+    for item in items:
+        key = key_of(item)
+        if previous is not None and key < previous:
+            raise ValueError('stream is not sorted: ' + repr(previous)
+                             + ' came before ' + repr(key))
+        previous = key
+        yield item
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Include/exclude rules of a bucket.
+
+A rule is a key prefix, such as `photos/`, or a glob matched against the
+whole key, such as `*.tmp` (`*` also matches `/`). A glob ending with its
+only `*` is a prefix as well. A key is kept if it matches an include rule,
+or if there are none, and matches no exclude rule.
+
+The rules are pushed down as far as they go. The literal beginnings of the
+include rules are the prefixes the bucket is listed with, so the rest of
+the bucket is never listed. A local directory none of whose keys can be
+kept is not walked.
+
+Size and age rules apply to each copy of a key instead: the listing item
+when the key is in the bucket, the local file otherwise. A file too big or
+too old is left alone on both sides.
+"""
+
+import fnmatch
+import re
+import time
+
+GLOB_CHARS = '*?['
+
+
+def _literal_prefix(rule):
+    """
+    :return: the part of rule before its first glob character
+    """
+    end = len(rule)
+    for char in GLOB_CHARS:
+        index = rule.find(char)
+        if index != -1:
+            end = min(end, index)
+    return rule[:end]
+
+
+class KeyFilter:
+    def __init__(self, include=(), exclude=(), min_size=None, max_size=None,
+                 min_age=None, max_age=None):
+        """
+        :param include: rules of the keys to keep, every key if empty
+        :param exclude: rules of the keys to leave alone
+        :param min_size: smallest size kept, in bytes
+        :param max_size: biggest size kept, in bytes
+        :param min_age: youngest age kept, in sec
+        :param max_age: oldest age kept, in sec
+        """
+        self.include_prefixes, self.include_globs = self._compile(include)
+        self.exclude_prefixes, self.exclude_globs = self._compile(exclude)
+        # the literal beginning of every include rule
+        self.include_starts = tuple(_literal_prefix(rule) for rule in include)
+        self.has_include = bool(include)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.min_age = min_age
+        self.max_age = max_age
+        self.now = time.time()
+        self.active = bool(include or exclude) or any(
+            limit is not None for limit in (min_size, max_size,
+                                            min_age, max_age))
+
+    @classmethod
+    def from_options(cls, options):
+        """
+        :param options: options of the bucket, sizes in KB and ages in days
+        """
+        def scaled(name, unit):
+            value = options.get(name, None)
+            return None if value is None else value * unit
+
+        return cls(include=options.get('include', []),
+                   exclude=options.get('exclude', []),
+                   min_size=scaled('min_size', 1024),
+                   max_size=scaled('max_size', 1024),
+                   min_age=scaled('min_age', 24 * 3600),
+                   max_age=scaled('max_age', 24 * 3600))
+
+    @staticmethod
+    def _compile(rules):
+        """
+        :return: (tuple of prefixes, compiled regex of the globs or None)
+        """
+        prefixes, globs = [], []
+        for rule in rules:
+            head = rule[:-1] if rule.endswith('*') else rule
+            if _literal_prefix(head) == head:
+                prefixes.append(head)
+            else:
+                globs.append(fnmatch.translate(rule))
+        regex = re.compile('|'.join(globs), re.DOTALL) if globs else None
+        return tuple(prefixes), regex
+
+    def prefixes(self):
+        """
+        :return: sorted list of the prefixes to list the bucket with, none
+                 of them a prefix of another. [''] lists the whole bucket.
+        """
+        if not self.has_include:
+            return ['']
+        prefixes = []
+        for start in sorted(set(self.include_starts)):
+            if not prefixes or not start.startswith(prefixes[-1]):
+                prefixes.append(start)
+        return prefixes
+
+    def wants_key(self, key):
+        """
+        :return: True if key is kept by the include and exclude rules
+        """
+        if self.has_include and not key.startswith(self.include_prefixes) \
+                and not (self.include_globs and
+                         self.include_globs.match(key)):
+            return False
+        return not key.startswith(self.exclude_prefixes) and \
+            not (self.exclude_globs and self.exclude_globs.match(key))
+
+    def wants_dir(self, prefix):
+        """
+        :param prefix: key prefix of a local directory, ending with '/'
+        :return: False if no key starting with prefix can be kept
+        """
+        if prefix.startswith(self.exclude_prefixes):
+            return False
+        return not self.has_include or any(
+            start.startswith(prefix) or prefix.startswith(start)
+            for start in self.include_starts)
+
+    def wants(self, size, mtime):
+        """
+        :param size: size of a copy, in bytes
+        :param mtime: time it was written, in sec since the epoch
+        :return: True if the copy is kept by the size and age rules
+        """
+        age = self.now - mtime
+        return (self.min_size is None or size >= self.min_size) and \
+            (self.max_size is None or size <= self.max_size) and \
+            (self.min_age is None or age >= self.min_age) and \
+            (self.max_age is None or age <= self.max_age)
+
+    def wants_item(self, item):
+        """
+        :param item: listing item, its putTime is in 100 ns
+        """
+        return self.wants(item['fsize'], item['putTime'] / 1e7)
+
+    def wants_stat(self, stat):
+        return self.wants(stat.st_size, stat.st_mtime)
+
+    def wants_copies(self, item, entry):
+        """
+        :param item: listing item of a key, or None
+        :param entry: (key, path, stat) of its local file, or None
+        :return: True if the key is to be synched. The listing item decides
+                 when there is one, so a key is never uploaded only because
+                 the bucket's copy is out of bounds.
+        """
+        if item is not None:
+            return self.wants_item(item)
+        return self.wants_stat(entry[2])
+
+
+NO_FILTER = KeyFilter()
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Limits shared by every transfer of a run.
+
+A single `TransferBudget` is handed to every bucket that is synched, so the
+limits hold for the run as a whole and not per bucket: at most
+`max_transfers` downloads and uploads are in flight at the same time, and
+together they move no more than `bandwidth` bytes per second.
+
+With `adaptive` set, the number of transfers in flight is not fixed but
+found by an `AdaptiveLimit`, AIMD style like TCP: it grows by one while the
+transfers go well and is cut when the server throttles us (429 or 5xx) or
+when more transfers only add latency without adding throughput.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+class TokenBucket:
+    """
+    classic token bucket, refilled at `rate` bytes per second and holding at
+    most one second worth of tokens
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.capacity = self.rate
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """
+        take `amount` tokens, sleeping until they are available. A request
+        bigger than the capacity drives the bucket into debt, which later
+        requests wait out.
+        """
+        wait = self.reserve(amount)
+        if wait:
+            time.sleep(wait)
+
+    def reserve(self, amount):
+        """
+        take `amount` tokens without waiting
+        :return: how long to wait before using them, in sec
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class AdaptiveLimit:
+    """
+    concurrency limit adjusted by additive increase, multiplicative decrease.
+    The transfers finished since the last adjustment form a window; when a
+    window closes the limit is
+      - halved if a transfer of the window was throttled,
+      - reduced by a tenth if throughput dropped while latency rose, the
+        extra transfers are then only queuing somewhere,
+      - raised by one otherwise, but only if the limit was actually
+        reached during the window: when the workers cannot fill the limit,
+        there is nothing to learn from raising it.
+    """
+    THROTTLE_DECREASE = 0.5
+    CONGESTION_DECREASE = 0.9
+    LATENCY_TOLERANCE = 1.5  # times the best window latency
+    MIN_WINDOW = 1.0  # sec
+    DEFAULT_MAXIMUM = 64
+
+    def __init__(self, initial, minimum=1, maximum=DEFAULT_MAXIMUM):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.inflight = 0
+        self.cond = threading.Condition()
+
+        self.window_start = time.monotonic()
+        self.window_done = 0
+        self.window_bytes = 0
+        self.window_latency = 0.0
+        self.window_throttled = 0
+        self.window_peak = 0
+        self.throughput = None  # bytes/sec of the previous window
+        self.best_latency = None
+        self.throttled = 0  # over the whole run
+
+    def acquire(self):
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+            self.window_peak = max(self.window_peak, self.inflight)
+
+    def release(self, nbytes, elapsed, throttled=False):
+        """
+        :param nbytes: bytes moved by the finished transfer
+        :param elapsed: duration of the transfer, in sec
+        :param throttled: the server answered 429 or 5xx
+        """
+        with self.cond:
+            self.inflight -= 1
+            self.window_done += 1
+            self.window_bytes += nbytes
+            self.window_latency += elapsed
+            if throttled:
+                self.window_throttled += 1
+                self.throttled += 1
+            now = time.monotonic()
+            if self.window_done >= int(self.limit) and \
+                    now - self.window_start >= self.MIN_WINDOW:
+                self._adjust(now)
+            self.cond.notify_all()
+
+    def _adjust(self, now):
+        throughput = self.window_bytes / (now - self.window_start)
+        latency = self.window_latency / self.window_done
+        if self.best_latency is None or latency < self.best_latency:
+            self.best_latency = latency
+
+        if self.window_throttled:
+            self.limit *= self.THROTTLE_DECREASE
+        elif self.throughput is not None and throughput < self.throughput \
+                and latency > self.best_latency * self.LATENCY_TOLERANCE:
+            self.limit *= self.CONGESTION_DECREASE
+        elif self.window_peak >= int(self.limit):
+            self.limit += 1
+        self.limit = min(max(self.limit, self.minimum), self.maximum)
+
+        self.throughput = throughput
+        self.window_start = now
+        self.window_done = self.window_bytes = self.window_throttled = 0
+        self.window_peak = self.inflight
+        self.window_latency = 0.0
+
+
+class Transfer:
+    """
+    a single transfer holding a slot of the budget, see
+    TransferBudget.transfer
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.nbytes = 0
+        self.throttled = False
+
+    def consume(self, nbytes):
+        self.nbytes += nbytes
+        self.budget.consume(nbytes)
+
+    def status(self, status_code):
+        """
+        report the HTTP status of a response, 429 and 5xx mean the server is
+        pushing back
+        """
+        if status_code == 429 or status_code >= 500:
+            self.throttled = True
+
+
+class TransferBudget:
+    def __init__(self, max_transfers=0, bandwidth=0, adaptive=False,
+                 min_transfers=1):
+        """
+        :param max_transfers: maximum number of concurrent transfers,
+                              0 for no limit
+        :param bandwidth: maximum total bytes per second, 0 for no limit
+        :param adaptive: find the number of concurrent transfers between
+                         min_transfers and max_transfers (64 if no limit)
+        :param min_transfers: lower bound of the adaptive limit
+        """
+        self.max_transfers = max_transfers
+        self.slots = None
+        self.adaptive = None
+        if adaptive:
+            maximum = max_transfers or AdaptiveLimit.DEFAULT_MAXIMUM
+            self.adaptive = AdaptiveLimit(min(4, maximum), min_transfers,
+                                          maximum)
+        elif max_transfers:
+            self.slots = threading.BoundedSemaphore(max_transfers)
+        self.bucket = TokenBucket(bandwidth) if bandwidth else None
+
+    @classmethod
+    def from_options(cls, options):
+        """
+        :param options: the [options] table of the config file
+        :return: TransferBudget built from `max_transfers` and
+                 `bandwidth_limit` (KB/s)
+        """
+        return cls(max_transfers=options.get('max_transfers', 0),
+                   bandwidth=options.get('bandwidth_limit', 0) * 1024,
+                   adaptive=options.get('adaptive_transfers', False),
+                   min_transfers=options.get('min_transfers', 1))
+
+    @contextmanager
+    def transfer(self):
+        """
+        hold one transfer slot for the duration of the with block
+        :return: the Transfer, to consume() bandwidth through and report the
+                 status of the responses to
+        """
+        transfer = Transfer(self)
+        if self.adaptive:
+            self.adaptive.acquire()
+        elif self.slots:
+            self.slots.acquire()
+        start = time.monotonic()
+        try:
+            yield transfer
+        finally:
+            if self.adaptive:
+                self.adaptive.release(transfer.nbytes,
+                                      time.monotonic() - start,
+                                      transfer.throttled)
+            elif self.slots:
+                self.slots.release()
+
+    def concurrency(self):
+        """
+        :return: the current limit on concurrent transfers, 0 for no limit
+        """
+        if self.adaptive:
+            return int(self.adaptive.limit)
+        return self.max_transfers
+
+    def consume(self, nbytes):
+        """
+        account for nbytes moved over the network, blocks to keep the total
+        under the bandwidth limit
+        """
+        if self.bucket and nbytes:
+            self.bucket.consume(nbytes)
+
+    def reserve(self, nbytes):
+        """
+        account for nbytes without blocking, for callers that cannot sleep
+        :return: how long to wait to stay under the bandwidth limit, in sec
+        """
+        if self.bucket and nbytes:
+            return self.bucket.reserve(nbytes)
+        return 0
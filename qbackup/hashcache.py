@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Persistent cache of local qetags.
+
+Hashing a file means reading all of it, so the result is remembered together
+with the stat signature of the file: (device, inode, size, mtime). As long as
+the signature is the same, the file is assumed unchanged and never hashed
+again. Files that do need hashing can be hashed on several cores at once.
+
+The path of each file is kept as well, so the cache doubles as a content
+index: `find` returns a local file with a given qetag, which lets a download
+be served by copying a file that is already on disk.
+
+Last, it remembers the qetag each local path had after its last transfer,
+so that when both copies of a key differ, the engines without a manifest
+can still tell which side changed (see qbackup.diff.decide).
+
+Writes are committed every BATCH_SIZE statements or COMMIT_INTERVAL
+seconds, so a cache shared by buckets synched at the same time is never
+locked for long. It is only a
+cache: a query or a write the database refuses (locked, disk full) is
+dropped with a warning, and costs at most hashing the file again.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from qbackup.qetag import qetag
+from qbackup.tracing import NULL_TRACER
+
+
+def signature(stat):
+    """
+    :param stat: os.stat_result of a file
+    :return: the cache key of the file
+    """
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class HashCache:
+    BATCH_SIZE = 200  # most writes per transaction
+    COMMIT_INTERVAL = 1  # most sec between the first write and the commit
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS hashes (
+        dev      INTEGER,
+        ino      INTEGER,
+        size     INTEGER,
+        mtime_ns INTEGER,
+        hash     TEXT,
+        path     TEXT,
+        PRIMARY KEY (dev, ino)
+    );
+    CREATE TABLE IF NOT EXISTS synched (
+        path TEXT PRIMARY KEY,
+        hash TEXT
+    );
+    """
+
+    def __init__(self, path, workers=None, tracer=None, logger=None):
+        """
+        :param path: location of the cache database, created if necessary
+        :param workers: number of processes used by hash_many,
+                        defaults to the number of CPUs
+        :param tracer: Tracer recording the files actually hashed
+        :param logger: EventLogger the database errors are reported to
+        """
+        self.path = Path(path)
+        if not self.path.parent.exists():
+            self.path.parent.mkdir(parents=True)
+        # the cache may be shared by buckets synched at the same time
+        self.db = sqlite3.connect(str(self.path), timeout=60,
+                                  check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(self.SCHEMA)
+        columns = [row[1] for row in
+                   self.db.execute('PRAGMA table_info(hashes)')]
+        if 'path' not in columns:  # cache written by an older version
+            self.db.execute('ALTER TABLE hashes ADD COLUMN path TEXT')
+        self.db.execute('CREATE INDEX IF NOT EXISTS hashes_by_hash '
+                        'ON hashes (hash)')
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.pending = 0  # writes not committed yet
+        self.began = 0  # time of the first of them
+        self.warned = False  # a database error has been logged
+        self.logger = logger
+        self.workers = workers or os.cpu_count() or 1
+        self.hashed = 0  # files actually read during this run
+        self.tracer = tracer if tracer is not None else NULL_TRACER
+        self.executor = None  # started by the first batch that needs it
+
+    @staticmethod
+    def path_for(directory, bucketname):
+        return Path(directory) / (bucketname + '.sqlite')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        with self.lock:
+            self._commit()
+            self.db.close()
+
+    def commit(self):
+        with self.lock:
+            self._commit()
+
+    def lookup(self, stat, path=None):
+        """
+        :param stat: os.stat_result of the file
+        :param path: path of the file, remembered if the cache has another
+                     one (the file was renamed) or none
+        :return: the cached qetag, or None if the file changed or is unknown
+        """
+        dev, ino, size, mtime_ns = signature(stat)
+        with self.lock:
+            rows = self._read(
+                'SELECT hash, path FROM hashes WHERE dev = ? AND ino = ? '
+                'AND size = ? AND mtime_ns = ?', (dev, ino, size, mtime_ns))
+            if not rows:
+                return None
+            row = rows[0]
+            if path is not None:
+                path = os.path.abspath(str(path))
+                if row[1] != path:
+                    self._write('UPDATE hashes SET path = ? '
+                                'WHERE dev = ? AND ino = ?',
+                                (path, dev, ino))
+        return row[0]
+
+    def store(self, stat, hash, commit=True, path=None):
+        """
+        :param stat: os.stat_result of the file
+        :param hash: its qetag
+        :param commit: commit now rather than with the next batch
+        :param path: path of the file, for find
+        """
+        if path is not None:
+            path = os.path.abspath(str(path))
+        with self.lock:
+            self._write(
+                'INSERT INTO hashes (dev, ino, size, mtime_ns, hash, path) '
+                'VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(dev, ino) DO UPDATE SET '
+                'size = excluded.size, mtime_ns = excluded.mtime_ns, '
+                'hash = excluded.hash, path = COALESCE(excluded.path, path)',
+                signature(stat) + (hash, path))
+            if commit:
+                self._commit()
+
+    def record_synched(self, path, hash):
+        """
+        remember hash as the content of path after its last transfer, or
+        the last time it was found equal to the remote copy
+        """
+        with self.lock:
+            self._write(
+                'INSERT INTO synched (path, hash) VALUES (?, ?) '
+                'ON CONFLICT(path) DO UPDATE SET hash = excluded.hash '
+                'WHERE hash IS NOT excluded.hash',
+                (os.path.abspath(str(path)), hash))
+
+    def synched(self, path):
+        """
+        :return: the qetag of path after its last transfer, None if unknown
+        """
+        with self.lock:
+            rows = self._read('SELECT hash FROM synched WHERE path = ?',
+                              (os.path.abspath(str(path)),))
+        return rows[0][0] if rows else None
+
+    def find(self, hash):
+        """
+        :param hash: qetag to look for
+        :return: pathlib.Path of a local file with that qetag, that has not
+                 changed since it was hashed, or None
+        """
+        with self.lock:
+            rows = self._read(
+                'SELECT dev, ino, size, mtime_ns, path FROM hashes '
+                'WHERE hash = ? AND path IS NOT NULL', (hash,))
+        for row in rows:
+            try:
+                stat = os.stat(row[4])
+            except OSError:
+                continue
+            if signature(stat) == tuple(row[:4]):
+                return Path(row[4])
+        return None
+
+    def hash_file(self, path, stat=None):
+        """
+        :param path: path of a local file
+        :param stat: os.stat_result of the file, if already known
+        :return: the qetag of the file, from the cache when possible
+        """
+        if stat is None:
+            stat = os.stat(str(path))
+        hash = self.lookup(stat, path)
+        if hash is None:
+            with self.tracer.span('hash_file', 'local', size=stat.st_size):
+                hash = qetag(path)
+            self.hashed += 1
+            self.store(stat, hash, path=path)
+        return hash
+
+    def warm(self, scan, batch=256):
+        """
+        hash the files of a scan missing from the cache, `batch` at a time,
+        so a folder of any size is warmed up with bounded memory
+        :param scan: iterable of (key, path, os.stat_result)
+        :param batch: number of files handed to the processes at once
+        :return: number of files hashed
+        """
+        before = self.hashed
+        pending = []
+        for _, path, stat in scan:
+            if self.lookup(stat, path) is None:
+                pending.append((path, stat))
+            if len(pending) >= batch:
+                self.hash_many(pending)
+                pending = []
+        if pending:
+            self.hash_many(pending)
+        return self.hashed - before
+
+    def hash_many(self, files):
+        """
+        hash a batch of files, the ones missing from the cache are hashed by
+        a pool of processes
+        :param files: iterable of (path, os.stat_result)
+        :return: dict mapping each path to its qetag
+        """
+        result = {}
+        missing = []
+        for path, stat in files:
+            hash = self.lookup(stat, path)
+            if hash is None:
+                missing.append((path, stat))
+            else:
+                result[path] = hash
+        if not missing:
+            return result
+
+        with self.tracer.span('hash_many', 'local', files=len(missing)):
+            hashes = self._hash_missing(missing)
+
+        for (path, stat), hash in zip(missing, hashes):
+            result[path] = hash
+            self.store(stat, hash, commit=False, path=path)
+        self.hashed += len(missing)
+        self.commit()
+        return result
+
+    def _read(self, statement, args):
+        """
+        run a query, the lock must be held
+        :return: the rows, none if the database cannot be read
+        """
+        try:
+            return self.db.execute(statement, args).fetchall()
+        except sqlite3.OperationalError as e:
+            self._dropped(e)
+            return []
+
+    def _write(self, statement, args):
+        """
+        run a write statement, the lock must be held
+        """
+        try:
+            self.db.execute(statement, args)
+        except sqlite3.OperationalError as e:
+            self._dropped(e)
+            return
+        now = time.monotonic()
+        if not self.pending:
+            self.began = now
+        self.pending += 1
+        if self.pending >= self.BATCH_SIZE or \
+                now - self.began >= self.COMMIT_INTERVAL:
+            self._commit()
+
+    def _commit(self):
+        """
+        commit the pending writes, the lock must be held
+        """
+        try:
+            self.db.commit()
+        except sqlite3.OperationalError as e:
+            self.db.rollback()
+            self._dropped(e)
+        self.pending = 0
+
+    def _dropped(self, error):
+        if not self.warned and self.logger is not None:
+            self.warned = True
+            self.logger('WARNING', 'hash cache ' + str(self.path) + ': '
+                        + str(error) + ', some hashes are not saved or '
+                        'computed again')
+
+    def _hash_missing(self, missing):
+        if self.workers > 1 and len(missing) > 1:
+            # the processes are kept for the next batches
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            return list(self.executor.map(qetag,
+                                          [str(p) for p, _ in missing],
+                                          chunksize=16))
+        return [qetag(path) for path, _ in missing]
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Minimal binding of the Linux inotify API, through ctypes, so that watching
+a folder needs no extra package. Only what the watch mode uses is bound.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+from collections import namedtuple
+
+# event masks, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, length of the name
+
+Event = namedtuple('Event', ['wd', 'mask', 'cookie', 'name'])
+
+
+class Inotify:
+    READ_SIZE = 64 * 1024
+
+    def __init__(self):
+        """
+        :except OSError: inotify is not available (not Linux)
+        """
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not available on this system')
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            self._raise('inotify_init1')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def add_watch(self, path, mask):
+        """
+        :param path: file or folder to watch
+        :param mask: events wanted, IN_* or-ed together
+        :return: the watch descriptor
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(str(path)),
+                                         ctypes.c_uint32(mask))
+        if wd < 0:
+            self._raise(str(path))
+        return wd
+
+    def read(self, timeout=None):
+        """
+        wait for events
+        :param timeout: in sec, None to wait until an event comes
+        :return: list of Events, empty if none came in time
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, self.READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append(Event(wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    @staticmethod
+    def _raise(what):
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), what)
@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Pipelined bucket listing.
+
+`BucketManager.list` returns one page of keys and a marker for the next page.
+Instead of waiting for the caller to finish a page before asking for the next
+one, `BucketLister` fetches pages on a background thread and hands them over
+through a small queue, so the round trip for page n+1 overlaps the processing
+of page n. A page that fails is tried again according to the RetryPolicy.
+
+Even pipelined, the listing is a single chain of markers, one round trip per
+page. `ShardedLister` splits the bucket into disjoint prefixes, found by
+listing with delimiter '/', lists several of them at the same time, and
+yields the items back in key order.
+
+`FilteredLister` lists only the parts of the bucket a KeyFilter can keep,
+one prefix after the other.
+
+Every lister has a `marker` that a new lister of the same bucket can resume
+from, past the pages the caller is done with. The markers of ShardedLister
+and FilteredLister are composite: the prefix listed at the time and the
+marker within it. A marker a lister cannot resume from, say after the
+settings changed, is ignored and the listing starts over.
+"""
+
+import heapq
+import json
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+
+from qiniu import BucketManager
+
+from qbackup.retry import HTTPStatusError, RetryPolicy
+from qbackup.tracing import NULL_TRACER
+
+COMPOSITE = 'qbackup:'  # tags the markers of ShardedLister, FilteredLister
+SHARDS = 'shards'
+PREFIXES = 'prefixes'
+
+
+def composite_marker(kind, prefix, marker):
+    """
+    :param kind: SHARDS or PREFIXES
+    :param prefix: the prefix being listed
+    :param marker: the marker within that prefix
+    :return: a marker to resume the listing from
+    """
+    return COMPOSITE + json.dumps([kind, prefix, marker])
+
+
+def split_marker(marker, kind):
+    """
+    :return: (prefix, marker within it) of a composite marker of kind,
+             None if marker is not one
+    """
+    if not marker or not marker.startswith(COMPOSITE):
+        return None
+    try:
+        parts = json.loads(marker[len(COMPOSITE):])
+    except ValueError:
+        return None
+    if not isinstance(parts, list) or len(parts) != 3 or parts[0] != kind:
+        return None
+    return parts[1], parts[2]
+
+
+class BucketLister:
+    MAX_LIMIT = 1000  # the API refuses to return more per page
+    PREFETCH = 2  # pages fetched ahead of the consumer
+
+    def __init__(self, auth, bucketname, limit=100, prefix=None, marker=None,
+                 retry=None, tracer=None, prefetch=PREFETCH):
+        """
+        :param auth: qiniu.Auth object
+        :param bucketname: bucket to list
+        :param limit: page size, clamped to [1, MAX_LIMIT]
+        :param prefix: only list the keys starting with prefix
+        :param marker: resume listing from this marker
+        :param retry: RetryPolicy for the pages, a default one if None
+        :param tracer: Tracer recording a span per page request
+        :param prefetch: pages fetched ahead of the consumer
+        """
+        self.bucket = BucketManager(auth)
+        self.bucketname = bucketname
+        self.limit = max(1, min(int(limit), self.MAX_LIMIT))
+        self.prefix = prefix
+        # a composite marker comes from another kind of lister
+        self.marker = None if marker and marker.startswith(COMPOSITE) \
+            else marker
+        self.pages_listed = 0
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.tracer = tracer if tracer is not None else NULL_TRACER
+        self.prefetch = prefetch
+        self.queue = None
+        self.stopped = threading.Event()
+
+    def __iter__(self):
+        """
+        :return: generator of listing items, in the order of the bucket
+        """
+        for page in self.pages():
+            for item in page['items']:
+                yield item
+
+    def start(self):
+        """
+        start fetching pages in the background, before they are iterated
+        """
+        if self.queue is None:
+            self.queue = queue.Queue(maxsize=self.prefetch)
+            threading.Thread(target=self._fetch,
+                             args=(self.queue, self.stopped),
+                             name='qbackup-lister', daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def pages(self):
+        """
+        generator of listing pages. The next page is already being fetched
+        while the caller works on the current one.
+        :except ConnectionError: a page could not be listed
+        """
+        self.start()
+        pages = self.queue
+        try:
+            while True:
+                page = pages.get()
+                if isinstance(page, Exception):
+                    raise page
+                if page is None:
+                    return
+                self.pages_listed += 1
+                yield page
+                # only advance once the caller is done with the page, so that
+                # `marker` always points past fully processed pages
+                self.marker = page.get('marker')
+        finally:
+            self.stop()
+
+    def _fetch(self, pages, stop):
+        marker = self.marker
+        done = False
+        while not done and not stop.is_set():
+            try:
+                res, done = self.retry.call('listing ' + self.bucketname,
+                                            self._list_page, marker)
+            except Exception as e:
+                self._put(pages, stop, e)
+                return
+            marker = res.get('marker')
+            self._put(pages, stop, res)
+        self._put(pages, stop, None)
+
+    def _list_page(self, marker):
+        with self.tracer.span('list_page', 'listing', limit=self.limit) as span:
+            res, done, info = self.bucket.list(self.bucketname,
+                                               prefix=self.prefix,
+                                               marker=marker,
+                                               limit=self.limit)
+            span['items'] = len(res.get('items', [])) if res else 0
+        if not res:
+            raise HTTPStatusError(
+                info.status_code if info is not None else -1,
+                'could not establish connection with cloud')
+        return res, done
+
+    @staticmethod
+    def _put(pages, stop, page):
+        # never block forever on a consumer that has gone away
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+
+class ShardedLister:
+    """
+    lists disjoint prefixes of the bucket at the same time, and yields the
+    items of the whole bucket in key order, like BucketLister.
+
+    The prefixes are discovered by listing with delimiter '/', level by
+    level from the top of the bucket, as long as more shards are wanted. A
+    prefix whose level does not fit in a single page becomes a shard. The
+    keys found along the way are kept and merged with the shards. A bucket
+    whose top level takes more than MAX_PROBES pages is listed by a single
+    BucketLister.
+
+    The shards are consumed one after the other, since their key ranges do
+    not overlap, while the next `shards` - 1 of them are listed ahead, each
+    holding up to SHARD_PREFETCH pages.
+
+    The marker is the shard being consumed and the marker within it. A
+    resumed listing discovers the shards again, and lists from that shard
+    on, along with the keys found on the way that sort after it. If the
+    shard is gone, the listing starts over.
+    """
+    SHARD_PREFETCH = 16
+    SHARDS_PER_LISTER = 4  # shards wanted per concurrent lister
+    MAX_PROBES = 64  # delimiter listings made to discover the shards
+
+    def __init__(self, auth, bucketname, shards=4, limit=1000, retry=None,
+                 tracer=None, prefix=None, marker=None):
+        """
+        :param auth: qiniu.Auth object
+        :param bucketname: bucket to list
+        :param shards: number of prefixes listed at the same time
+        :param limit: page size of the shards, clamped to [1, MAX_LIMIT]
+        :param retry: RetryPolicy for the pages, a default one if None
+        :param tracer: Tracer recording a span per page request
+        :param prefix: only list the keys starting with prefix
+        :param marker: resume listing from this marker
+        """
+        self.auth = auth
+        self.bucket = BucketManager(auth)
+        self.bucketname = bucketname
+        self.shards = max(1, shards)
+        self.limit = limit
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.tracer = tracer if tracer is not None else NULL_TRACER
+        self.prefix = prefix or ''
+        self.resume_marker = marker
+        # (shard prefix, marker within it), shard None for a single chain
+        self.resume = split_marker(marker, SHARDS)
+        self.current = None  # (shard prefix, lister) being consumed
+        self.probes = 0
+        self.prefixes = []
+        self.listers = []
+        self.lock = threading.Lock()
+
+    @property
+    def pages_listed(self):
+        return self.probes + sum(lister.pages_listed
+                                 for lister in self.listers)
+
+    @property
+    def marker(self):
+        if self.current is None:
+            return self.resume_marker
+        prefix, lister = self.current
+        return composite_marker(SHARDS, prefix, lister.marker)
+
+    def __iter__(self):
+        """
+        :return: generator of listing items, in the order of the bucket
+        :except ConnectionError: a page could not be listed
+        """
+        if self.resume is not None and self.resume[0] is None:
+            return self._single_chain(self.resume[1])
+        found = self._discover()
+        if found is None:
+            return self._single_chain(None)
+        items, self.prefixes = found
+        start = None
+        if self.resume is not None and self.resume[0] in self.prefixes:
+            start = self.resume[0]
+            # the keys before the shard were handled before the checkpoint
+            items = [item for item in items if item['key'] >= start]
+        items.sort(key=itemgetter('key'))
+        return heapq.merge(items, self._shard_items(start),
+                           key=itemgetter('key'))
+
+    def _single_chain(self, marker):
+        lister = self._lister(self.prefix or None, BucketLister.PREFETCH,
+                              marker)
+        self.current = None, lister
+        return iter(lister)
+
+    def _discover(self):
+        """
+        :return: (items found, sorted list of the shard prefixes), or None
+                 if the top level of the bucket is too big
+        """
+        wanted = self.shards * self.SHARDS_PER_LISTER
+        found = self._probe(self.prefix, self.MAX_PROBES)
+        if found is None:
+            return None
+        items, level = found
+        leaves = []
+        # the prefixes of a level are probed at the same time
+        with ThreadPoolExecutor(self.shards) as pool:
+            while level and len(leaves) + len(level) < wanted and \
+                    self.probes + len(level) <= self.MAX_PROBES:
+                deeper = []
+                for prefix, found in zip(level, pool.map(
+                        lambda prefix: self._probe(prefix, 1), level)):
+                    if found is None:  # more than a page, a shard
+                        leaves.append(prefix)
+                    else:
+                        items.extend(found[0])
+                        deeper.extend(found[1])
+                level = deeper
+        return items, sorted(leaves + level)
+
+    def _probe(self, prefix, max_pages):
+        """
+        :return: (items, common prefixes) of the delimiter listing of
+                 prefix, None if it takes more than max_pages pages
+        """
+        items, prefixes = [], []
+        marker = None
+        for _ in range(max_pages):
+            res, done = self.retry.call('listing ' + self.bucketname,
+                                        self._probe_page, prefix, marker)
+            items.extend(res.get('items', []))
+            prefixes.extend(res.get('commonPrefixes', []))
+            if done:
+                return items, prefixes
+            marker = res.get('marker')
+        return None
+
+    def _probe_page(self, prefix, marker):
+        with self.tracer.span('list_prefixes', 'listing',
+                              prefix=prefix) as span:
+            res, done, info = self.bucket.list(
+                self.bucketname, prefix=prefix or None, marker=marker,
+                limit=BucketLister.MAX_LIMIT, delimiter='/')
+            span['done'] = done
+        if not res:
+            raise HTTPStatusError(
+                info.status_code if info is not None else -1,
+                'could not establish connection with cloud')
+        with self.lock:
+            self.probes += 1
+        return res, done
+
+    def _shard_items(self, start=None):
+        """
+        :param start: prefix of the shard to resume from, None for all
+        """
+        prefixes = self.prefixes
+        if start is not None:
+            prefixes = prefixes[prefixes.index(start):]
+        listers = [self._lister(prefix, self.SHARD_PREFETCH,
+                                self.resume[1] if prefix == start else None)
+                   for prefix in prefixes]
+        try:
+            for index, lister in enumerate(listers):
+                for ahead in listers[index:index + self.shards]:
+                    ahead.start()
+                for item in lister:
+                    yield item
+                    # only now is the caller done with the shard before,
+                    # the merge may have yielded other keys in between
+                    if self.current is None or self.current[1] is not lister:
+                        self.current = prefixes[index], lister
+        finally:
+            for lister in listers:
+                lister.stop()
+
+    def _lister(self, prefix, prefetch, marker=None):
+        lister = BucketLister(self.auth, self.bucketname, limit=self.limit,
+                              prefix=prefix, marker=marker, retry=self.retry,
+                              tracer=self.tracer, prefetch=prefetch)
+        self.listers.append(lister)
+        return lister
+
+
+class FilteredLister:
+    """
+    lists several prefixes of the bucket one after the other, and yields
+    the items whose key the filter keeps. The prefixes are sorted and none
+    is a prefix of another, so their key ranges are disjoint and in order,
+    and so are the items.
+
+    With several prefixes, the marker is the prefix being listed and the
+    marker of its lister.
+    """
+
+    def __init__(self, listers, key_filter, prefixes=None, start=0):
+        """
+        :param listers: a lister per prefix, in the order of the prefixes
+        :param key_filter: KeyFilter of the bucket
+        :param prefixes: the prefixes, needed by the marker of several
+        :param start: index of the lister to resume from, the ones before
+                      it are not listed
+        """
+        self.listers = listers
+        self.key_filter = key_filter
+        self.prefixes = prefixes
+        self.current = start
+
+    @staticmethod
+    def resume_position(marker, prefixes):
+        """
+        :param marker: marker of a FilteredLister of prefixes
+        :return: (index of the prefix to resume from, marker within it),
+                 (0, None) to start over
+        """
+        position = split_marker(marker, PREFIXES)
+        if position is None or position[0] not in prefixes:
+            return 0, None
+        return prefixes.index(position[0]), position[1]
+
+    @property
+    def marker(self):
+        lister = self.listers[self.current]
+        if len(self.listers) == 1:
+            return lister.marker
+        return composite_marker(PREFIXES, self.prefixes[self.current],
+                                lister.marker)
+
+    @property
+    def pages_listed(self):
+        return sum(lister.pages_listed for lister in self.listers)
+
+    def __iter__(self):
+        """
+        :return: generator of the listing items kept, in key order
+        :except ConnectionError: a page could not be listed
+        """
+        wants_key = self.key_filter.wants_key
+        for index in range(self.current, len(self.listers)):
+            # the caller is done with the prefixes before
+            self.current = index
+            for item in self.listers[index]:
+                if wants_key(item['key']):
+                    yield item
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Persistent per-bucket sync manifest.
+
+The manifest remembers, for every key, what the bucket listing said about it
+(fsize, putTime, hash) and what the local copy looked like after the last
+successful transfer (mtime, size). A later run can therefore skip every key
+whose remote and local entries have not changed without comparing them again.
+
+The manifest is a SQLite database. Writes are grouped into transactions of
+BATCH_SIZE statements, so recording tens of thousands of keys costs a handful
+of disk syncs instead of one per key.
+
+It also holds the checkpoint of the current run: the listing marker past
+which nothing has been looked at yet, and the keys whose transfer was
+started but has not succeeded. A run that is killed is resumed from there
+by the next one.
+"""
+
+import sqlite3
+import threading
+from collections import namedtuple
+from pathlib import Path
+
+Entry = namedtuple('Entry', ['key', 'fsize', 'put_time', 'hash',
+                             'local_mtime', 'local_size', 'seen'])
+
+
+class SyncManifest:
+    BATCH_SIZE = 500
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS files (
+        key         TEXT PRIMARY KEY,
+        fsize       INTEGER,
+        put_time    INTEGER,
+        hash        TEXT,
+        local_mtime REAL,
+        local_size  INTEGER,
+        seen        INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+    CREATE TABLE IF NOT EXISTS meta (
+        name  TEXT PRIMARY KEY,
+        value TEXT
+    );
+    CREATE TABLE IF NOT EXISTS pending (
+        key   TEXT PRIMARY KEY,
+        fsize INTEGER,
+        hash  TEXT,
+        state TEXT
+    );
+    """
+    # states of the pending keys
+    DOWNLOADING = 'download'
+    FAILED = 'failed'
+    EDITED = 'upload'  # edited locally, to be uploaded at the end of the run
+
+    def __init__(self, path):
+        """
+        :param path: location of the database file, created if necessary
+        """
+        self.path = Path(path)
+        if not self.path.parent.exists():
+            self.path.parent.mkdir(parents=True)
+        self.db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(self.SCHEMA)
+        self.db.commit()
+
+        self.lock = threading.Lock()  # shared by the download workers
+        self.pending = 0
+        self.run = int(self.get_meta('run', 0))
+
+    @staticmethod
+    def path_for(directory, bucketname):
+        return Path(directory) / (bucketname + '.sqlite')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+    def begin_run(self):
+        """
+        start a new run, entries listed during this run are marked with the
+        returned run number
+        :return: the run number
+        """
+        self.run += 1
+        self.set_meta('run', self.run)
+        self.set_meta('state', 'running')
+        self.set_meta('marker', '')
+        self._write('DELETE FROM pending', ())
+        self.commit()
+        return self.run
+
+    def interrupted(self):
+        """
+        :return: True if the last run was stopped before end_run
+        """
+        return self.get_meta('state') == 'running'
+
+    def resume_run(self):
+        """
+        carry on with the interrupted run, under the same run number
+        :return: the listing marker of the last checkpoint, None to list
+                 from the start
+        """
+        return self.get_meta('marker') or None
+
+    def checkpoint(self, marker):
+        """
+        commit everything recorded so far, with the marker of the listing
+        page after which nothing has been recorded yet
+        """
+        self.set_meta('marker', marker or '')
+        self.commit()
+
+    def end_run(self):
+        self.set_meta('state', 'done')
+        self.set_meta('marker', '')
+        self.commit()
+
+    def set_pending(self, key, state, fsize=None, hash=None):
+        """
+        remember that the transfer of key has started (DOWNLOADING), has
+        failed (FAILED) or is still to be made (EDITED)
+        """
+        self._write('INSERT INTO pending (key, fsize, hash, state) '
+                    'VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT(key) DO UPDATE SET state = excluded.state, '
+                    'fsize = COALESCE(excluded.fsize, fsize), '
+                    'hash = COALESCE(excluded.hash, hash)',
+                    (key, fsize, hash, state))
+
+    def clear_pending(self, key):
+        self._write('DELETE FROM pending WHERE key = ?', (key,))
+
+    def pending_keys(self):
+        """
+        :return: list of the (key, fsize, hash, state) not done yet
+        """
+        with self.lock:
+            return self.db.execute('SELECT key, fsize, hash, state '
+                                   'FROM pending ORDER BY key').fetchall()
+
+    def get(self, key):
+        """
+        :return: the Entry for key or None
+        """
+        with self.lock:
+            row = self.db.execute(
+                'SELECT key, fsize, put_time, hash, local_mtime, local_size, '
+                'seen FROM files WHERE key = ?', (key,)).fetchone()
+        return Entry(*row) if row else None
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def by_hash(self, hash):
+        """
+        :return: list of the Entries of the keys in the bucket with content
+                 hash, in key order
+        """
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT key, fsize, put_time, hash, local_mtime, local_size, '
+                'seen FROM files WHERE hash = ? AND fsize IS NOT NULL '
+                'ORDER BY key', (hash,)).fetchall()
+        return [Entry(*row) for row in rows]
+
+    def listed(self, key):
+        """
+        :return: True if key has been seen in the listing of the current run
+        """
+        entry = self.get(key)
+        return entry is not None and entry.seen == self.run
+
+    def record_remote(self, key, fsize, put_time, hash):
+        """
+        remember the listing entry of a key. The local side is kept as long
+        as the remote object has not changed, and forgotten otherwise.
+        """
+        self._write(
+            'INSERT INTO files (key, fsize, put_time, hash, seen) '
+            'VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET '
+            'local_mtime = CASE WHEN fsize = excluded.fsize '
+            'AND hash IS excluded.hash THEN local_mtime END, '
+            'local_size = CASE WHEN fsize = excluded.fsize '
+            'AND hash IS excluded.hash THEN local_size END, '
+            'fsize = excluded.fsize, put_time = excluded.put_time, '
+            'hash = excluded.hash, seen = excluded.seen',
+            (key, fsize, put_time, hash, self.run))
+
+    def record_local(self, key, mtime, size):
+        """
+        remember the state of the local copy after a successful transfer
+        """
+        self._write(
+            'INSERT INTO files (key, local_mtime, local_size) '
+            'VALUES (?, ?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET '
+            'local_mtime = excluded.local_mtime, '
+            'local_size = excluded.local_size',
+            (key, mtime, size))
+
+    def forget(self, key):
+        """
+        drop a key that is no longer in the bucket (moved away)
+        """
+        self._write('DELETE FROM files WHERE key = ?', (key,))
+
+    def forget_unseen(self):
+        """
+        drop the keys that were not listed in the current run (deleted
+        remotely). Only call this after a complete listing.
+        """
+        self._write('DELETE FROM files WHERE seen != ?', (self.run,))
+        self.commit()
+
+    def __iter__(self):
+        """
+        :return: generator of every Entry, in key order
+        """
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT key, fsize, put_time, hash, local_mtime, local_size, '
+                'seen FROM files ORDER BY key').fetchall()
+        return (Entry(*row) for row in rows)
+
+    def get_meta(self, name, default=None):
+        with self.lock:
+            row = self.db.execute('SELECT value FROM meta WHERE name = ?',
+                                  (name,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, name, value):
+        self._write('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)',
+                    (name, str(value)))
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def _write(self, statement, args):
+        with self.lock:
+            self.db.execute(statement, args)
+            self.pending += 1
+            if self.pending >= self.BATCH_SIZE:
+                self.db.commit()
+                self.pending = 0
+
+    @staticmethod
+    def unchanged(entry, item):
+        """
+        :param entry: Entry recorded in the manifest, or None
+        :param item: listing item of the current run
+        :return: True if the remote object has the content recorded in entry
+                 and it was fully transferred to the local folder. putTime
+                 is not compared, a re-upload of the same content is no change
+        """
+        return entry is not None \
+            and entry.fsize == item['fsize'] \
+            and entry.hash == item.get('hash') \
+            and entry.local_size == item['fsize']
+
+    @staticmethod
+    def local_unchanged(entry, stat):
+        """
+        :param entry: Entry recorded in the manifest, or None
+        :param stat: os.stat_result of the local file
+        :return: True if the local file looks as it did after the last
+                 transfer
+        """
+        return entry is not None \
+            and entry.local_size == stat.st_size \
+            and entry.local_mtime == stat.st_mtime
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Structured metrics of a synch run.
+
+`RunMetrics` times the phases of a run and counts the objects and bytes that
+were downloaded, uploaded, skipped or reused (copied from a local file with
+the same content instead of downloaded), and the new keys copied or moved
+within the bucket instead of uploaded. Phases are exclusive: while a nested
+phase runs (say a listing page is fetched in the middle of the diff), the
+outer one is paused, so the phase times of a thread add up to its wall time.
+The transfers running on worker threads add up their own time, so the
+download and upload phases may be longer than the run itself.
+
+At the end of the run the metrics are written as `<bucket>.json` and as
+`<bucket>.prom`, in the text format of the Prometheus node_exporter textfile
+collector.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from qbackup.tracing import NULL_TRACER
+
+PHASES = ('validate', 'scan', 'hash', 'relocate', 'listing', 'diff', 'download',
+          'upload')
+DIRECTIONS = ('downloaded', 'uploaded', 'skipped', 'reused', 'copied', 'moved')
+
+
+class RunMetrics:
+    def __init__(self, bucket, directory=None, retry=None, tracer=None):
+        """
+        :param bucket: name of the synched bucket
+        :param directory: where the metric files go, None not to write them
+        :param retry: RetryPolicy whose counters are reported
+        :param tracer: Tracer the phases are recorded in as spans
+        """
+        self.bucket = bucket
+        self.directory = Path(directory) if directory else None
+        self.retry = retry
+        self.tracer = tracer if tracer is not None else NULL_TRACER
+        self.phases = {phase: 0.0 for phase in PHASES}
+        self.counters = {}
+        for direction in DIRECTIONS:
+            self.counters[direction] = 0
+            self.counters[direction + '_bytes'] = 0
+        self.pages_listed = 0
+        self.started = None
+        self.elapsed = 0.0
+        self.success = None
+        self.lock = threading.Lock()
+        self._local = threading.local()
+
+    def count(self, direction, nbytes):
+        """
+        count one object moved (or skipped) in direction
+        """
+        with self.lock:
+            self.counters[direction] += 1
+            self.counters[direction + '_bytes'] += nbytes
+
+    @contextmanager
+    def phase(self, name, trace=True):
+        """
+        add the time spent in the with block to the phase `name`
+        :param trace: also record the phase as a span of the trace
+        """
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        now = time.monotonic()
+        if stack:  # pause the enclosing phase
+            self.add(stack[-1][0], now - stack[-1][1])
+        stack.append([name, now])
+        try:
+            if trace:
+                with self.tracer.span(name, 'phase'):
+                    yield
+            else:
+                yield
+        finally:
+            now = time.monotonic()
+            name, start = stack.pop()
+            self.add(name, now - start)
+            if stack:
+                stack[-1][1] = now
+
+    def timed(self, name, iterable):
+        """
+        :return: generator over iterable, the time spent waiting for each
+                 item is added to the phase `name`
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name, trace=False):  # a span per item is too many
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add(self, name, seconds):
+        """
+        add seconds to the phase `name`
+        """
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextmanager
+    def run(self):
+        """
+        time the whole run, and write the metric files when it ends,
+        successfully or not
+        """
+        self.started = time.time()
+        start = time.monotonic()
+        self.success = False
+        try:
+            yield self
+            self.success = True
+        finally:
+            self.elapsed = time.monotonic() - start
+            if self.directory is not None:
+                self.write()
+
+    def to_dict(self):
+        transferred = self.counters['downloaded_bytes'] \
+            + self.counters['uploaded_bytes']
+        return {
+            'bucket': self.bucket,
+            'started': self.started,
+            'elapsed': self.elapsed,
+            'success': self.success,
+            'phases': dict(self.phases),
+            'counters': dict(self.counters),
+            'pages_listed': self.pages_listed,
+            'bytes_per_second':
+                transferred / self.elapsed if self.elapsed else 0.0,
+            'retry': self.retry.stats() if self.retry is not None else {},
+        }
+
+    def write(self):
+        """
+        write <bucket>.json and <bucket>.prom into the metrics directory
+        """
+        if not self.directory.exists():
+            self.directory.mkdir(parents=True)
+        metrics = self.to_dict()
+        self._write_atomic(self.directory / (self.bucket + '.json'),
+                           json.dumps(metrics, indent=2, sort_keys=True))
+        self._write_atomic(self.directory / (self.bucket + '.prom'),
+                           self.prometheus(metrics))
+
+    @staticmethod
+    def prometheus(metrics):
+        """
+        :param metrics: dict returned by to_dict
+        :return: the metrics in the Prometheus text exposition format
+        """
+        bucket = 'bucket="{0}"'.format(
+            metrics['bucket'].replace('\\', '\\\\').replace('"', '\\"'))
+        lines = []
+
+        def gauge(name, help, samples):
+            lines.append('# HELP qbackup_{0} {1}'.format(name, help))
+            lines.append('# TYPE qbackup_{0} gauge'.format(name))
+            for labels, value in samples:
+                lines.append('qbackup_{0}{{{1}}} {2}'.format(
+                    name, ','.join((bucket,) + labels), value))
+
+        gauge('run_success', 'whether the last run succeeded',
+              [((), int(bool(metrics['success'])))])
+        gauge('run_timestamp_seconds', 'start time of the last run',
+              [((), metrics['started'])])
+        gauge('run_seconds', 'duration of the last run',
+              [((), metrics['elapsed'])])
+        gauge('phase_seconds', 'time spent in each phase of the last run',
+              [(('phase="{0}"'.format(phase),), seconds)
+               for phase, seconds in sorted(metrics['phases'].items())])
+        gauge('objects', 'objects transferred, skipped or reused by the last run',
+              [(('direction="{0}"'.format(direction),),
+                metrics['counters'][direction])
+               for direction in DIRECTIONS])
+        gauge('bytes', 'bytes transferred, skipped or reused by the last run',
+              [(('direction="{0}"'.format(direction),),
+                metrics['counters'][direction + '_bytes'])
+               for direction in DIRECTIONS])
+        gauge('bytes_per_second', 'transfer throughput of the last run',
+              [((), metrics['bytes_per_second'])])
+        gauge('pages_listed', 'listing pages fetched by the last run',
+              [((), metrics['pages_listed'])])
+        retry = metrics['retry']
+        if retry:
+            gauge('retries', 'failed attempts that were tried again',
+                  [((), retry['retries'])])
+            gauge('retries_given_up', 'requests that ran out of attempts',
+                  [((), retry['given_up'])])
+            gauge('backoff_seconds', 'time spent waiting between attempts',
+                  [((), retry['backoff'])])
+            gauge('breaker_trips', 'times the circuit breaker opened',
+                  [((), retry['breaker_trips'])])
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _write_atomic(path, text):
+        # the textfile collector may read the file at any time
+        temp = path.with_name(path.name + '.tmp')
+        with open(str(temp), 'w') as file:
+            file.write(text)
+        os.replace(str(temp), str(path))
@@ -4,63 +4,240 @@ from __future__ import absolute_import
 
 __author__ = 'nykh'
 
+import atexit
 import pathlib
 import os
-import sys
 import mimetypes
 import datetime
+import json
+import queue
+import shutil
+import sys
+import threading
 import time
 
 import qiniu
-from qiniu import BucketManager
-import progressbar
 import requests as req
 
+from qbackup import diff
+from qbackup.filters import KeyFilter
+from qbackup.governor import TransferBudget
+from qbackup.hashcache import HashCache
+from qbackup.listing import BucketLister, FilteredLister, ShardedLister
+from qbackup.metrics import RunMetrics
+from qbackup.qetag import QEtag
+from qbackup.resumable import BlockUploader
+from qbackup.retry import HTTPStatusError, RetryPolicy
+from qbackup.scheduler import ORDERS, TransferScheduler
+from qbackup.tracing import Tracer
+from qbackup.workers import WorkerPool
+
+
+class SynchError(Exception):
+    """
+    the synchronization of a bucket cannot go on. Raised instead of exiting
+    the program so that the other buckets of the run are not affected.
+    """
+
+
 class QiniuBackup:
     BATCH_LIMIT = 100  # maybe optimized under real condition
+    QUEUE_LIMIT = 1000  # maximum number of downloads waiting for a worker
     CHUNK_SIZE = 1024 * 1024
-
-    def __init__(self, options, auth, logger=None):
+    PART_SUFFIX = '.qbackup.part'  # downloads in progress
+    HASH_CACHE_DIR = 'manifest/hashes'
+    UPLOAD_STATE_DIR = 'manifest/uploads'
+    METRICS_DIR = 'manifest/metrics'
+    DURABILITY = ('chunk', 'rename', 'none')
+    REUSE_LOCAL = ('copy', 'link', 'off')
+
+    def __init__(self, options, auth, logger=None, budget=None, retry=None):
         self.bucketname = options['bucketname']
         self.bucketurl = options['bucketurl']
         self.localdir = pathlib.Path(options['localdir'])
 
+        self.list_limit = options.get('list_limit', self.BATCH_LIMIT)
+        # number of prefixes of the bucket listed at the same time
+        self.list_shards = options.get('list_shards', 1)
+        # include/exclude rules, the rest of the bucket is left alone
+        self.filter = KeyFilter.from_options(options)
+
         self.verbose = options.get('verbose', False)
         self.log = options.get('log', False)
 
+        self.chunk_size = options.get('chunk_size', self.CHUNK_SIZE // 1024)\
+                          * 1024
         self.download_size_threshold = options.get('size_threshold', 1024)\
                                        * 1024
-        if self.download_size_threshold < self.CHUNK_SIZE * 2:
-            self.download_size_threshold = self.CHUNK_SIZE * 2
+        self.download_workers = options.get('download_workers', 1)
+        if self.download_size_threshold < self.chunk_size * 2:
+            self.download_size_threshold = self.chunk_size * 2
+        # order in which the download workers take the queued files, and
+        # at most `large_workers` of them on files of `large_file_threshold`
+        # (KB) or more, see qbackup.scheduler
+        self.transfer_order = options.get('transfer_order', 'listing')
+        if self.transfer_order not in ORDERS:
+            raise ValueError('transfer_order must be one of '
+                             + ', '.join(ORDERS))
+        self.priority_prefixes = options.get('priority_prefixes', [])
+        self.large_file_threshold = options.get(
+            'large_file_threshold', TransferScheduler.LARGE_THRESHOLD) * 1024
+        self.large_workers = options.get('large_workers', None)
+
+        # when to fsync downloaded data: after every chunk, once before the
+        # file is renamed into place, or never (leave it to the OS)
+        self.durability = options.get('durability', 'rename')
+        if self.durability not in self.DURABILITY:
+            raise ValueError('durability must be one of '
+                             + ', '.join(self.DURABILITY))
+
+        # local qetags are cached by stat signature, in a file of each bucket
+        # by default, hashing runs on `hash_workers` processes (all CPUs by
+        # default)
+        self.hash_cache = options.get('hash_cache') or HashCache.path_for(
+            self.HASH_CACHE_DIR, self.bucketname)
+        self.hash_workers = options.get('hash_workers', None)
+        # a download whose content is already in a local file is copied (or
+        # hard-linked) from it instead
+        self.reuse_local = options.get('reuse_local', 'copy')
+        if self.reuse_local not in self.REUSE_LOCAL:
+            raise ValueError('reuse_local must be one of '
+                             + ', '.join(self.REUSE_LOCAL))
+
+        # files bigger than `parallel_upload_threshold` (KB) are uploaded by
+        # blocks, `upload_workers` blocks at a time
+        self.upload_workers = options.get('upload_workers', 1)
+        self.parallel_upload_threshold = \
+            options.get('parallel_upload_threshold', 16 * 1024) * 1024
+        self.upload_state_dir = options.get('upload_state_dir',
+                                            self.UPLOAD_STATE_DIR)
 
         if logger is None:
-            self.logger = EventLogger(verbose=self.verbose,
-                                      log_to_file=self.log)
+            self.logger = EventLogger.from_options(options)
         else:
             self.logger = logger
 
         self.auth = auth
+        # limits on concurrent transfers and bandwidth, possibly shared with
+        # the other buckets of the run
+        self.budget = budget if budget is not None else TransferBudget()
+        # retries of listing, downloads and uploads, possibly shared with the
+        # other buckets of the run as well
+        self.retry = retry if retry is not None \
+            else RetryPolicy.from_options(options, self.logger)
+        # opt-in Chrome trace of the transfers, written to `trace_dir`
+        self.tracer = Tracer.for_bucket(options.get('trace_dir', None),
+                                        self.bucketname)
+        # phase timings and transfer counters, written at the end of synch
+        # to `metrics_dir` as json and as a Prometheus textfile
+        self.metrics = RunMetrics(self.bucketname,
+                                  options.get('metrics_dir', self.METRICS_DIR),
+                                  self.retry, self.tracer)
+        self.counters = self.metrics.counters
+        self.failed = 0
+        self.lock = threading.Lock()
+        # local directories known to exist, each is made once per run
+        self.directories = set()
 
     def synch(self):
         """
-        the main synchroization logic happens here
+        the main synchroization logic happens here. The bucket listing and a
+        scan of the local folder, both in key order, are merge-joined and
+        every transfer starts as soon as it is decided.
         :return:None
         """
         self.logger('INFO', 'Begin synching ' + str(self.localdir)
                     + ' <=> Bucket ' + self.bucketname)
 
-        self.validate_local_folder()
+        with self.tracer, self.metrics.run():
+            with self.metrics.phase('validate'):
+                self.validate_local_folder()
+            self._synch_streams()
+        self.logger('INFO', "Bucket and local folder are synched!")
+
+    def _synch_streams(self):
+        """
+        With `download_workers` > 1 the downloads and the uploads are queued
+        to a pool of workers while the merge goes on, and the scheduler
+        decides their order.
+        """
+        self.failed = 0
+        self.directories = set()
+        with HashCache(self.hash_cache, self.hash_workers, self.tracer,
+                       self.logger) as hashes:
+            # hash the local files missing from the cache on every core
+            # first, the merge below then only hits the cache
+            with self.metrics.phase('hash'):
+                hashes.warm(entry for entry in self._scan_local()
+                            if self.filter.wants_stat(entry[2]))
+            pool = None
+            if self.download_workers > 1:
+                pool = WorkerPool(self._transfer, self.download_workers,
+                                  self.QUEUE_LIMIT, self.logger,
+                                  self._scheduler())
+            lister = self._remote_listing()
+            actions = diff.diff(self.metrics.timed('listing', lister),
+                                self.metrics.timed('scan', self._scan_local()),
+                                hashes.hash_file,
+                                self.filter.wants_copies
+                                if self.filter.active else None,
+                                hashes.synched)
+            try:
+                for action, key, item, entry in self.metrics.timed('diff',
+                                                                   actions):
+                    if action == diff.SKIP:
+                        self._count('skipped', item['fsize'])
+                        self._remember_synched(hashes, entry[1],
+                                               item.get('hash'))
+                    elif action == diff.CONFLICT:
+                        self._conflict(key, item)
+                    elif pool and action == diff.DOWNLOAD:
+                        pool.submit(action, key, item, hashes, key=key,
+                                    size=item['fsize'],
+                                    put_time=item['putTime'])
+                    elif pool and action == diff.UPLOAD:
+                        stat = entry[2]
+                        pool.submit(action, key, item, hashes, key=key,
+                                    size=stat.st_size,
+                                    put_time=int(stat.st_mtime * 1e7))
+                    else:
+                        self._transfer(action, key, item, hashes)
+            except ConnectionError:
+                self.logger('ERROR',
+                            'could not establish connection with cloud. Exit.')
+                raise SynchError('could not list bucket ' + self.bucketname)
+            finally:
+                if pool:
+                    pool.join()
+                    self.failed += pool.failed
+                self.metrics.pages_listed = lister.pages_listed
 
-        local_timestamp = self._list_local_files()
-        remote_timstamp, big = self._list_remote_bucket()
+        if self.failed:
+            raise SynchError(str(self.failed) + ' transfers failed')
 
-        download_file_list, upload_file_list = \
-            QiniuBackup._compare_local_and_remote(remote_timstamp,
-                                                  local_timestamp)
-        self._batch_download(download_file_list, big)
-        self._batch_upload(upload_file_list)
+    def _scheduler(self):
+        """
+        :return: a new TransferScheduler for the download workers
+        """
+        return TransferScheduler(self.QUEUE_LIMIT, self.download_workers,
+                                 self.large_file_threshold,
+                                 self.large_workers, self.transfer_order,
+                                 self.priority_prefixes, self.logger)
 
-        self.logger('INFO', "Bucket and local folder are synched!")
+    def _transfer(self, action, key, item, hashes):
+        """
+        download or upload a key, a failure is logged and counted. Local
+        errors (disk full, permission denied) fail the key, not the run.
+        """
+        try:
+            if action == diff.DOWNLOAD:
+                self._download_one(key, item, hashes)
+            else:
+                self._upload_one(key, hashes)
+        except OSError as e:  # ConnectionError included
+            self.logger('ERROR', action + ' of ' + key + ' failed: ' + str(e))
+            with self.lock:
+                self.failed += 1
 
     def validate_local_folder(self):
         if not self.localdir.exists():
@@ -73,128 +250,101 @@ class QiniuBackup:
                         self.localdir.mkdir()
                     except PermissionError:
                         self.logger('ERR', 'unable to create folder. Exit now.')
-                        sys.exit(1)
+                        raise SynchError('unable to create folder '
+                                         + str(self.localdir))
                     self.logger('INFO', 'folder created!')
                     break
                 elif ans in ('n' or 'no'):
                     self.logger('INFO', 'user chooses not to create folder '
                                 + str(self.localdir) + '. Skip this backup.')
-                    sys.exit(1)
+                    raise SynchError('folder ' + str(self.localdir)
+                                     + ' does not exist')
                 else:
                     print('Pease answer explicitly, y(es) or n(o).')
 
         elif not self.localdir.is_dir():
             self.logger('ERR', str(self.localdir) + ' is not a directory')
-            sys.exit(1)
+            raise SynchError(str(self.localdir) + ' is not a directory')
         elif not os.access(str(self.localdir), mode=os.W_OK | os.X_OK):
             self.logger('ERR', str(self.localdir) + ' is not writable')
-            sys.exit(1)
+            raise SynchError(str(self.localdir) + ' is not writable')
 
-    def _list_remote_bucket(self):
+    def _remote_listing(self, marker=None):
         """
-        traverse the buckt through the Qiniu API and return a list of keys
-        and timestamp
-        :except no connection is established
-        :return: a dict mapping key to upload time
+        :param marker: resume the listing from this marker
+        :return: a BucketLister that yields the items of the bucket in key
+                 order, prefetching the next page in the background, or a
+                 ShardedLister with `list_shards` > 1. With include/exclude
+                 rules, a FilteredLister of the prefixes they allow.
         """
-        key_list = {}
-        big_file = {}
-        done = False
-        marker = None
-
-        bucket = BucketManager(self.auth)
+        if not self.filter.active:
+            return self._prefix_listing(None, marker)
+        prefixes = self.filter.prefixes()
+        if len(prefixes) == 1:
+            return FilteredLister([self._prefix_listing(prefixes[0] or None,
+                                                        marker)], self.filter)
+        start, marker = FilteredLister.resume_position(marker, prefixes)
+        return FilteredLister(
+            [self._prefix_listing(prefix or None,
+                                  marker if index == start else None)
+             for index, prefix in enumerate(prefixes)],
+            self.filter, prefixes, start)
+
+    def _prefix_listing(self, prefix, marker):
+        if self.list_shards > 1:
+            return ShardedLister(self.auth, self.bucketname,
+                                 shards=self.list_shards,
+                                 limit=self.list_limit, retry=self.retry,
+                                 tracer=self.tracer, prefix=prefix,
+                                 marker=marker)
+        return BucketLister(self.auth, self.bucketname, limit=self.list_limit,
+                            prefix=prefix, marker=marker, retry=self.retry,
+                            tracer=self.tracer)
+
+    def _local_path(self, key):
+        """
+        :return: pathlib.Path of the local copy of key
+        """
+        return self.localdir / QiniuBackup.__encode_spec_character(key)
 
-        while not done:
-            res, done, _ = bucket.list(self.bucketname, marker=marker,
-                                       limit=self.BATCH_LIMIT)
-            if not res:
-                self.logger('ERROR',
-                            'could not establish connection with cloud. Exit.')
-                sys.exit(1)
-            marker = res.get('marker')
-            for resource in res['items']:
-                key_list[resource['key']] = resource['putTime']
-                big_file[resource['key']] = resource['fsize'] \
-                    if resource['fsize'] > self.download_size_threshold * 2 \
-                    else 0
-        return key_list, big_file
-
-    def _list_local_files(self):
-        """
-        :return:a dict mapping filename to last modified time (ST_MTIME)
-        """
-        local_filename_and_mtime = {}
-        for path, _, files in os.walk(str(self.localdir)):
-            for file in files:
-                fullpath = pathlib.Path(path, file)
-                keypath = self.__decode_spec_characters(
-                    fullpath.relative_to(self.localdir))
-                # strip the basepath from fullpath, such that filename == key
-                # drop any @/
-                mtime = fullpath.stat().st_mtime
-                local_filename_and_mtime[keypath] = mtime
-        return local_filename_and_mtime
+    def _scan_local(self):
+        """
+        :return: generator of (key, path, stat) for every local file,
+                 in key order
+        """
+        return diff.scan_sorted(self.localdir,
+                                QiniuBackup.__decode_spec_characters,
+                                self.PART_SUFFIX, self.filter)
 
     @staticmethod
     def __encode_spec_character(key):
         """
-        translate key to local file path
-        ^/ -> ^@/
+        translate key to local file path, segment by segment (the parts of
+        the key between slashes)
         @ -> @@
-        // -> /@/
+        empty segment -> @  (^/ -> @/, // -> /@/, /$ -> /@)
+        . -> @.  and  .. -> @..  (pathlib would drop or follow them)
         :param key string
         :return local file path
         """
-        key = key.replace('@', '@@') \
-            .replace('//', '/@/') \
-            .replace('//', '/@/')
-        if key.startswith('/'):
-            key = '@' + key
-        return key
+        return '/'.join('@' + segment if segment in ('', '.', '..')
+                        else segment.replace('@', '@@')
+                        for segment in key.split('/'))
 
     @staticmethod
     def __decode_spec_characters(local_path):
         """
-        translate local file path to key string
-        to posix
-        ^@/ -> ^/
-        @@ -> @
-        /@/ -> //
-        :param local_path
+        translate local file path to key string, the inverse of
+        __encode_spec_character
+        :param local_path: relative path, or a string in posix form. A
+                           trailing slash (a directory) is kept.
         :return: key string
         """
-        pathname = local_path.as_posix()
-        return pathname.replace('@/', '/').replace('@@', '@')
-
-    @staticmethod
-    def _compare_local_and_remote(remote_key_and_ts, local_filename_and_mtime):
-        """
-        Compare the local files and remote list of items,
-        produce a tuple of two lists, one lists files on remote
-        not in local drive (to be downloaded), the other lists files
-        that exist on the local drive but not on remote (to be uploaded).
-        :param local_filename_and_mtime: output of `list_remote_files` function
-        :param remote_key_and_ts: output of the `list_local_flles` function
-        :rtype: object
-        :return: ([files to be downloaded], [files to be uploaded])
-        """
-        download = []
-        upload = []
-
-        remote_files = set(remote_key_and_ts)
-        local_files = set(local_filename_and_mtime)
-
-        both = local_files.intersection(remote_files)
-
-        download.extend(remote_files.difference(both))
-        upload.extend(local_files.difference(both))
-        for key in both:
-            cmp = QiniuBackup.compare_timestamp(remote_key_and_ts[key],
-                                                local_filename_and_mtime[key])
-            if cmp > 0:  # remote is later than local
-                download.append(key)
-
-        return download, upload
+        pathname = local_path if isinstance(local_path, str) \
+            else local_path.as_posix()
+        return '/'.join(segment[1:] if segment in ('@', '@.', '@..')
+                        else segment.replace('@@', '@')
+                        for segment in pathname.split('/'))
 
     @staticmethod
     def compare_timestamp(remote, local):
@@ -217,79 +367,265 @@ class QiniuBackup:
         else:
             return 0
 
-    def _batch_download(self, keylist, big_file_list=None):
+    def _download_one(self, key, item, hashes=None):
         """
-        side-effect: batch download list of resources from qiniu bucket
-        :except: raises exception if any of the request return an error
-        :param keylist: list of keys for downloading
-        :return None
+        download a key to its local path, creating the directories needed
+        :param key: remote key
+        :param item: listing item of the key
+        :param hashes: HashCache used to find the content locally
         """
-        if not keylist:
+        path = self._local_path(key)
+        self._make_parent(path)
+        if self._reuse_local(hashes, key, path, item['fsize'],
+                             item.get('hash')):
             return
+        with self.metrics.phase('download'):
+            self.retry.call('download of ' + key, self._download_resumable,
+                            key, path, item['fsize'], item.get('hash'))
+        self._remember_content(hashes, path, item.get('hash'))
 
-        for key in keylist:
-            file = QiniuBackup.__encode_spec_character(key)
-            subpath = self.localdir / file
-            parents = [str(p) for p in subpath.parents]
-            parents.sort(key=len)
-            for parent in parents[1:]:  # ignore ','
-                dirpath = self.localdir / parent
-                if not dirpath.exists():
-                    dirpath.mkdir()
-            with open(str(self.localdir / subpath), 'wb') as local_copy:
-                self._download_file(key, local_copy, big_file_list[key])
-
-    def _batch_upload(self, filelist):
-        """
-        same as batch_download but for uploadging, requires authentication
-        :param filelist: list of file names (including path) to be uploaded
-        :return:None
+    def _make_parent(self, path):
         """
-        if not filelist:
-            return
+        create the directory of path, unless this run has already made or
+        found it: a directory costs one mkdir per run, not a stat per file
+        """
+        parent = path.parent
+        if parent not in self.directories:
+            parent.mkdir(parents=True, exist_ok=True)
+            self.directories.add(parent)
 
-        token = self.auth.upload_token(self.bucketname)
-        params = {'x:a': 'a'}
+    def _reuse_local(self, hashes, key, path, size, hash):
+        """
+        copy or hard-link (see `reuse_local`) a local file that has the
+        content of key into path, instead of downloading it. This serves
+        remote renames and duplicate content from the disk.
+        :param hashes: HashCache, used as the index of the local content
+        :param key: remote key
+        :param path: pathlib.Path of the local copy of key
+        :param size: remote file size
+        :param hash: remote qetag
+        :return: True if path now has the content of key
+        """
+        if hashes is None or hash is None or self.reuse_local == 'off':
+            return False
+        source = hashes.find(hash)
+        if source is None or source.stat().st_size != size \
+                or os.path.abspath(str(path)) == str(source):
+            return False
+        part = path.with_name(path.name + self.PART_SUFFIX)
+        try:
+            if part.exists():
+                part.unlink()
+            if self.reuse_local == 'link':
+                os.link(str(source), str(part))
+            else:
+                shutil.copyfile(str(source), str(part))
+                if self.durability != 'none':
+                    with open(str(part), 'rb') as file:
+                        os.fsync(file.fileno())
+            os.replace(str(part), str(path))
+        except OSError as e:
+            self.logger('WARN', 'could not reuse ' + str(source) + ' for '
+                        + key + ' (' + str(e) + '), downloading it')
+            return False
+        self.logger('INFO', key + ' has the content of ' + str(source)
+                    + ', ' + ('linked' if self.reuse_local == 'link'
+                              else 'copied') + ' instead of downloaded')
+        self._remember_content(hashes, path, hash)
+        self._count('reused', size)
+        return True
+
+    @staticmethod
+    def _remember_content(hashes, path, hash):
+        """
+        record a file that was just written with a known qetag, so it is
+        neither hashed again nor missed by the content index
+        """
+        if hashes is not None and hash is not None:
+            hashes.store(path.stat(), hash, commit=False, path=path)
+            hashes.record_synched(path, hash)
 
-        for key in filelist:
-            filename = QiniuBackup.__encode_spec_character(key)
-            self._upload_file(token, key, filename, params)
+    @staticmethod
+    def _remember_synched(hashes, path, hash):
+        """
+        record the content both copies of a key share after a transfer, so
+        the next runs can tell which side changed
+        """
+        if hashes is not None and hash is not None:
+            hashes.record_synched(path, hash)
 
-    def _download_file(self, key, file, size=0):
+    def _conflict(self, key, item):
+        self.logger('WARNING', key + ' differs locally and remotely, and '
+                    'the remote copy may be newer: left alone. Remove the '
+                    'local file to download the remote one, or rename it '
+                    'to keep both')
+        self._count('skipped', item['fsize'])
+
+    def _upload_one(self, key, hashes=None):
+        """
+        upload the local copy of key, requires authentication
+        """
+        path = self._local_path(key)
+        filename = str(path.relative_to(self.localdir))
+        # a token scoped to the key allows overwriting an edited file
+        token = self.auth.upload_token(self.bucketname, key)
+        with self.metrics.phase('upload'):
+            ret = self.retry.call('upload of ' + key, self._upload_file,
+                                  token, key, filename, {'x:a': 'a'})
+        self._remember_synched(hashes, path, ret.get('hash'))
+
+    def _download_resumable(self, key, path, size, hash=None, resume=True):
+        """
+        download key into path. The data goes to a temporary part file next
+        to path, which is renamed into place only once it is complete, so a
+        half-written file never appears under the final name.
+
+        With `resume`, the part file left by an earlier attempt is continued:
+        the missing part is requested with an HTTP Range header. The data on
+        disk must not be longer than the remote file, and the complete file
+        must have the remote hash, otherwise it is discarded so that the next
+        attempt downloads the file from scratch.
+        :param key: remote key
+        :param path: pathlib.Path of the local file
+        :param size: remote file size
+        :param hash: remote qetag, not checked if None
+        :param resume: continue an existing part file
+        :except ConnectionError: transfer failed, the part file is kept
+        :return: None
+        """
+        with self.tracer.span('download_file', key=key, size=size):
+            part = path.with_name(path.name + self.PART_SUFFIX)
+            etag = QEtag()
+            exists = resume and part.exists()
+            offset = part.stat().st_size if exists else 0
+            if offset > size:
+                self.logger('WARN', 'local data of ' + key + ' is larger '
+                            'than the remote file, starting over')
+                offset = 0
+
+            with open(str(part), 'r+b' if exists else 'wb') as file:
+                if offset:
+                    with self.tracer.span('rehash', offset=offset):
+                        etag.update_from(file, offset)
+                file.seek(offset)
+                file.truncate()
+                if offset < size or not resume:
+                    if offset:
+                        self.logger('INFO', 'resuming ' + key + ' from byte '
+                                    + str(offset))
+                    self._download_file(key, file, size, offset, etag)
+                if self.durability != 'none':
+                    # also with 'chunk': a small download is written in one
+                    # go, never synched chunk by chunk
+                    with self.tracer.span('fsync', durability=self.durability):
+                        file.flush()
+                        os.fsync(file.fileno())
+
+            if resume and part.stat().st_size != size:
+                raise ConnectionError('incomplete download of ' + key)
+            if hash is not None and etag.hexdigest() != hash:
+                self.logger('WARN', 'hash of ' + key + ' does not match the '
+                            'remote file, discarding local data')
+                part.unlink()
+                raise ConnectionError('hash mismatch for ' + key)
+
+            with self.tracer.span('rename'):
+                os.replace(str(part), str(path))
+            self._count('downloaded', path.stat().st_size)
+
+    def _count(self, direction, nbytes):
+        self.metrics.count(direction, nbytes)
+
+    def _download_file(self, key, file, size=0, offset=0, etag=None):
+        """
+        :param key: remote key
+        :param file: binary file object, positioned at offset
+        :param size: remote file size, big files are streamed by chunks
+        :param offset: request the content from this byte on
+        :param etag: QEtag fed with the downloaded data
+        :except ConnectionError: the request failed
+        """
         self.logger('INFO', 'downloading: ' + key + ' => ' + file.name)
 
-        if size > self.download_size_threshold:
-            res = req.get(self.bucketurl + key, stream=True)
-            if res.status_code != 200:
-                self.logger('WARN',
-                            'downloading ' + key + ' failed.')
-                raise ConnectionError('Remote server returned status '
-                                      + res.status_code)
-
-            progress_bar = ProgressHandler(self.verbose)
-            progress = 0
-            total = size
-            for chunk in res.iter_content(chunk_size=self.CHUNK_SIZE):
+        headers = {'Range': 'bytes={0}-'.format(offset)} if offset else None
+        stream = size > self.download_size_threshold
+        with self.budget.transfer() as transfer:
+            try:
+                # requests connects lazily, the connection setup is part of
+                # the time to first byte
+                with self.tracer.span('ttfb', offset=offset) as span:
+                    res = req.get(self.bucketurl + key, headers=headers,
+                                  stream=stream)
+                    span['status'] = res.status_code
+                transfer.status(res.status_code)
+                if res.status_code not in (200, 206):
+                    self.logger('WARN',
+                                'downloading ' + key + ' failed.')
+                    raise HTTPStatusError(res.status_code)
+
+                if offset and (res.status_code == 200 or not res.headers.get(
+                        'Content-Range', '').startswith(
+                        'bytes {0}-'.format(offset))):
+                    # the server ignored the range, take the whole file
+                    self.logger('INFO', 'range request of ' + key
+                                + ' was ignored, downloading the whole file')
+                    if res.status_code != 200:
+                        res = req.get(self.bucketurl + key, stream=stream)
+                        transfer.status(res.status_code)
+                        if res.status_code != 200:
+                            raise HTTPStatusError(res.status_code)
+                    file.seek(0)
+                    file.truncate()
+                    offset = 0
+                    if etag is not None:
+                        etag.reset()
+
+                with self.tracer.span('body') as span:
+                    self._write_body(res, file, stream, size, offset, etag,
+                                     transfer, span,
+                                     ProgressHandler(self.logger, key))
+            except req.exceptions.RequestException as e:
+                # keep whatever has been written, the next attempt resumes it
+                self.logger('WARN', 'downloading ' + key + ' interrupted: '
+                            + str(e))
+                raise ConnectionError(str(e))
+
+    def _write_body(self, res, file, stream, size, offset, etag, transfer,
+                    span, progress):
+        """
+        write the body of a download response to file
+        :param span: args of the trace span, receive the bytes written and
+                     the time spent in fsync
+        :param progress: ProgressHandler of the download
+        """
+        fsync = 0.0
+        written = 0
+        if stream:
+            for chunk in res.iter_content(chunk_size=self.chunk_size):
                 if not chunk:
                     continue
+                transfer.consume(len(chunk))
                 file.write(chunk)
-                file.flush()
-                os.fsync(file)
-
-                progress += self.CHUNK_SIZE
-                if progress > total:
-                    progress_bar(total, total)
-                else:
-                    progress_bar(progress, total)
+                written += len(chunk)
+                if self.durability == 'chunk':
+                    start = time.perf_counter()
+                    file.flush()
+                    os.fsync(file.fileno())
+                    fsync += time.perf_counter() - start
+                if etag is not None:
+                    etag.update(chunk)
+                progress(offset + written, size)
 
         else:
-            res = req.get(self.bucketurl + key)
-            if res.status_code != 200:
-                self.logger('WARN',
-                            'downloading ' + key + ' failed.')
-                raise ConnectionError('Remote server returned status '
-                                      + res.status_code)
+            transfer.consume(len(res.content))
             file.write(res.content)
+            written = len(res.content)
+            if etag is not None:
+                etag.update(res.content)
+            progress(offset + written, size)
+        span['bytes'] = written
+        if fsync:
+            span['fsync_ms'] = fsync * 1e3
 
     def _upload_file(self, token, key, file, params):
         file_path = str(self.localdir / file)
@@ -299,19 +635,40 @@ class QiniuBackup:
 
         self.logger('INFO', 'uploading: ' + file + ' => ' + key)
 
-        progress = ProgressHandler(self.verbose)
-        ret, _ = qiniu.put_file(token, key=key,
-                                file_path=file_path,
-                                params=params,
-                                mime_type=mime_type,
-                                check_crc=True,
-                                progress_handler=progress)
-        assert ret['key'] == key
-
-        future = time.time() + 10  # sec since Epoch
-        os.utime(file_path, times=(future, future))
-        # reset the atime and mtime in the future so that the file doesn't
-        # trigger the download criteria (remote ts > local ts)
+        progress = ProgressHandler(self.logger, key)
+        size = os.stat(file_path).st_size
+        with self.tracer.span('upload_file', key=key, size=size):
+            if self.upload_workers > 1 and \
+                    size > self.parallel_upload_threshold:
+                uploader = BlockUploader(
+                    token, key, file_path,
+                    'http://' + qiniu.config.get_default('default_up_host'),
+                    workers=self.upload_workers,
+                    state_dir=self.upload_state_dir,
+                    mime_type=mime_type, params=params,
+                    budget=self.budget, retry=self.retry,
+                    tracer=self.tracer, logger=self.logger)
+                ret = uploader.upload()
+            else:
+                with self.budget.transfer() as transfer, \
+                        self.tracer.span('put_file') as span:
+                    transfer.consume(size)
+                    ret, info = qiniu.put_file(token, key=key,
+                                               file_path=file_path,
+                                               params=params,
+                                               mime_type=mime_type,
+                                               check_crc=True,
+                                               progress_handler=progress)
+                    span['status'] = info.status_code
+                    transfer.status(info.status_code)
+                if ret is None or ret.get('key') != key:
+                    raise HTTPStatusError(info.status_code,
+                                          'upload of ' + key + ' failed: '
+                                          + str(info.error))
+        self._count('uploaded', size)
+        # the remote copy is now later than the local one, but both have the
+        # same hash so the next run will not download it back
+        return ret
 
 
 class QiniuFlatBackup(QiniuBackup):
@@ -321,119 +678,241 @@ class QiniuFlatBackup(QiniuBackup):
 
     def __init__(self, options, auth, logger=None,
                  encoding_func=lambda s: s.replace('/', '%2F'),
-                 decoding_func=lambda s: s.replace('%2F', '/')):
-        super(QiniuFlatBackup, self).__init__(options, auth, logger)
+                 decoding_func=lambda s: s.replace('%2F', '/'),
+                 budget=None, retry=None):
+        super(QiniuFlatBackup, self).__init__(options, auth, logger,
+                                              budget=budget, retry=retry)
         self.encoding = encoding_func
         self.decoding = decoding_func
 
-    def _list_local_files(self):
-        def detect_dir(path):
-            if path.is_dir():
-                self.logger('ERROR', "subdirectory is detected in a "
-                            "flat structure. Please review local file system "
-                            "or program setting. Exit now.")
-                sys.exit(1)
-            else:
-                return True
-
-        return {self.decoding(str(file.relative_to(self.localdir))):
-                file.stat().st_mtime
-                for file in self.localdir.iterdir() if detect_dir(file)}
+    def _local_path(self, key):
+        return self.localdir / self.encoding(key)
 
-    def _batch_download(self, keylist, big_file_list=None,
-                        output_policy=lambda x: x):
+    def _scan_local(self):
         """
-        side-effect: batch download list of resources from qiniu bucket
-        :except: raises exception if any of the request return an error
-        :param keylist: list of keys for downloading
-        :param output_policy: callback function that determines the output
-                              filename based on the key
-        :return None
+        :except SynchError: a subdirectory is found in the local folder
+        :return: generator of (key, path, stat) in key order. The names of the
+                 single local folder are sorted in memory, the flat encoding
+                 does not preserve the key order.
         """
-        if not keylist:
-            return
+        entries = []
+        with os.scandir(str(self.localdir)) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    self.logger('ERROR', "subdirectory is detected in a "
+                                "flat structure. Please review local file "
+                                "system or program setting. Exit now.")
+                    raise SynchError('subdirectory ' + entry.path
+                                     + ' in a flat structure')
+                if entry.name.endswith(self.PART_SUFFIX):
+                    continue
+                key = self.decoding(entry.name)
+                if self.filter.wants_key(key):
+                    entries.append((key, entry.path))
+        entries.sort()
+        return ((key, path, os.stat(path)) for key, path in entries)
+
+    def _upload_one(self, key, hashes=None):
+        token = self.auth.upload_token(self.bucketname, key)
+        with self.metrics.phase('upload'):
+            ret = self.retry.call('upload of ' + key, self._upload_file,
+                                  token, key, self.encoding(key),
+                                  {'x:a': 'a'})
+        self._remember_synched(hashes, self._local_path(key),
+                               ret.get('hash'))
+
 
-        for key in keylist:
-            file = self.encoding(key)
-            file_path = str(self.localdir / file)
-            with open(file_path, 'wb') as local_copy:
-                self._download_file(key, local_copy, big_file_list[key])
+class EventLogger:
+    """
+    Messages are put on a queue and written by a background thread, so
+    logging never holds up a transfer. Messages below `level` are dropped
+    right away, before they are formatted.
 
-    def _batch_upload(self, filelist):
+    When verbose and writing to a terminal, a single line at the bottom
+    shows the progress of every transfer together, redrawn at most every
+    PROGRESS_INTERVAL seconds. The log file never contains it.
+    """
+    LEVELS = {'DEBUG': 0, 'INFO': 1, 'WARN': 2, 'WARNING': 2,
+              'ERR': 3, 'ERROR': 3}
+    PROGRESS_INTERVAL = 1.0  # sec
+    DRAIN = 1000  # messages written between two looks at the progress
+    _STOP = object()
+
+    def __init__(self, verbose=False, log_to_file=False, level='DEBUG',
+                 json_lines=False):
         """
-        same as batch_download but for uploadging, requires authentication
-        :param filelist: list of file names (including path) to be uploaded
-               filelist is in the *decoded* state
-        :return:None
+        :param verbose: print the messages
+        :param log_to_file: also write them to qbackup-[timestamp].log
+        :param level: lowest level written, DEBUG, INFO, WARN or ERROR
+        :param json_lines: write a json object per message instead of text
         """
-        if not filelist:
-            return
-
-        token = self.auth.upload_token(self.bucketname)
-        params = {'x:a': 'a'}
-
-        for file in filelist:
-            self._upload_file(token, file, self.encoding(file), params)
-
-
-class EventLogger:
-    def __init__(self, verbose=False, log_to_file=False):
         self.logfile = None
+        self.verbose = verbose
+        self.json_lines = json_lines
+        self.level = self.LEVELS[level.upper()]
+        self.show_progress = verbose and sys.stdout.isatty()
+        # key -> (bytes done, size) of the transfers in flight
+        self.transfers = {}
+        self.done_files = 0
+        self.done_bytes = 0
+        self.lock = threading.Lock()
 
         if log_to_file:
             self.logfile = open('qbackup-{}.log'.format(
                 datetime.datetime.now().strftime('%y-%m-%d_%H-%M-%S')
             ), 'w')
 
-            if verbose:
-                def _log(tag, msg):
-                    msg = EventLogger.format(tag, msg)
-                    self.logfile.write(msg + '\n')
-                    print(msg)
+        self.queue = None
+        self.writer = None
+        if verbose or log_to_file:
+            self.queue = queue.Queue()
+            self.writer = threading.Thread(target=self._write,
+                                           name='qbackup-logger',
+                                           daemon=True)
+            self.writer.start()
+            atexit.register(self.close)
+
+    @classmethod
+    def from_options(cls, options):
+        return cls(verbose=options.get('verbose', False),
+                   log_to_file=options.get('log', False),
+                   level=options.get('log_level', 'debug'),
+                   json_lines=options.get('log_format', 'text') == 'json')
+
+    def __call__(self, tag, msg, bucket=None):
+        """
+        :param tag: level of the message, DEBUG, INFO, WARN or ERROR
+        :param bucket: bucket the message is about, if several are synched
+        """
+        if self.queue is None or self.LEVELS.get(tag, 1) < self.level:
+            return
+        self.queue.put((time.time(), tag, msg, bucket))
 
-                self.log = _log
+    def progress(self, key, done, total):
+        """
+        record the progress of a transfer, for the progress line
+        """
+        if not self.show_progress:
+            return
+        with self.lock:
+            before = self.transfers.get(key, (0, 0))[0]
+            self.done_bytes += max(0, done - before)
+            if done >= total:
+                self.transfers.pop(key, None)
+                self.done_files += 1
             else:
-                def _log(tag, msg):
-                    self.logfile.write(EventLogger.format(tag, msg) + '\n')
-
-                self.log = _log
-        elif verbose:
-            def _log(tag, msg):
-                print(EventLogger.format(tag, msg))
+                self.transfers[key] = (done, total)
 
-            self.log = _log
-        else:
-            self.log = lambda tag, msg: None
-
-    def __call__(self, tag, msg):
-        self.log(tag, msg)
+    def close(self):
+        """
+        write the messages still queued and stop the writer
+        """
+        if self.writer is not None and self.writer.is_alive():
+            self.queue.put(self._STOP)
+            self.writer.join()
+        if self.logfile:
+            self.logfile.close()
+            self.logfile = None
 
     def __del__(self):
         if self.logfile:
             self.logfile.close()
 
     @staticmethod
-    def format(tag, msg):
-        return "{0} [{1}] {2}".format(datetime.datetime.now(),
-                                      tag, msg)
+    def format(tag, msg, when=None):
+        when = datetime.datetime.fromtimestamp(when) if when is not None \
+            else datetime.datetime.now()
+        return "{0} [{1}] {2}".format(when, tag, msg)
+
+    def _line(self, when, tag, msg, bucket):
+        if self.json_lines:
+            record = {'time': datetime.datetime.fromtimestamp(when)
+                      .isoformat(), 'level': tag, 'message': msg}
+            if bucket is not None:
+                record['bucket'] = bucket
+            return json.dumps(record, ensure_ascii=False)
+        if bucket is not None:
+            msg = '[' + bucket + '] ' + msg
+        return EventLogger.format(tag, msg, when)
+
+    def _write(self):
+        status = ''  # the progress line on screen
+        drawn = time.monotonic()
+        drawn_bytes = 0
+        stop = False
+        while not stop:
+            try:
+                record = self.queue.get(timeout=self.PROGRESS_INTERVAL)
+            except queue.Empty:
+                record = None
+            lines = []
+            # write what is queued in one go
+            while record is not None and len(lines) < self.DRAIN:
+                if record is self._STOP:
+                    stop = True
+                    break
+                lines.append(self._line(*record))
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    record = None
+            if lines:
+                if self.verbose:
+                    if status:  # the messages go above the progress line
+                        sys.stdout.write('\r\x1b[K')
+                        status = ''
+                    sys.stdout.write('\n'.join(lines) + '\n')
+                if self.logfile:
+                    self.logfile.write('\n'.join(lines) + '\n')
+                    self.logfile.flush()
+            now = time.monotonic()
+            if self.show_progress and not stop and \
+                    now - drawn >= self.PROGRESS_INTERVAL:
+                with self.lock:
+                    in_flight = len(self.transfers)
+                    done_files, done_bytes = self.done_files, self.done_bytes
+                if in_flight or done_bytes != drawn_bytes:
+                    status = '{0} files done, {1} in flight, {2:.1f} MB, ' \
+                             '{3:.2f} MB/s'.format(
+                                 done_files, in_flight, done_bytes / 1048576,
+                                 (done_bytes - drawn_bytes) / 1048576
+                                 / (now - drawn))
+                    sys.stdout.write('\r\x1b[K' + status)
+                drawn, drawn_bytes = now, done_bytes
+            if self.verbose:
+                sys.stdout.flush()
+        if status:
+            sys.stdout.write('\r\x1b[K')
+            sys.stdout.flush()
+
+
+class BucketLogger:
+    """
+    wraps a logger and tags every message with the bucket name, so that
+    the lines of buckets synched at the same time can be told apart
+    """
 
+    def __init__(self, logger, bucketname):
+        self.logger = logger
+        self.bucketname = bucketname
 
-class ProgressHandler:
-    def __init__(self, display_progress_bar=False):
-        self.bar = None
-        self.display = display_progress_bar
+    def __call__(self, tag, msg):
+        self.logger(tag, msg, bucket=self.bucketname)
 
-    def __call__(self, progress, total):
-        if not self.display:
-            return
+    def progress(self, key, done, total):
+        self.logger.progress(self.bucketname + ':' + key, done, total)
 
-        if not self.bar:
-            self.bar = progressbar.ProgressBar(widgets=[
-                progressbar.Percentage(), progressbar.Bar()
-            ], maxval=total).start()
-        self.bar.update(progress)
-        if progress >= total:
-            self.bar.finish()
 
+class ProgressHandler:
+    """
+    reports the progress of one transfer to the progress line of the
+    logger, if it has one
+    """
 
+    def __init__(self, logger, key):
+        self.report = getattr(logger, 'progress', None)
+        self.key = key
 
+    def __call__(self, progress, total):
+        if self.report is not None:
+            self.report(self.key, min(progress, total), total)
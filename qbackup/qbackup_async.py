@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+asyncio version of qbackup, for buckets of many small files.
+
+With one blocking request per file, a bucket of tens of thousands of small
+files spends its time waiting for round trips. `QiniuBackupAsync` lists the
+bucket, downloads and uploads on a single event loop with aiohttp, keeping up
+to `async_concurrency` requests in flight over a pool of keep-alive
+connections. Disk I/O runs on the default thread pool so it never blocks
+the loop.
+
+The local folder is flat, with the same key encoding as QiniuFlatBackup, so
+the two engines can be used on the same folder. Files too big for a single
+form upload are handed to the blocking uploader on a thread.
+
+Requires aiohttp.
+"""
+
+import asyncio
+import mimetypes
+import os
+import time
+import zlib
+from urllib.parse import urlencode
+
+import aiohttp
+import qiniu
+from yarl import URL
+
+from qbackup import diff
+from qbackup.hashcache import HashCache
+from qbackup.listing import BucketLister
+from qbackup.qbackup import QiniuFlatBackup, SynchError
+from qbackup.qetag import BLOCK_SIZE, QEtag
+from qbackup.retry import HTTPStatusError
+
+
+class QiniuBackupAsync(QiniuFlatBackup):
+    CONCURRENCY = 256
+    # put_file sends files up to this size as a single form, so do we
+    FORM_UPLOAD_LIMIT = 2 * BLOCK_SIZE
+
+    def __init__(self, options, auth, logger=None, budget=None, retry=None):
+        super(QiniuBackupAsync, self).__init__(options, auth, logger,
+                                               budget=budget, retry=retry)
+        self.concurrency = options.get('async_concurrency', self.CONCURRENCY)
+        if self.budget.max_transfers:
+            self.concurrency = min(self.concurrency,
+                                   self.budget.max_transfers)
+        self.session = None
+        self.fetching = {}  # hash -> download in flight of that content
+
+    def synch(self):
+        """
+        same comparison as QiniuFlatBackup, but every transfer is a task of
+        the event loop, started as soon as its key is listed
+        :return: None
+        """
+        self.logger('INFO', 'Begin synching ' + str(self.localdir)
+                    + ' <=> ' + self.bucketname)
+        with self.tracer, self.metrics.run():
+            with self.metrics.phase('validate'):
+                self.validate_local_folder()
+            with HashCache(self.hash_cache, self.hash_workers,
+                           self.tracer, self.logger) as hashes:
+                with self.metrics.phase('scan'):
+                    # the flat folder is sorted in memory anyway
+                    local = {entry[0]: entry for entry in self._scan_local()}
+                with self.metrics.phase('hash'):
+                    hashes.warm(local.values())
+                self.failed = 0
+                asyncio.run(self._synch_async(local, hashes))
+            if self.failed:
+                raise SynchError(str(self.failed) + ' transfers failed')
+        self.logger('INFO', 'Bucket and local folder are synched!')
+
+    async def _synch_async(self, local, hashes):
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+
+        async def spawn(coroutine):
+            # wait for a free slot, so the listing never runs far ahead of
+            # the transfers
+            await slots.acquire()
+            task = asyncio.ensure_future(self._guarded(coroutine, slots))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        connector = aiohttp.TCPConnector(limit=self.concurrency,
+                                         limit_per_host=self.concurrency)
+        timeout = aiohttp.ClientTimeout(sock_connect=30, sock_read=60)
+        async with aiohttp.ClientSession(connector=connector,
+                                         timeout=timeout) as session:
+            self.session = session
+            try:
+                async for item in self._list_async():
+                    key = item['key']
+                    entry = local.pop(key, None)
+                    if not self.filter.wants_copies(item, entry):
+                        continue
+                    start = time.monotonic()
+                    action = diff.decide(item, entry, hashes.hash_file,
+                                         hashes.synched)
+                    self.metrics.add('diff', time.monotonic() - start)
+                    if action == diff.DOWNLOAD:
+                        await spawn(self._download(key, item, hashes))
+                    elif action == diff.UPLOAD:
+                        await spawn(self._upload(key, entry[2], hashes))
+                    elif action == diff.CONFLICT:
+                        self._conflict(key, item)
+                    else:
+                        self._count('skipped', item['fsize'])
+                        self._remember_synched(hashes, entry[1],
+                                               item.get('hash'))
+            except ConnectionError:
+                self.logger('ERROR',
+                            'could not establish connection with cloud. Exit.')
+                await asyncio.gather(*tasks)
+                raise SynchError('could not list bucket ' + self.bucketname)
+
+            for key in sorted(local):
+                if not self.filter.wants_stat(local[key][2]):
+                    continue
+                await spawn(self._upload(key, local[key][2], hashes))
+            await asyncio.gather(*tasks)
+        self.session = None
+
+    async def _guarded(self, coroutine, slots):
+        try:
+            await coroutine
+        except (OSError, ValueError, aiohttp.ClientError) as e:
+            # ConnectionError, a local error, or a body that is not the
+            # expected JSON: one failed transfer, the others go on
+            self.logger('ERROR', str(e))
+            self.failed += 1
+        finally:
+            slots.release()
+
+    async def _list_async(self):
+        """
+        async generator of the listing items the include/exclude rules
+        keep, listing only the prefixes they allow, one after the other
+        """
+        for prefix in self.filter.prefixes():
+            async for item in self._list_prefix(prefix):
+                if self.filter.wants_key(item['key']):
+                    yield item
+
+    async def _list_prefix(self, prefix):
+        """
+        async generator of the listing items of a prefix, the next page is
+        requested while the current one is processed
+        """
+        host = qiniu.config.get_default('default_rsf_host')
+        limit = max(1, min(int(self.list_limit), BucketLister.MAX_LIMIT))
+
+        def fetch(marker):
+            return asyncio.ensure_future(self.retry.call_async(
+                'listing ' + self.bucketname, self._list_page,
+                host, limit, marker, prefix))
+
+        page = fetch(None)
+        try:
+            while page is not None:
+                start = time.monotonic()
+                ret = await page
+                self.metrics.add('listing', time.monotonic() - start)
+                self.metrics.pages_listed += 1
+                marker = ret.get('marker')
+                page = fetch(marker) if marker else None
+                for item in ret.get('items', []):
+                    yield item
+        finally:
+            if page is not None:
+                page.cancel()
+
+    async def _list_page(self, host, limit, marker, prefix=''):
+        query = {'bucket': self.bucketname, 'limit': limit}
+        if prefix:
+            query['prefix'] = prefix
+        if marker:
+            query['marker'] = marker
+        url = 'http://{0}/list?{1}'.format(host, urlencode(query))
+        # the signature covers the url exactly as it is sent
+        headers = {'Authorization':
+                   'QBox ' + self.auth.token_of_request(url)}
+        try:
+            async with self.session.get(URL(url, encoded=True),
+                                        headers=headers) as res:
+                if res.status != 200:
+                    raise HTTPStatusError(res.status)
+                return await res.json(content_type=None)
+        except aiohttp.ClientError as e:
+            raise ConnectionError(str(e))
+
+    async def _download(self, key, item, hashes):
+        hash = item.get('hash')
+        fetched = None
+        if hash in self.fetching:
+            # the same content is on its way under another key, wait for it
+            # rather than download it twice
+            await asyncio.wait([self.fetching[hash]])
+        elif hash is not None:
+            fetched = self.fetching[hash] = \
+                asyncio.get_running_loop().create_future()
+        try:
+            if await asyncio.to_thread(self._reuse_local, hashes, key,
+                                       self._local_path(key), item['fsize'],
+                                       hash):
+                return
+            start = time.monotonic()
+            try:
+                await self.retry.call_async('download of ' + key,
+                                            self._download_async, key,
+                                            item['fsize'], hash)
+            finally:
+                self.metrics.add('download', time.monotonic() - start)
+            await asyncio.to_thread(self._remember_content, hashes,
+                                    self._local_path(key), hash)
+        finally:
+            if fetched is not None:
+                fetched.set_result(None)
+                del self.fetching[hash]
+
+    async def _download_async(self, key, size, hash):
+        """
+        download key into its part file, resuming from the data an earlier
+        attempt left there, and rename it into place once complete
+        :except ConnectionError: the transfer failed, the part file is kept
+        """
+        path = self._local_path(key)
+        part = path.with_name(path.name + self.PART_SUFFIX)
+        file, etag, offset = await asyncio.to_thread(self._open_part, part,
+                                                     size)
+        try:
+            headers = {'Range': 'bytes={0}-'.format(offset)} if offset else {}
+            async with self.session.get(self.bucketurl + key,
+                                        headers=headers) as res:
+                if res.status not in (200, 206):
+                    raise HTTPStatusError(res.status)
+                if offset and (res.status == 200 or not res.headers.get(
+                        'Content-Range', '').startswith(
+                        'bytes {0}-'.format(offset))):
+                    # the server ignored the range, take the whole file
+                    if res.status != 200:
+                        raise HTTPStatusError(res.status)
+                    await asyncio.to_thread(self._truncate, file, etag)
+                if size > self.download_size_threshold:
+                    async for chunk in res.content.iter_chunked(
+                            self.chunk_size):
+                        await self._throttle(len(chunk))
+                        await asyncio.to_thread(self._write_chunk, file,
+                                                etag, chunk)
+                else:
+                    data = await res.read()
+                    await self._throttle(len(data))
+                    await asyncio.to_thread(self._write_chunk, file, etag,
+                                            data)
+        except aiohttp.ClientError as e:
+            await asyncio.to_thread(file.close)
+            raise ConnectionError('downloading ' + key + ' interrupted: '
+                                  + str(e))
+        except BaseException:
+            await asyncio.to_thread(file.close)
+            raise
+        await asyncio.to_thread(self._finish_part, key, file, etag, part,
+                                path, size, hash)
+        self._count('downloaded', size)
+
+    async def _throttle(self, nbytes):
+        delay = self.budget.reserve(nbytes)
+        if delay:
+            await asyncio.sleep(delay)
+
+    def _open_part(self, part, size):
+        """
+        :return: (open part file, QEtag of its content, its size)
+        """
+        etag = QEtag()
+        offset = part.stat().st_size if part.exists() else 0
+        if offset > size:
+            self.logger('WARN', 'local data of ' + part.name + ' is larger '
+                        'than the remote file, starting over')
+            offset = 0
+        file = open(str(part), 'r+b' if offset else 'wb')
+        if offset:
+            etag.update_from(file, offset)
+        file.seek(offset)
+        file.truncate()
+        return file, etag, offset
+
+    @staticmethod
+    def _truncate(file, etag):
+        file.seek(0)
+        file.truncate()
+        etag.reset()
+
+    def _write_chunk(self, file, etag, chunk):
+        file.write(chunk)
+        etag.update(chunk)
+        if self.durability == 'chunk':
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _finish_part(self, key, file, etag, part, path, size, hash):
+        with file:
+            if self.durability != 'none':
+                file.flush()
+                os.fsync(file.fileno())
+            written = file.tell()
+        if written != size:
+            raise ConnectionError('incomplete download of ' + key)
+        if hash is not None and etag.hexdigest() != hash:
+            self.logger('WARN', 'hash of ' + key + ' does not match the '
+                        'remote file, discarding local data')
+            part.unlink()
+            raise ConnectionError('hash mismatch for ' + key)
+        os.replace(str(part), str(path))
+
+    async def _upload(self, key, stat, hashes=None):
+        start = time.monotonic()
+        file = self.encoding(key)
+        token = self.auth.upload_token(self.bucketname, key)
+        try:
+            if stat.st_size > self.FORM_UPLOAD_LIMIT:
+                # block upload, blocking and parallel, on a thread
+                ret = await asyncio.to_thread(self.retry.call,
+                                              'upload of ' + key,
+                                              self._upload_file, token, key,
+                                              file, {'x:a': 'a'})
+            else:
+                ret = await self.retry.call_async('upload of ' + key,
+                                                  self._form_upload, token,
+                                                  key, self.localdir / file)
+        finally:
+            self.metrics.add('upload', time.monotonic() - start)
+        self._remember_synched(hashes, self.localdir / file, ret.get('hash'))
+
+    async def _form_upload(self, token, key, path):
+        self.logger('INFO', 'uploading: ' + path.name + ' => ' + key)
+        data = await asyncio.to_thread(path.read_bytes)
+        await self._throttle(len(data))
+        form = aiohttp.FormData()
+        form.add_field('token', token)
+        form.add_field('key', key)
+        form.add_field('crc32', str(zlib.crc32(data) & 0xffffffff))
+        form.add_field('x:a', 'a')
+        form.add_field('file', data, filename=key,
+                       content_type=mimetypes.guess_type(str(path))[0]
+                       or 'application/octet-stream')
+        url = 'http://' + qiniu.config.get_default('default_up_host') + '/'
+        try:
+            async with self.session.post(url, data=form) as res:
+                if res.status != 200:
+                    raise HTTPStatusError(res.status, 'upload of ' + key
+                                          + ' failed: status '
+                                          + str(res.status))
+                ret = await res.json(content_type=None)
+        except aiohttp.ClientError as e:
+            raise ConnectionError('uploading ' + key + ' interrupted: '
+                                  + str(e))
+        if ret.get('key') != key:
+            raise HTTPStatusError(res.status, 'upload of ' + key
+                                  + ' returned key ' + str(ret.get('key')))
+        self._count('uploaded', len(data))
+        return ret
@@ -9,142 +9,613 @@ scalable version of qbackup.
 
 In real test cases where there are tens of thousands of files online, we found out it is not
 practical to pull the full list of files into RAM (it can take hours).
+
+With the `snapshots` option, each run writes a dated snapshot of the bucket
+instead of synching a single mirror, see qbackup.snapshots.
 """
 
-import sys
+import datetime
 import os
-from pathlib import Path
-import dbm
-
-from arrow import now
-import qiniu
+import shutil
+import time
 
-from qbackup.qbackup import QiniuFlatBackup
+from qbackup import diff
+from qbackup.qbackup import QiniuFlatBackup, SynchError
+from qbackup.hashcache import HashCache
+from qbackup.manifest import SyncManifest
+from qbackup.relocate import Relocator
+from qbackup.snapshots import SnapshotIndex, retained
+from qbackup.workers import WorkerPool
 
 
 class QiniuBackupScaled(QiniuFlatBackup):
     BATCH_LIMIT = 100
-    TEMP_DB_DIR = Path('tmp')
-    TEMP_DB = 'temp-reomte-directory'
-    MAX_ATTEMPT = 4
+    MANIFEST_DIR = 'manifest'
 
-    def __init__(self, options, auth, logger):
-        super(QiniuBackupScaled, self).__init__(options, auth, logger)
-        self.purge = options.get('purge', True)
+    def __init__(self, options, auth, logger, budget=None, retry=None):
+        super(QiniuBackupScaled, self).__init__(options, auth, logger,
+                                                budget=budget, retry=retry)
+        self.manifest_dir = options.get('manifest_dir', self.MANIFEST_DIR)
+        # seconds between two checkpoints of an interrupted run
+        self.checkpoint_interval = options.get('checkpoint_interval', 30)
+        self.edited = set()  # keys edited locally, to be uploaded
+        # copy or move the content of new local files within the bucket
+        # when it is already there, instead of uploading it
+        self.server_side_copy = options.get('server_side_copy', True)
+        self.snapshots = options.get('snapshots', False)
+        self.keep = {'daily': options.get('keep_daily', 7),
+                     'weekly': options.get('keep_weekly', 4),
+                     'monthly': options.get('keep_monthly', 12)}
+        self.linked = 0
+        self.fetching = {}  # hash -> keys waiting for its download
 
     def synch(self):
         """
         This overrides the original synch() and rebuilds an *online* version of the code
         :return:
         """
+        if self.snapshots:
+            return self.synch_snapshot()
         self.logger('INFO', 'Begin synching ' + str(self.localdir)
                     + ' <=> ' + self.bucketname)
-        self.validate_local_folder()
-
-        if not self.TEMP_DB_DIR.exists():
-            self.logger('DEBUG', 'Create temporary folder')
-            self.TEMP_DB_DIR.mkdir()
-        temp_db = self.bucketname + '-' + now().format('YYYY-MM-DD-HH-mm-ss')
-        self.logger('DEBUG', 'Create database file tmp/' + temp_db)
-
-        with dbm.open(str(self.TEMP_DB_DIR / temp_db), 'c') as remote_file_db:
-            self.logger('INFO', 'Check for download')
-            self.download_remote_files(remote_file_db)
-            self.logger('INFO', 'Check for upload')
-            self.upload_local_files(remote_file_db)
-            self.logger('INFO', 'Bucket and local folder are synched!')
-
-        if self.purge:
-            self.logger('DEBUG', 'removing temporary database files...')
-            for file in self.TEMP_DB_DIR.iterdir():
-                file.unlink()  # remove file
-        self.logger('DEBUG', 'Cleaning up completed')
+        with self.tracer, self.metrics.run():
+            with self.metrics.phase('validate'):
+                self.validate_local_folder()
+
+            manifest_path = SyncManifest.path_for(self.manifest_dir,
+                                                  self.bucketname)
+            self.logger('DEBUG', 'Open manifest ' + str(manifest_path))
+
+            with SyncManifest(manifest_path) as manifest, \
+                    HashCache(self.hash_cache, self.hash_workers,
+                              self.tracer, self.logger) as hashes:
+                marker = self._begin_or_resume(manifest)
+                with self.metrics.phase('scan'):
+                    local_files = self._scan_local_files()
+                with self.metrics.phase('hash'):
+                    self._hash_changed_files(manifest, local_files, hashes)
+                if self.server_side_copy:
+                    with self.metrics.phase('relocate'):
+                        Relocator(self, manifest, hashes).run(local_files)
+                self.logger('INFO', 'Check for download')
+                with self.metrics.phase('diff'):
+                    self.download_remote_files(manifest, local_files, hashes,
+                                               marker)
+                self.logger('INFO', 'Check for upload')
+                self.upload_local_files(manifest, local_files)
+                manifest.forget_unseen()
+                self._clean_part_files(manifest)
+                manifest.end_run()
+        self.logger('INFO', 'Bucket and local folder are synched!')
+
+    def _begin_or_resume(self, manifest):
+        """
+        start a new run, or carry on with the run that was interrupted: the
+        listing continues from its last checkpoint, the downloads that were
+        in flight or failed are made again and the keys found edited are
+        uploaded at the end
+        :return: the listing marker to start from
+        """
+        self.edited = set()
+        if not manifest.interrupted():
+            manifest.begin_run()
+            return None
+        marker = manifest.resume_run()
+        pending = manifest.pending_keys()
+        self.edited = {key for key, _, _, state in pending
+                       if state == SyncManifest.EDITED}
+        self.logger('INFO', 'resuming the interrupted run '
+                    + ('from its last checkpoint' if marker
+                       else 'from the start of the listing') + ': '
+                    + str(len(pending) - len(self.edited))
+                    + ' downloads to make again, ' + str(len(self.edited))
+                    + ' edited files to upload')
+        return marker
 
     def validate_local_folder(self):
         super(QiniuBackupScaled, self).validate_local_folder()
+        if self.snapshots:  # the snapshots are subdirectories
+            return
 
         # In addition, check for directory in a flat structure
         if any(s.is_dir() for s in self.localdir.iterdir()):
             self.logger('ERROR', "subdirectory is detected in a "
                         "flat structure. Please review local file system "
                         "or program setting. Exit now.")
-            sys.exit(1)
+            raise SynchError('subdirectory in the flat structure '
+                             + str(self.localdir))
+
+    def _scan_local_files(self):
+        """
+        :return: a dict mapping the file names of the local folder to their
+                 stat result, for the keys the include/exclude rules keep
+        """
+        with os.scandir(str(self.localdir)) as entries:
+            return {entry.name: entry.stat() for entry in entries
+                    if not entry.name.endswith(self.PART_SUFFIX)
+                    and self.filter.wants_key(self.decoding(entry.name))}
+
+    def _hash_changed_files(self, manifest, local_files, hashes):
+        """
+        hash, on several processes, every local file that changed since it
+        was last recorded in the manifest, so that the comparison with the
+        listing only needs cached hashes
+        """
+        changed = [(self.localdir / file, stat)
+                   for file, stat in local_files.items()
+                   if not SyncManifest.local_unchanged(
+                       manifest.get(self.decoding(file)), stat)]
+        if changed:
+            hashes.hash_many(changed)
+            self.logger('DEBUG', 'hashed ' + str(hashes.hashed) + ' of '
+                        + str(len(changed)) + ' changed local files')
 
-    def download_remote_files(self, remote_file_set):
+    def download_remote_files(self, manifest, local_files, hashes,
+                              marker=None):
         """
-        list all the files on the bucket (100 per batch)
-        check for existence locally. Download any file that is not present
-        Load the file list into a persistent database
-        :return:database object
+        list all the files on the bucket (`list_limit` per page) and record
+        them in the manifest. Keys whose remote and local copies have not
+        changed since they were last transferred are skipped without being
+        compared again. Otherwise the content hashes are compared: a key
+        that is missing locally or has changed remotely is downloaded, a key
+        edited locally is left for the upload.
+
+        With `download_workers` > 1 the listing loop only enqueues the
+        missing files and a pool of workers downloads them.
+
+        Every `checkpoint_interval` seconds the manifest is committed with
+        the marker of the listing, see `_begin_or_resume`.
+        :param manifest: SyncManifest of the bucket
+        :param local_files: dict mapping local file names to stat results
+        :param hashes: HashCache of the local qetags
+        :param marker: listing marker to start from, None for the start
+        :return: None
         """
-        done = False
-        marker = None
-        bucket = qiniu.BucketManager(self.auth)
+        pool = None
+        if self.download_workers > 1:
+            pool = WorkerPool(self._download_with_retry,
+                              self.download_workers,
+                              self.QUEUE_LIMIT,
+                              self.logger,
+                              self._scheduler())
 
-        while not done:
-            res, done, _ = bucket.list(self.bucketname, marker=marker,
-                                       limit=self.BATCH_LIMIT)
-            if not res:
-                self.logger('ERROR',
-                            'could not establish connection with cloud. Exit.')
-                raise ConnectionError('could not establish connection with cloud')
-            marker = res.get('marker')
+        # downloads an interrupted run started, or that failed
+        redone = {}
+        for key, fsize, hash, state in manifest.pending_keys():
+            if state == SyncManifest.EDITED:
+                continue
+            redone[key] = (fsize, hash)
+            if pool:
+                pool.submit(key, fsize, manifest, hash, hashes, key=key,
+                            size=fsize or 0)
+            else:
+                self._download_with_retry(key, fsize, manifest, hash, hashes)
 
-            for remote_file in res['items']:
+        lister = self._remote_listing(marker)
+        checkpointed = marker
+        last_checkpoint = time.monotonic()
+        try:
+            for remote_file in self.metrics.timed('listing', lister):
+                # every key before lister.marker has been recorded
+                if lister.marker != checkpointed and time.monotonic() \
+                        - last_checkpoint >= self.checkpoint_interval:
+                    manifest.checkpoint(lister.marker)
+                    checkpointed = lister.marker
+                    last_checkpoint = time.monotonic()
                 key = remote_file['key']
                 file = self.encoding(key)
-                remote_file_set[file] = str(remote_file['fsize'])
-                # I only need the db to serve as a set
-                path = self.localdir / file
-                if not path.exists():
-                    attempt = 0
-                    while True:
-                        if attempt > self.MAX_ATTEMPT:
-                            self.logger('ERROR', 'The file has failed to download. '
-                                                 'Removing incomplete file')
-                            if path.exists():
-                                path.unlink()
-                            break
-
-                        try:
-                            attempt += 1
-                            with open(str(path), 'wb') as filestrem:
-                                self._download_file(key, filestrem, remote_file['fsize'])
-                        except ConnectionError:
-                            self.logger('WARN',
-                                        'There is trouble downloading the file. '
-                                        'Attempt ' + str(attempt) + ' out of '
-                                        + str(self.MAX_ATTEMPT))
-                            continue
-
-                        # no exception is thrown
-                        if path.stat().st_size == remote_file['fsize']:
-                            self.logger('INFO', 'file has been downloaded successfully.')
-                            break  # success!
-                        else:
-                            self.logger('WARN',
-                                        'file downloaded is not complete.'
-                                        'Attempt ' + str(attempt) + ' out of '
-                                        + str(self.MAX_ATTEMPT))
-        return remote_file_set
-
-    def upload_local_files(self, remote_file_set):
-        """
-        os.listdir all the local files, check whether they exist remotely
-        (by checking in the remote_filelist, and upload any file that doesn't.
-        :param remote_file_set: a mapping of keys to file size stored in database
+                entry = manifest.get(key)
+                manifest.record_remote(key, remote_file['fsize'],
+                                       remote_file['putTime'],
+                                       remote_file.get('hash'))
+                if redone.get(key) == (remote_file['fsize'],
+                                       remote_file.get('hash')):
+                    continue  # already downloaded again above
+                if not self.filter.wants_item(remote_file):
+                    continue  # still listed, so its local copy stays put
+
+                if file in local_files:
+                    stat = local_files[file]
+                    remote_unchanged = SyncManifest.unchanged(entry,
+                                                              remote_file)
+                    if remote_unchanged and \
+                            SyncManifest.local_unchanged(entry, stat):
+                        self._count('skipped', remote_file['fsize'])
+                        continue
+                    path = self.localdir / file
+                    action = diff.decide(
+                        remote_file, (key, path, stat), hashes.hash_file,
+                        lambda path: self._synched(entry, hashes, path))
+                    if action == diff.SKIP:
+                        if remote_file.get('hash') is not None:
+                            manifest.record_local(key, stat.st_mtime,
+                                                  stat.st_size)
+                            self._remember_synched(hashes, path,
+                                                   remote_file['hash'])
+                        self._count('skipped', remote_file['fsize'])
+                        continue
+                    if action == diff.CONFLICT:
+                        self._conflict(key, remote_file)
+                        continue
+                    if action == diff.UPLOAD:
+                        self.logger('INFO', key + ' has changed locally')
+                        self.edited.add(key)
+                        manifest.set_pending(key, SyncManifest.EDITED)
+                        continue
+                    self.logger('INFO', key + ' has changed remotely')
+
+                manifest.set_pending(key, SyncManifest.DOWNLOADING,
+                                     remote_file['fsize'],
+                                     remote_file.get('hash'))
+                if pool:
+                    pool.submit(key, remote_file['fsize'], manifest,
+                                remote_file.get('hash'), hashes, key=key,
+                                size=remote_file['fsize'],
+                                put_time=remote_file['putTime'])
+                else:
+                    self._download_with_retry(key, remote_file['fsize'],
+                                              manifest,
+                                              remote_file.get('hash'), hashes)
+        except ConnectionError:
+            self.logger('ERROR',
+                        'could not establish connection with cloud. Exit.')
+            raise
+        finally:
+            if pool:
+                pool.join()
+            self.metrics.pages_listed = lister.pages_listed
+
+    @staticmethod
+    def _synched(entry, hashes, path):
+        """
+        :param entry: Entry of the key in the manifest, before this run
+        :return: qetag both copies of the key had after its last transfer,
+                 from the manifest or else from the HashCache, None if
+                 unknown
+        """
+        if entry is not None and entry.local_size is not None:
+            return entry.hash
+        return hashes.synched(path)
+
+    def _download_with_retry(self, key, fsize, manifest=None, hash=None,
+                             hashes=None):
+        """
+        download a single key, retrying according to the RetryPolicy until
+        the local file has the size and hash reported by the listing. Every
+        attempt continues from the data the previous ones left on disk.
+        :param key: remote key
+        :param fsize: remote file size
+        :param manifest: SyncManifest to record the downloaded file in
+        :param hash: remote qetag of the file
+        :param hashes: HashCache used to find the content locally
+        :return: None
+        """
+        path = self.localdir / self.encoding(key)
+        if self._reuse_local(hashes, key, path, fsize, hash):
+            if manifest is not None:
+                self._record_local(manifest, key)
+            return
+        try:
+            with self.metrics.phase('download'):
+                self.retry.call('download of ' + key,
+                                self._download_resumable, key, path, fsize,
+                                hash)
+        except OSError as e:  # ConnectionError, or a local error
+            self.logger('ERROR', 'The file has failed to download (' + str(e)
+                        + '). Keeping the incomplete part file to resume on '
+                        'the next run')
+            if manifest is not None:
+                manifest.set_pending(key, SyncManifest.FAILED)
+            return
+
+        self.logger('INFO', 'file has been downloaded successfully.')
+        self._remember_content(hashes, path, hash)
+        if manifest is not None:
+            self._record_local(manifest, key)
+
+    def upload_local_files(self, manifest, local_files):
+        """
+        go through the local files, check whether they were listed remotely
+        during this run (by checking in the manifest), and upload any file
+        that wasn't, as well as the files edited locally.
+
+        With `download_workers` > 1 the uploads are queued to a pool of
+        workers, in the order of the scheduler.
+        :param manifest: SyncManifest of the bucket
+        :param local_files: dict mapping local file names to stat results
         :return:None
         """
+        pool = None
+        if self.download_workers > 1:
+            pool = WorkerPool(self._upload_with_retry,
+                              self.download_workers,
+                              self.QUEUE_LIMIT,
+                              self.logger,
+                              self._scheduler())
         token = self.auth.upload_token(self.bucketname)
-        for file in os.listdir(str(self.localdir)):
-            if file not in remote_file_set:
+        try:
+            for file in sorted(local_files):
                 key = self.decoding(file)
-                self._upload_file(token,
-                                  key,
-                                  file,
-                                  params={'x:a': 'a'})
-                # ideally, remote_file_set[key] should store the
-                # file size of the uploaded file,
-                # currently I only put in a zero for every newly uploaded file
-                # and assume uploading is handled correctly
-                remote_file_set[key] = '0'
+                stat = local_files[file]
+                if key in self.edited:
+                    # overwriting an existing key needs a token scoped to it
+                    key_token = self.auth.upload_token(self.bucketname, key)
+                elif not manifest.listed(key) and \
+                        self.filter.wants_stat(stat):
+                    key_token = token
+                else:
+                    continue
+                if pool:
+                    pool.submit(key, key_token, file, stat, manifest,
+                                key=key, size=stat.st_size,
+                                put_time=int(stat.st_mtime * 1e7))
+                else:
+                    self._upload_with_retry(key, key_token, file, stat,
+                                            manifest)
+        finally:
+            if pool:
+                pool.join()
+
+    def _upload_with_retry(self, key, token, file, stat, manifest):
+        """
+        upload a local file and record it in the manifest
+        :param key: remote key
+        :param token: upload token
+        :param file: local file name
+        :param stat: stat result of the local file
+        :param manifest: SyncManifest of the bucket
+        :return: None
+        :except: a failed upload is logged, and made again on the next run
+        """
+        try:
+            with self.metrics.phase('upload'):
+                ret = self.retry.call('upload of ' + key, self._upload_file,
+                                      token, key, file, {'x:a': 'a'})
+        except OSError as e:  # ConnectionError, or a local error
+            self.logger('ERROR', 'The file has failed to upload ('
+                        + str(e) + '), it will be tried again on the '
+                        'next run')
+            return
+        manifest.record_remote(key, stat.st_size, int(time.time() * 10e6),
+                               ret.get('hash'))
+        manifest.record_local(key, stat.st_mtime, stat.st_size)
+        manifest.clear_pending(key)
+
+    def _record_local(self, manifest, key):
+        stat = (self.localdir / self.encoding(key)).stat()
+        manifest.record_local(key, stat.st_mtime, stat.st_size)
+        manifest.clear_pending(key)
+
+    def _clean_part_files(self, manifest):
+        """
+        delete the part files of keys that are gone from the bucket, the
+        others are kept for their download to resume
+        """
+        with os.scandir(str(self.localdir)) as entries:
+            parts = [entry.name for entry in entries
+                     if entry.name.endswith(self.PART_SUFFIX)]
+        for part in parts:
+            key = self.decoding(part[:-len(self.PART_SUFFIX)])
+            if not manifest.listed(key):
+                self.logger('INFO', 'removing ' + part + ', ' + key
+                            + ' is no longer in the bucket')
+                (self.localdir / part).unlink()
+
+    def synch_snapshot(self):
+        """
+        download the bucket into a new snapshot directory of the local
+        folder, hard-linking the files that have not changed since the
+        previous snapshot, then prune the old snapshots. Snapshots are
+        backups: local files are never uploaded.
+
+        The snapshot is written as `<name>.qbackup.part` and renamed once
+        every file is in. If some downloads fail, it stays unfinished and
+        the next run carries on with it under a new name.
+        :return: None
+        """
+        self.logger('INFO', 'Begin snapshot of ' + self.bucketname
+                    + ' into ' + str(self.localdir))
+        with self.tracer, self.metrics.run():
+            with self.metrics.phase('validate'):
+                self.validate_local_folder()
+            index_path = SnapshotIndex.path_for(self.manifest_dir,
+                                                self.bucketname)
+            with SnapshotIndex(index_path) as index:
+                previous = index.latest()
+                name, folder = self._begin_snapshot(index)
+                self.failed = self.linked = 0
+                with self.metrics.phase('diff'):
+                    self._fill_snapshot(index, name, folder, previous)
+                index.commit()
+                if self.failed:
+                    raise SynchError(str(self.failed) + ' files failed to '
+                                     'download, snapshot ' + name
+                                     + ' is unfinished')
+                folder.rename(self.localdir / name)
+                index.finish(name)
+                self.logger('INFO', 'snapshot ' + name + ' done, '
+                            + str(self.linked) + ' files linked from '
+                            + (previous.name if previous else '-'))
+                self.prune_snapshots(index)
+        self.logger('INFO', 'Bucket snapshot is complete!')
+
+    def _begin_snapshot(self, index):
+        """
+        :return: (name, directory) of the snapshot of this run, an
+                 unfinished snapshot left by an earlier run is reused
+        """
+        now = time.time()
+        unfinished = index.unfinished()
+        name = datetime.datetime.fromtimestamp(now).strftime(
+            '%Y-%m-%d_%H%M%S')
+        taken = {s.name for s in index.snapshots() if s != unfinished}
+        base, n = name, 1
+        while name in taken:
+            name = base + '-' + str(n)
+            n += 1
+        folder = self.localdir / (name + self.PART_SUFFIX)
+
+        if unfinished is not None:
+            old = self.localdir / (unfinished.name + self.PART_SUFFIX)
+            if old.is_dir():
+                self.logger('INFO', 'resuming unfinished snapshot '
+                            + unfinished.name)
+                old.rename(folder)
+                index.rename(unfinished.name, name, now)
+                return name, folder
+            index.remove(unfinished.name)
+
+        folder.mkdir()
+        index.begin(name, now)
+        return name, folder
+
+    def _fill_snapshot(self, index, name, folder, previous):
+        """
+        go through the bucket listing: files already in the snapshot (when
+        it is resumed) are left alone, files unchanged since the previous
+        snapshot are linked from it, the others are downloaded. A key whose
+        content is being downloaded for another key is linked from it once
+        that download is done.
+        """
+        self.fetching = {}
+        pool = None
+        if self.download_workers > 1:
+            pool = WorkerPool(self._download_to_snapshot,
+                              self.download_workers,
+                              self.QUEUE_LIMIT,
+                              self.logger,
+                              self._scheduler())
+
+        lister = self._remote_listing()
+        try:
+            for item in self.metrics.timed('listing', lister):
+                if not self.filter.wants_item(item):
+                    continue
+                key = item['key']
+                content = (item['fsize'], item.get('hash'))
+                file = self.encoding(key)
+                if index.get(name, key) == content:
+                    self._count('skipped', item['fsize'])
+                    continue
+                if previous is not None and \
+                        index.get(previous.name, key) == content and \
+                        self._link(self.localdir / previous.name / file,
+                                   folder / file):
+                    index.record(name, key, *content)
+                    self._count('skipped', item['fsize'])
+                    self.linked += 1
+                    continue
+                with self.lock:  # the workers link the waiting keys
+                    if self._link_content(index, name, folder, previous,
+                                          key, item) or \
+                            self._wait_for_content(key, item, pool):
+                        continue
+                if pool:
+                    pool.submit(key, item, index, name, folder / file,
+                                key=key, size=item['fsize'],
+                                put_time=item['putTime'])
+                else:
+                    self._download_to_snapshot(key, item, index, name,
+                                               folder / file)
+        except ConnectionError:
+            self.logger('ERROR',
+                        'could not establish connection with cloud. Exit.')
+            raise SynchError('could not list bucket ' + self.bucketname)
+        finally:
+            if pool:
+                pool.join()
+                self.failed += pool.failed
+            self.metrics.pages_listed = lister.pages_listed
+
+    def _link_content(self, index, name, folder, previous, key, item):
+        """
+        link the content of key from another key with the same hash, in the
+        previous snapshot or in this one
+        :return: True if the file has been linked
+        """
+        hash = item.get('hash')
+        if hash is None or self.reuse_local == 'off':
+            return False
+        snapshots = [name] if previous is None else [name, previous.name]
+        for snapshot, other in index.find(hash, snapshots):
+            source = (folder if snapshot == name
+                      else self.localdir / snapshot) / self.encoding(other)
+            if self._link(source, folder / self.encoding(key)):
+                index.record(name, key, item['fsize'], hash)
+                self._count('reused', item['fsize'])
+                return True
+        return False
+
+    def _wait_for_content(self, key, item, pool):
+        """
+        :return: True if the content of item is being downloaded by a worker
+                 for another key, key is then linked from it when it is done
+        """
+        hash = item.get('hash')
+        if pool is None or hash is None or self.reuse_local == 'off':
+            return False
+        if hash in self.fetching:
+            self.fetching[hash].append((key, item))
+            return True
+        self.fetching[hash] = []
+        return False
+
+    def _download_to_snapshot(self, key, item, index, name, path):
+        try:
+            with self.metrics.phase('download'):
+                self.retry.call('download of ' + key,
+                                self._download_resumable, key, path,
+                                item['fsize'], item.get('hash'))
+        except OSError as e:  # ConnectionError, or a local error
+            self.logger('ERROR', 'The file has failed to download (' + str(e)
+                        + '), it will be tried again on the next run')
+            with self.lock:
+                self.failed += 1
+                waiting = self.fetching.pop(item.get('hash'), [])
+            # the keys waiting for the content try on their own
+            for other, other_item in waiting:
+                self._download_to_snapshot(other, other_item, index, name,
+                                           path.parent / self.encoding(other))
+            return
+        index.record(name, key, item['fsize'], item.get('hash'))
+        with self.lock:
+            waiting = self.fetching.pop(item.get('hash'), [])
+        for other, other_item in waiting:
+            self._link(path, path.parent / self.encoding(other))
+            index.record(name, other, other_item['fsize'],
+                         other_item.get('hash'))
+            self._count('reused', other_item['fsize'])
+
+    def _link(self, source, path):
+        """
+        hard-link source to path, or copy it where hard links are not
+        possible (other file system, too many links)
+        :return: False if source is missing
+        """
+        try:
+            if path.exists():
+                path.unlink()
+            os.link(str(source), str(path))
+        except FileNotFoundError:
+            return False
+        except OSError:
+            shutil.copy2(str(source), str(path))
+        return True
+
+    def prune_snapshots(self, index):
+        """
+        delete the complete snapshots that the keep_daily, keep_weekly and
+        keep_monthly policy does not retain. All three set to 0 keeps every
+        snapshot.
+        """
+        if not any(self.keep.values()):
+            return
+        complete = [s for s in index.snapshots() if s.complete]
+        keep = retained(complete, **self.keep)
+        for snapshot in complete:
+            if snapshot.name in keep:
+                continue
+            self.logger('INFO', 'pruning snapshot ' + snapshot.name)
+            shutil.rmtree(str(self.localdir / snapshot.name),
+                          ignore_errors=True)
+            index.remove(snapshot.name)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Local computation of the Qiniu etag (qetag), the `hash` field of a listing.
+
+The content is cut into 4 MB blocks and each block is hashed with SHA-1.
+A file of a single block gets 0x16 + sha1(block); a bigger file gets
+0x96 + sha1(sha1(block 1) + sha1(block 2) + ...). The result is encoded in
+url-safe base64.
+"""
+
+import hashlib
+import mmap
+import os
+from base64 import urlsafe_b64encode
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class QEtag:
+    """
+    incremental qetag, fed with data of any length as it arrives
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.blocks = []
+        self.current = hashlib.sha1()
+        self.filled = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            room = BLOCK_SIZE - self.filled
+            self.current.update(view[:room])
+            self.filled += min(room, len(view))
+            view = view[room:]
+            if self.filled == BLOCK_SIZE:
+                self.blocks.append(self.current.digest())
+                self.current = hashlib.sha1()
+                self.filled = 0
+
+    def update_from(self, file, size):
+        """
+        feed the first `size` bytes of an open binary file
+        """
+        file.seek(0)
+        while size > 0:
+            data = file.read(min(size, BLOCK_SIZE))
+            if not data:
+                break
+            self.update(data)
+            size -= len(data)
+
+    def hexdigest(self):
+        """
+        :return: the qetag of the data fed so far
+        """
+        blocks = list(self.blocks)
+        if self.filled or not blocks:
+            blocks.append(self.current.digest())
+        if len(blocks) == 1:
+            digest = b'\x16' + blocks[0]
+        else:
+            digest = b'\x96' + hashlib.sha1(b''.join(blocks)).digest()
+        return urlsafe_b64encode(digest).decode()
+
+
+def qetag(path):
+    """
+    :param path: path of a local file
+    :return: the qetag of the file content. The file is mapped in memory and
+             hashed straight from the page cache, without copying it block
+             by block into Python bytes.
+    """
+    etag = QEtag()
+    with open(str(path), 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:  # cannot map an empty file
+            return etag.hexdigest()
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if hasattr(data, 'madvise'):
+                data.madvise(mmap.MADV_SEQUENTIAL)
+            etag.update(data)
+    return etag.hexdigest()
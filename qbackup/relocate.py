@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Server-side copies and moves in place of uploads (scaled engine).
+
+A local file whose key is not in the bucket would be uploaded, even when it
+is only a renamed or duplicated copy of a key the bucket already holds.
+`Relocator` looks the qetag of every such file up in the manifest first:
+
+- a key with the same content whose local file has disappeared since its
+  last synch was renamed locally: it is moved to the new key, so the old
+  key is not downloaded back either
+- any other key with the same content is copied to the new key
+
+The manifest may be out of date, so the sources are checked first with
+batched stat operations, and only the ones whose content is still the same
+are copied or moved. The copies are sent before the moves, since a key can
+be the source of both. Every batch request carries up to BATCH operations,
+so reorganizing a folder costs a few requests instead of uploading every
+file again. A key that could not be copied or moved is uploaded as usual.
+"""
+
+import json
+import time
+
+from qiniu import BucketManager, build_batch_copy, build_batch_move, \
+    build_batch_stat
+
+from qbackup.retry import HTTPStatusError
+
+COPY = 'copy'
+MOVE = 'move'
+
+
+class Relocator:
+    BATCH = 1000  # operations per batch request, the most Qiniu accepts
+
+    def __init__(self, backup, manifest, hashes):
+        """
+        :param backup: QiniuBackupScaled of the bucket
+        :param manifest: SyncManifest of the bucket
+        :param hashes: HashCache of the local qetags
+        """
+        self.backup = backup
+        self.manifest = manifest
+        self.hashes = hashes
+        self.logger = backup.logger
+        self.bucket = BucketManager(backup.auth)
+        self.requests = 0
+
+    def run(self, local_files):
+        """
+        copy or move, in the bucket, the content of the local files that
+        are new to it, and record the keys done in the manifest
+        :param local_files: dict mapping local file names to stat results
+        :return: the set of keys copied or moved
+        """
+        plan = self.plan(local_files)
+        if not plan:
+            return set()
+        try:
+            current = self._stat_sources(sorted({op[1] for op in plan}))
+            plan = [op for op in plan if current.get(op[1]) == op[4]]
+            done = self._apply([op for op in plan if op[0] == COPY])
+            done |= self._apply([op for op in plan if op[0] == MOVE])
+        except ConnectionError as e:
+            self.logger('ERROR', 'server-side copies failed (' + str(e)
+                        + '), the files are uploaded instead')
+            return set()
+        finally:
+            self.manifest.commit()
+        if done:
+            self.logger('INFO', str(len(done)) + ' new local files found '
+                        'in the bucket, copied or moved in '
+                        + str(self.requests) + ' requests')
+        return done
+
+    def plan(self, local_files):
+        """
+        :param local_files: dict mapping local file names to stat results
+        :return: list of (COPY or MOVE, source key, target key, stat of the
+                 local file, qetag), by target key
+        """
+        backup = self.backup
+        plan = []
+        moved = set()
+        for file in sorted(local_files):
+            key = backup.decoding(file)
+            stat = local_files[file]
+            entry = self.manifest.get(key)
+            if entry is not None and entry.fsize is not None:
+                continue  # the key is in the bucket already
+            if not backup.filter.wants_key(key) or \
+                    not backup.filter.wants_stat(stat):
+                continue
+            hash = self.hashes.hash_file(backup.localdir / file, stat)
+            sources = [source for source in self.manifest.by_hash(hash)
+                       if source.key != key]
+            if not sources:
+                continue
+            for source in sources:
+                if source.key not in moved and self._renamed(source):
+                    moved.add(source.key)
+                    plan.append((MOVE, source.key, key, stat, hash))
+                    break
+            else:
+                plan.append((COPY, sources[0].key, key, stat, hash))
+        return plan
+
+    def _renamed(self, entry):
+        """
+        :return: True if the local file of entry was synched and has been
+                 removed since
+        """
+        backup = self.backup
+        return entry.local_size is not None \
+            and backup.filter.wants_key(entry.key) \
+            and not (backup.localdir / backup.encoding(entry.key)).exists()
+
+    def _stat_sources(self, keys):
+        """
+        :return: dict mapping the keys still in the bucket to their qetag
+        """
+        current = {}
+        for start in range(0, len(keys), self.BATCH):
+            chunk = keys[start:start + self.BATCH]
+            results = self._batch(build_batch_stat(self.backup.bucketname,
+                                                   chunk))
+            for key, result in zip(chunk, results):
+                if result.get('code') == 200:
+                    current[key] = result['data'].get('hash')
+        return current
+
+    def _apply(self, plan):
+        """
+        send the operations of plan, all of the same kind, by batch
+        :return: the set of target keys done
+        """
+        done = set()
+        for start in range(0, len(plan), self.BATCH):
+            chunk = plan[start:start + self.BATCH]
+            build = build_batch_copy if chunk[0][0] == COPY \
+                else build_batch_move
+            operations = []
+            for op in chunk:
+                operations.extend(build(self.backup.bucketname,
+                                        {op[1]: op[2]}, None))
+            results = self._batch(operations)
+            for (kind, source, target, stat, hash), result in zip(chunk,
+                                                                  results):
+                code = result.get('code')
+                if code != 200:
+                    self.logger('DEBUG', kind + ' of ' + source + ' to '
+                                + target + ' failed with ' + str(code))
+                    continue
+                self._record(kind, source, target, stat, hash)
+                done.add(target)
+        return done
+
+    def _record(self, kind, source, target, stat, hash):
+        manifest = self.manifest
+        self.logger('INFO', source + (' moved' if kind == MOVE else ' copied')
+                    + ' to ' + target)
+        manifest.record_remote(target, stat.st_size,
+                               int(time.time() * 10e6), hash)
+        manifest.record_local(target, stat.st_mtime, stat.st_size)
+        manifest.clear_pending(target)
+        if kind == MOVE:
+            manifest.forget(source)
+        self.backup._count('moved' if kind == MOVE else 'copied',
+                           stat.st_size)
+
+    def _batch(self, operations):
+        self.requests += 1
+        return self.backup.retry.call('batch of ' + str(len(operations))
+                                      + ' operations', self._batch_once,
+                                      operations)
+
+    def _batch_once(self, operations):
+        """
+        :return: the list of results, one dict per operation
+        """
+        ret, info = self.bucket.batch(operations)
+        if ret is None:
+            status = info.status_code if info is not None else -1
+            if status != 298:  # 298: some of the operations failed
+                raise HTTPStatusError(status, 'batch request failed')
+            ret = json.loads(info.text_body)
+        return ret
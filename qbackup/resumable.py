@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Parallel resumable upload of big files.
+
+`qiniu.put_file` sends the 4 MB blocks of a big file one after the other.
+`BlockUploader` speaks the same mkblk/mkfile protocol but uploads several
+blocks at the same time. The file is memory-mapped and every block is sent
+straight from a memoryview of the mapping, without copying it, and its CRC32
+is computed once and checked against the server's answer.
+
+The context returned for every finished block is saved in a small state file,
+so an upload that is interrupted can be resumed later without sending the
+completed blocks again (as long as the contexts have not expired, which
+Qiniu does after a few days).
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests as req
+from qiniu import urlsafe_base64_encode
+
+from qbackup.qetag import BLOCK_SIZE
+from qbackup.retry import HTTPStatusError, RetryPolicy
+from qbackup.tracing import NULL_TRACER
+
+
+class BlockUploader:
+    MAX_ATTEMPT = 3  # per block
+    EXPIRY_MARGIN = 3600  # sec, don't reuse contexts about to expire
+
+    def __init__(self, token, key, path, host, workers=4, state_dir=None,
+                 mime_type=None, params=None, budget=None, retry=None,
+                 tracer=None, logger=None):
+        """
+        :param token: upload token
+        :param key: key of the uploaded file
+        :param path: path of the local file
+        :param host: upload host, eg. 'http://up.qiniu.com'
+        :param workers: number of blocks uploaded at the same time
+        :param state_dir: where to save the block contexts, None to disable
+        :param mime_type: mime type of the file
+        :param params: custom variables, eg. {'x:a': 'a'}
+        :param budget: TransferBudget every block request goes through
+        :param retry: RetryPolicy of the block requests, by default
+                      MAX_ATTEMPT attempts per block
+        :param tracer: Tracer recording a span per block request
+        :param logger: EventLogger
+        """
+        self.token = token
+        self.key = key
+        self.path = Path(path)
+        self.host = host.rstrip('/')
+        self.workers = max(1, workers)
+        self.mime_type = mime_type
+        self.params = params or {}
+        self.budget = budget
+        self.logger = logger or (lambda tag, msg: None)
+        self.retry = retry if retry is not None \
+            else RetryPolicy(self.MAX_ATTEMPT, logger=self.logger)
+        self.tracer = tracer if tracer is not None else NULL_TRACER
+
+        self.stat = self.path.stat()
+        self.size = self.stat.st_size
+        self.nblocks = (self.size + BLOCK_SIZE - 1) // BLOCK_SIZE
+        self.state_file = None
+        if state_dir is not None:
+            state_dir = Path(state_dir)
+            if not state_dir.exists():
+                state_dir.mkdir(parents=True)
+            ident = '\0'.join([key, str(self.path.resolve()), str(self.size),
+                               str(self.stat.st_mtime_ns)])
+            self.state_file = state_dir / (
+                hashlib.sha1(ident.encode()).hexdigest() + '.json')
+        self.contexts = self._load_state()
+        self.lock = threading.Lock()
+
+    def upload(self):
+        """
+        :except ConnectionError: a block or the final mkfile failed
+        :return: the response of mkfile, {'hash': ..., 'key': ...}
+        """
+        pending = [i for i in range(self.nblocks) if i not in self.contexts]
+        if len(pending) < self.nblocks:
+            self.logger('INFO', 'resuming upload of ' + self.key + ', '
+                        + str(self.nblocks - len(pending)) + ' of '
+                        + str(self.nblocks) + ' blocks already sent')
+
+        with open(str(self.path), 'rb') as file, \
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    futures = [executor.submit(self._upload_block, view, i)
+                               for i in pending]
+                    for future in futures:
+                        future.result()  # raises the first failure
+            finally:
+                view.release()
+
+        ret = self._make_file()
+        if self.state_file is not None and self.state_file.exists():
+            self.state_file.unlink()
+        return ret
+
+    def _upload_block(self, view, index):
+        start = index * BLOCK_SIZE
+        block = view[start:start + BLOCK_SIZE]
+        crc = zlib.crc32(block) & 0xffffffff  # computed once per block
+        try:
+            ret = self.retry.call(
+                'block ' + str(index) + ' of ' + self.key,
+                self._make_block, block, crc)
+        finally:
+            block.release()
+        self._save_context(index, ret)
+
+    def _make_block(self, block, crc):
+        with self.tracer.span('mkblk', size=len(block)):
+            ret = self._post('{0}/mkblk/{1}'.format(self.host, len(block)),
+                             block)
+        if ret.get('crc32') != crc:
+            raise ConnectionError('block was corrupted in transit')
+        return ret
+
+    def _make_file(self):
+        url = ['{0}/mkfile/{1}'.format(self.host, self.size),
+               'key/' + urlsafe_base64_encode(self.key)]
+        if self.mime_type:
+            url.append('mimeType/' + urlsafe_base64_encode(self.mime_type))
+        for name, value in self.params.items():
+            url.append(name + '/' + urlsafe_base64_encode(str(value)))
+        body = ','.join(self.contexts[i]['ctx'] for i in range(self.nblocks))
+        with self.tracer.span('mkfile', blocks=self.nblocks):
+            return self.retry.call('mkfile of ' + self.key, self._post,
+                                   '/'.join(url), body.encode())
+
+    def _post(self, url, data):
+        headers = {'Authorization': 'UpToken ' + self.token,
+                   'Content-Type': 'application/octet-stream'}
+        try:
+            if self.budget is None:
+                res = req.post(url, data=data, headers=headers)
+            else:
+                with self.budget.transfer() as transfer:
+                    transfer.consume(len(data))
+                    res = req.post(url, data=data, headers=headers)
+                    transfer.status(res.status_code)
+        except req.exceptions.RequestException as e:
+            raise ConnectionError(str(e))
+        if res.status_code != 200:
+            raise HTTPStatusError(res.status_code)
+        return res.json()
+
+    def _load_state(self):
+        if self.state_file is None or not self.state_file.exists():
+            return {}
+        try:
+            with open(str(self.state_file)) as state:
+                contexts = json.load(state)
+        except ValueError:
+            return {}
+        deadline = time.time() + self.EXPIRY_MARGIN
+        return {int(i): ctx for i, ctx in contexts.items()
+                if ctx.get('expired_at', 0) > deadline}
+
+    def _save_context(self, index, ret):
+        with self.lock:  # several blocks may finish at the same time
+            self.contexts[index] = {'ctx': ret['ctx'],
+                                    'expired_at': ret.get('expired_at', 0)}
+            if self.state_file is None:
+                return
+            temp = self.state_file.with_name(self.state_file.name + '.tmp')
+            with open(str(temp), 'w') as state:
+                json.dump(self.contexts, state)
+            os.replace(str(temp), str(self.state_file))
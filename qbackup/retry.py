@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Retry policy shared by the listing, the downloads and the uploads.
+
+A failed request is retried only if the failure may go away by itself: the
+network dropped, the request timed out, or the server answered 408, 429 or
+5xx. Anything else (404, 401, ...) is fatal and raised at once. Retries
+wait an exponentially growing delay with full jitter, so that many workers
+failing together do not come back together.
+
+An error a call has given up on is not retried by an enclosing call, so
+the block requests of an upload, retried one by one, are not tried again
+as a whole: a failing block costs at most max_attempts requests, counted
+once.
+
+When most of the recent requests fail, the `CircuitBreaker` opens and every
+worker pauses for a while instead of hammering an endpoint that is down.
+"""
+
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+
+
+class HTTPStatusError(ConnectionError):
+    """
+    the server answered with an unexpected status
+    """
+
+    def __init__(self, status, message=None):
+        super(HTTPStatusError, self).__init__(
+            message or 'Remote server returned status ' + str(status))
+        self.status = status
+
+
+def retryable(error):
+    """
+    :param error: exception raised by a request
+    :return: True if trying again may succeed
+    """
+    if getattr(error, 'exhausted', False):
+        return False  # a nested call already retried it
+    if isinstance(error, HTTPStatusError):
+        # the SDK reports -1 when no response was received at all
+        return error.status in (-1, 408, 429) or error.status >= 500
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+class CircuitBreaker:
+    """
+    opens when at least `threshold` of the last `window` requests failed,
+    then holds every caller for `cooldown` seconds
+    """
+
+    def __init__(self, threshold=0.5, window=20, cooldown=30):
+        self.threshold = threshold
+        self.outcomes = deque(maxlen=window)
+        self.cooldown = cooldown
+        self.open_until = 0
+        self.lock = threading.Lock()
+        self.trips = 0
+        self.paused = 0.0  # sec, summed over the callers held
+
+    def record(self, success):
+        """
+        :return: True if this outcome opened the breaker
+        """
+        with self.lock:
+            self.outcomes.append(success)
+            if len(self.outcomes) < self.outcomes.maxlen:
+                return False
+            failures = self.outcomes.count(False)
+            if failures < self.threshold * len(self.outcomes):
+                return False
+            self.open_until = time.monotonic() + self.cooldown
+            self.outcomes.clear()  # start over once the pause is done
+            self.trips += 1
+            return True
+
+    def wait(self):
+        """
+        block while the breaker is open
+        """
+        delay = self._pause()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def wait_async(self):
+        delay = self._pause()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _pause(self):
+        with self.lock:
+            delay = self.open_until - time.monotonic()
+            if delay > 0:
+                self.paused += delay
+        return delay
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=4, base_delay=0.5, max_delay=30,
+                 breaker=None, logger=None):
+        """
+        :param max_attempts: attempts per request, the first one included
+        :param base_delay: delay before the first retry, in sec, doubled
+                           for each further retry
+        :param max_delay: cap of the delay between two attempts, in sec
+        :param breaker: CircuitBreaker shared by the callers, None to disable
+        :param logger: EventLogger
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker
+        self.logger = logger or (lambda tag, msg: None)
+        self.lock = threading.Lock()
+        self.retries = 0  # attempts that failed and were tried again
+        self.backoff = 0.0  # sec spent waiting between attempts
+        self.given_up = 0
+
+    @classmethod
+    def from_options(cls, options, logger=None):
+        """
+        :param options: the [options] table of the config file
+        :param logger: EventLogger
+        :return: RetryPolicy built from `max_attempt`, `retry_delay`,
+                 `retry_max_delay` and `breaker_threshold` (0 disables the
+                 breaker), `breaker_window` and `breaker_cooldown`
+        """
+        breaker = None
+        if options.get('breaker_threshold', 0.5):
+            breaker = CircuitBreaker(options.get('breaker_threshold', 0.5),
+                                     options.get('breaker_window', 20),
+                                     options.get('breaker_cooldown', 30))
+        return cls(max_attempts=options.get('max_attempt', 4),
+                   base_delay=options.get('retry_delay', 0.5),
+                   max_delay=options.get('retry_max_delay', 30),
+                   breaker=breaker, logger=logger)
+
+    def call(self, what, func, *args):
+        """
+        call func(*args) until it succeeds, fails with a fatal error or runs
+        out of attempts
+        :param what: description of the request, for the log
+        :except: the last error raised by func
+        :return: the result of func
+        """
+        attempt = 1
+        while True:
+            if self.breaker is not None:
+                self.breaker.wait()
+            try:
+                result = func(*args)
+            except Exception as e:
+                time.sleep(self._failed(what, e, attempt))
+                attempt += 1
+                continue
+            if self.breaker is not None:
+                self.breaker.record(True)
+            return result
+
+    async def call_async(self, what, func, *args):
+        """
+        same as call, for a coroutine function, without blocking the loop
+        """
+        attempt = 1
+        while True:
+            if self.breaker is not None:
+                await self.breaker.wait_async()
+            try:
+                result = await func(*args)
+            except Exception as e:
+                await asyncio.sleep(self._failed(what, e, attempt))
+                attempt += 1
+                continue
+            if self.breaker is not None:
+                self.breaker.record(True)
+            return result
+
+    def _failed(self, what, error, attempt):
+        """
+        account for a failed attempt, re-raise the error if it must not be
+        retried
+        :return: the delay before the next attempt
+        """
+        if not retryable(error):
+            raise error
+        if self.breaker is not None and self.breaker.record(False):
+            self.logger('WARN', 'too many failures, pausing all transfers '
+                        'for ' + str(self.breaker.cooldown) + 's')
+        if attempt >= self.max_attempts:
+            with self.lock:
+                self.given_up += 1
+            error.exhausted = True
+            raise error
+        delay = random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        self.logger('WARN', what + ' failed (' + str(error) + '), '
+                    'attempt ' + str(attempt) + ' out of '
+                    + str(self.max_attempts) + ', retrying in '
+                    '{0:.1f}s'.format(delay))
+        with self.lock:
+            self.retries += 1
+            self.backoff += delay
+        return delay
+
+    def stats(self):
+        """
+        :return: dict of the retry counters of the run
+        """
+        return {'retries': self.retries,
+                'backoff': self.backoff,
+                'given_up': self.given_up,
+                'breaker_trips': self.breaker.trips if self.breaker else 0,
+                'paused': self.breaker.paused if self.breaker else 0.0}
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Order in which the queued transfers are handed to the workers.
+
+The transfers decided by the diff wait in two queues, one for small and one
+for large files. At most `large_workers` workers transfer a large file at
+the same time, so the other workers keep going through the small files
+instead of all waiting behind a few big streams. Once nothing more can be
+queued the limit is lifted, so that no worker stays idle at the end of the
+run.
+
+Within the queues the transfers go by priority: the keys starting with one
+of `priority_prefixes` first, in the order of the list, then in the
+`transfer_order` of the run:
+  - "listing": in the order of the listing (default)
+  - "newest": the most recently uploaded (or, for an upload, modified)
+    keys first
+  - "oldest": the least recently uploaded or modified keys first
+  - "smallest": the smallest files first
+The listing is streamed, so the order applies among the transfers queued
+at a time, at most `limit` of them.
+
+The time left for the queued transfers is estimated from the bytes queued
+and the rate of the transfers done so far, and logged now and then.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+ORDERS = {
+    'listing': lambda size, put_time: 0,
+    'newest': lambda size, put_time: -put_time,
+    'oldest': lambda size, put_time: put_time,
+    'smallest': lambda size, put_time: size,
+}
+
+
+class TransferScheduler:
+    LARGE_THRESHOLD = 16 * 1024  # KB, files at least this big are large
+    ETA_INTERVAL = 30  # sec between two estimates in the log
+
+    def __init__(self, limit, workers, large_threshold=LARGE_THRESHOLD * 1024,
+                 large_workers=None, order='listing', prefixes=(),
+                 logger=None):
+        """
+        :param limit: most transfers waiting in both queues together, a put
+                      blocks beyond
+        :param workers: number of workers taking the transfers
+        :param large_threshold: size in bytes from which a file is large
+        :param large_workers: most large transfers at once, half of the
+                              workers by default
+        :param order: one of ORDERS
+        :param prefixes: key prefixes transferred first, in this order
+        :param logger: EventLogger the estimates are logged to
+        """
+        self.limit = limit
+        self.large_threshold = large_threshold
+        self.large_workers = max(1, large_workers if large_workers
+                                 else workers // 2)
+        self.rank = ORDERS[order]
+        self.prefixes = tuple(prefixes)
+        self.logger = logger
+        self.small = []  # heaps of (priority, sequence, size, job)
+        self.large = []
+        self.sequence = itertools.count()
+        self.large_running = 0
+        self.running = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        # for the estimate of the time left
+        self.queued_bytes = 0
+        self.running_bytes = 0
+        self.done_bytes = 0
+        self.started = None
+        self.last_estimate = time.monotonic()
+
+    def priority(self, key, size, put_time=0):
+        """
+        :return: sort key of a transfer, the lowest goes first
+        """
+        for index, prefix in enumerate(self.prefixes):
+            if key.startswith(prefix):
+                break
+        else:
+            index = len(self.prefixes)
+        return index, self.rank(size, put_time)
+
+    def put(self, job, key, size, put_time=0):
+        """
+        queue a transfer, blocks while `limit` transfers are waiting
+        (backpressure)
+        :param job: what get returns for it
+        :param key: remote key
+        :param size: size of the file in bytes
+        :param put_time: time of the file (remote upload time, or local
+                         mtime for an upload), in 100 ns
+        """
+        heap = self.large if size >= self.large_threshold else self.small
+        entry = (self.priority(key, size, put_time), next(self.sequence),
+                 size, job)
+        with self.condition:
+            while len(self.small) + len(self.large) >= self.limit:
+                self.condition.wait()
+            if self.started is None:
+                self.started = time.monotonic()
+            heapq.heappush(heap, entry)
+            self.queued_bytes += size
+            self.condition.notify_all()
+
+    def get(self):
+        """
+        wait for the next transfer a worker may start
+        :return: (job, size), None once the scheduler is closed and empty
+        """
+        with self.condition:
+            while True:
+                heap = self._next_heap()
+                if heap is not None:
+                    break
+                if self.closed and not self.small and not self.large:
+                    return None
+                self.condition.wait()
+            _, _, size, job = heapq.heappop(heap)
+            if heap is self.large:
+                self.large_running += 1
+            self.running += 1
+            self.queued_bytes -= size
+            self.running_bytes += size
+            self.condition.notify_all()
+        return job, size
+
+    def done(self, size):
+        """
+        a transfer returned by get is over, whether it succeeded or not
+        """
+        with self.condition:
+            if size >= self.large_threshold:
+                self.large_running -= 1
+            self.running -= 1
+            self.running_bytes -= size
+            self.done_bytes += size
+            self.condition.notify_all()
+            estimate = self._estimate()
+        if estimate and self.logger is not None:
+            self.logger('INFO', estimate)
+
+    def close(self):
+        """
+        nothing more will be queued, the workers stop once the queues are
+        empty
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def eta(self):
+        """
+        :return: sec left to transfer what is queued or running at the rate
+                 so far, None before any transfer is done
+        """
+        with self.condition:
+            return self._eta()
+
+    def _next_heap(self):
+        """
+        :return: the heap of the transfer to start next, None if none may
+                 start now
+        """
+        large_allowed = self.large and (
+            self.closed or self.large_running < self.large_workers)
+        if self.small and large_allowed:
+            return self.small if self.small[0] < self.large[0] \
+                else self.large
+        if self.small:
+            return self.small
+        return self.large if large_allowed else None
+
+    def _eta(self):
+        if not self.done_bytes:
+            return None
+        rate = self.done_bytes / (time.monotonic() - self.started)
+        return (self.queued_bytes + self.running_bytes) / rate
+
+    def _estimate(self):
+        """
+        :return: a line for the log every ETA_INTERVAL, None in between
+        """
+        now = time.monotonic()
+        if now - self.last_estimate < self.ETA_INTERVAL:
+            return None
+        self.last_estimate = now
+        eta = self._eta()
+        if not eta:
+            return None
+        return '{0} transfers ({1:.1f} MB) queued or running, about {2:.0f}s ' \
+            'left'.format(len(self.small) + len(self.large) + self.running,
+                          (self.queued_bytes + self.running_bytes) / 2 ** 20,
+                          eta)
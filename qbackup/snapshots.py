@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Point-in-time snapshots of a bucket.
+
+In snapshot mode every run writes the bucket into a new dated directory
+under the local folder. A file whose content has not changed since the
+previous snapshot is hard-linked from it, like rsync --link-dest, so an
+unchanged file costs a directory entry instead of a copy. So is a file whose
+content is found under another key, renamed or duplicated.
+
+`SnapshotIndex` records the snapshots and the hash of every file in each of
+them. The files of the previous snapshot are looked up in the index, never
+by walking the snapshot, and pruning only reads the list of snapshots.
+"""
+
+import datetime
+import sqlite3
+import threading
+from collections import namedtuple
+from pathlib import Path
+
+Snapshot = namedtuple('Snapshot', ['name', 'created', 'complete'])
+
+
+class SnapshotIndex:
+    BATCH_SIZE = 500
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS snapshots (
+        name     TEXT PRIMARY KEY,
+        created  REAL,
+        complete INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS files (
+        snapshot TEXT,
+        key      TEXT,
+        fsize    INTEGER,
+        hash     TEXT,
+        PRIMARY KEY (snapshot, key)
+    );
+    CREATE INDEX IF NOT EXISTS files_by_hash ON files (hash);
+    """
+
+    def __init__(self, path):
+        """
+        :param path: location of the database file, created if necessary
+        """
+        self.path = Path(path)
+        if not self.path.parent.exists():
+            self.path.parent.mkdir(parents=True)
+        self.db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(self.SCHEMA)
+        self.db.commit()
+        self.lock = threading.Lock()  # shared by the download workers
+        self.pending = 0
+
+    @staticmethod
+    def path_for(directory, bucketname):
+        return Path(directory) / (bucketname + '.snapshots.sqlite')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+    def snapshots(self):
+        """
+        :return: list of every Snapshot, oldest first
+        """
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT name, created, complete FROM snapshots '
+                'ORDER BY created, name').fetchall()
+        return [Snapshot(name, created, bool(complete))
+                for name, created, complete in rows]
+
+    def latest(self):
+        """
+        :return: the most recent complete Snapshot, or None
+        """
+        complete = [s for s in self.snapshots() if s.complete]
+        return complete[-1] if complete else None
+
+    def unfinished(self):
+        """
+        :return: the Snapshot a failed run left incomplete, or None
+        """
+        unfinished = [s for s in self.snapshots() if not s.complete]
+        return unfinished[-1] if unfinished else None
+
+    def begin(self, name, created):
+        self._write('INSERT INTO snapshots (name, created) VALUES (?, ?)',
+                    (name, created))
+        self.commit()
+
+    def rename(self, old, new, created):
+        """
+        carry the files of an unfinished snapshot over to a new one
+        """
+        with self.lock:
+            self.db.execute('UPDATE snapshots SET name = ?, created = ? '
+                            'WHERE name = ?', (new, created, old))
+            self.db.execute('UPDATE files SET snapshot = ? '
+                            'WHERE snapshot = ?', (new, old))
+            self.db.commit()
+            self.pending = 0
+
+    def finish(self, name):
+        self._write('UPDATE snapshots SET complete = 1 WHERE name = ?',
+                    (name,))
+        self.commit()
+
+    def remove(self, name):
+        with self.lock:
+            self.db.execute('DELETE FROM files WHERE snapshot = ?', (name,))
+            self.db.execute('DELETE FROM snapshots WHERE name = ?', (name,))
+            self.db.commit()
+            self.pending = 0
+
+    def get(self, snapshot, key):
+        """
+        :return: (fsize, hash) of key in snapshot, or None
+        """
+        with self.lock:
+            return self.db.execute(
+                'SELECT fsize, hash FROM files WHERE snapshot = ? AND key = ?',
+                (snapshot, key)).fetchone()
+
+    def find(self, hash, snapshots):
+        """
+        :param hash: qetag to look for
+        :param snapshots: names of the snapshots to look in
+        :return: list of (snapshot, key) holding that content
+        """
+        marks = ', '.join('?' * len(snapshots))
+        with self.lock:
+            return self.db.execute(
+                'SELECT snapshot, key FROM files WHERE hash = ? '
+                'AND snapshot IN (' + marks + ')',
+                (hash,) + tuple(snapshots)).fetchall()
+
+    def record(self, snapshot, key, fsize, hash):
+        self._write('INSERT OR REPLACE INTO files (snapshot, key, fsize, hash) '
+                    'VALUES (?, ?, ?, ?)', (snapshot, key, fsize, hash))
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def _write(self, statement, args):
+        with self.lock:
+            self.db.execute(statement, args)
+            self.pending += 1
+            if self.pending >= self.BATCH_SIZE:
+                self.db.commit()
+                self.pending = 0
+
+
+def retained(snapshots, daily=0, weekly=0, monthly=0):
+    """
+    choose the snapshots to keep: the newest snapshot of each of the last
+    `daily` days, `weekly` ISO weeks and `monthly` months that have one. The
+    newest snapshot is always kept.
+    :param snapshots: complete Snapshots
+    :return: set of the names of the snapshots to keep
+    """
+    newest_first = sorted(snapshots, key=lambda s: s.created, reverse=True)
+    keep = {newest_first[0].name} if newest_first else set()
+    rules = ((daily, lambda d: d.date()),
+             (weekly, lambda d: d.isocalendar()[:2]),
+             (monthly, lambda d: (d.year, d.month)))
+    for count, period_of in rules:
+        periods = set()
+        for snapshot in newest_first:
+            if len(periods) >= count:
+                break
+            period = period_of(datetime.datetime.fromtimestamp(
+                snapshot.created))
+            if period not in periods:
+                periods.add(period)
+                keep.add(snapshot.name)
+    return keep
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Opt-in tracing of the transfers, in the Chrome trace event format.
+
+A `Tracer` records spans: a listing page, a download, an upload, and the
+steps inside them (time to first byte, body, fsync, rename, blocks...). Each
+span becomes a complete ("X") event of the JSON array format read by
+chrome://tracing and https://ui.perfetto.dev, with one row per thread.
+Events are streamed to the file as they end, so a trace of a long run does
+not stay in memory.
+
+The duration of every span also goes into a histogram per span name, with
+power-of-two buckets in milliseconds, written next to the trace with the
+count, mean and estimated percentiles of each name.
+
+When tracing is off, the engines use `NULL_TRACER`, which records nothing.
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+PERCENTILES = (50, 90, 99)
+
+
+class Histogram:
+    """
+    latency histogram, bucket i counts the durations in [2^(i-1), 2^i) ms
+    """
+    BUCKETS = 24  # up to 2^23 ms, about 2 hours
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, ms):
+        index = 0 if ms < 1 else min(int(math.log2(ms)) + 1,
+                                     self.BUCKETS - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += ms
+        self.min = ms if self.min is None else min(self.min, ms)
+        self.max = ms if self.max is None else max(self.max, ms)
+
+    def percentile(self, p):
+        """
+        :return: upper bound of the bucket holding the p-th percentile, in ms
+        """
+        rank = self.count * p / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(2.0 ** index, self.max)
+        return self.max
+
+    def to_dict(self):
+        result = {'count': self.count,
+                  'mean_ms': self.total / self.count if self.count else 0,
+                  'min_ms': self.min, 'max_ms': self.max,
+                  'buckets_ms': {'<{0}'.format(2 ** i): n
+                                 for i, n in enumerate(self.counts) if n}}
+        for p in PERCENTILES:
+            result['p{0}_ms'.format(p)] = self.percentile(p)
+        return result
+
+
+class Tracer:
+    def __init__(self, path):
+        """
+        :param path: trace file to write, the histograms go to
+                     <path without .json>.histograms.json
+        """
+        self.path = Path(path)
+        self.file = None
+        self.first = True
+        self.pid = os.getpid()
+        self.start = time.perf_counter()
+        self.histograms = {}
+        self.threads = set()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_bucket(cls, directory, bucket):
+        """
+        :param directory: where traces go, tracing is off if empty or None
+        :return: a Tracer writing <directory>/<bucket>.trace.json, or
+                 NULL_TRACER
+        """
+        if not directory:
+            return NULL_TRACER
+        return cls(Path(directory) / (bucket + '.trace.json'))
+
+    def __enter__(self):
+        if not self.path.parent.exists():
+            self.path.parent.mkdir(parents=True)
+        self.file = open(str(self.path), 'w')
+        self.file.write('[\n')
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write('\n]\n')
+            self.file.close()
+            self.file = None
+            histograms = {name: histogram.to_dict() for name, histogram
+                          in sorted(self.histograms.items())}
+        name = self.path.name
+        if name.endswith('.json'):
+            name = name[:-len('.json')]
+        with open(str(self.path.with_name(name + '.histograms.json')),
+                  'w') as file:
+            json.dump(histograms, file, indent=2)
+
+    @contextmanager
+    def span(self, name, cat='transfer', **args):
+        """
+        record the with block as a span
+        :param name: name of the span, and of its histogram
+        :param cat: category, to filter the spans in the viewer
+        :param args: shown with the span, more can be added to the dict
+                     returned by the with statement
+        """
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self._emit(name, cat, start, time.perf_counter(), args)
+
+    def _emit(self, name, cat, start, end, args):
+        thread = threading.current_thread()
+        event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': self.pid,
+                 'tid': thread.ident,
+                 'ts': (start - self.start) * 1e6,
+                 'dur': (end - start) * 1e6}
+        if args:
+            event['args'] = args
+        with self.lock:
+            if self.file is None:
+                return
+            if thread.ident not in self.threads:
+                self.threads.add(thread.ident)
+                self._write({'name': 'thread_name', 'ph': 'M',
+                             'pid': self.pid, 'tid': thread.ident,
+                             'args': {'name': thread.name}})
+            self._write(event)
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add((end - start) * 1e3)
+
+    def _write(self, event):
+        if not self.first:
+            self.file.write(',\n')
+        self.first = False
+        self.file.write(json.dumps(event, default=str))
+
+
+class NullTracer:
+    """
+    a Tracer that records nothing
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def close(self):
+        pass
+
+    @contextmanager
+    def span(self, name, cat='transfer', **args):
+        yield args
+
+
+NULL_TRACER = NullTracer()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Integrity check of a local folder against its bucket.
+
+Every key of the bucket listing must have a local file of the same size and
+the same qetag, and every local file must be in the listing. Only the keys
+the include/exclude rules of the bucket keep are checked. The listing is
+either made afresh or the one the last run saved in the manifest (scaled
+engine), which needs no request at all.
+
+The listing and the scan of the local folder are merge-joined in key order,
+like in the synch itself (see qbackup.diff). The files whose size matches
+are hashed by batch on a pool of processes, and the qetags are cached by
+stat signature in the HashCache shared with the synch, so a file that has
+not changed since the last synch or verification is not read again.
+"""
+
+from qbackup import diff
+from qbackup.manifest import SyncManifest
+from qbackup.qbackup import SynchError
+
+# problems reported for a key
+MISSING = 'missing'  # listed, but not in the local folder
+EXTRA = 'extra'  # in the local folder, but not listed
+SIZE = 'size'  # sizes differ
+HASH = 'hash'  # same size, different content
+
+
+class Verifier:
+    BATCH = 1024  # files handed to the hashing processes at once
+
+    def __init__(self, backup, hashes, manifest_path=None):
+        """
+        :param backup: engine of the bucket, it knows the layout of the
+                       local folder and how to list the bucket
+        :param hashes: HashCache of the local qetags
+        :param manifest_path: compare with the listing saved in this
+                              manifest instead of listing the bucket
+        """
+        self.backup = backup
+        self.hashes = hashes
+        self.manifest_path = manifest_path
+        self.checked = 0
+        self.mismatches = 0
+
+    def __iter__(self):
+        """
+        :except SynchError: there is no saved listing, or the bucket could
+                            not be listed
+        :return: generator of a dict per mismatch, in key order, with the
+                 key, the problem, the local path, and the size and hash on
+                 each side (None where unknown)
+        """
+        if self.manifest_path is not None:
+            if not self.manifest_path.exists():
+                raise SynchError('no saved listing of '
+                                 + self.backup.bucketname + ' in '
+                                 + str(self.manifest_path))
+            with SyncManifest(self.manifest_path) as manifest:
+                yield from self._compare(self._saved_listing(manifest))
+        else:
+            try:
+                yield from self._compare(self.backup._remote_listing())
+            except ConnectionError:
+                raise SynchError('could not list bucket '
+                                 + self.backup.bucketname)
+
+    def _saved_listing(self, manifest):
+        for entry in manifest:
+            if entry.fsize is not None and \
+                    self.backup.filter.wants_key(entry.key):
+                yield {'key': entry.key, 'fsize': entry.fsize,
+                       'putTime': entry.put_time, 'hash': entry.hash}
+
+    def _compare(self, listing):
+        batch = []
+        key_filter = self.backup.filter
+        for key, item, entry in diff.merge_join(listing,
+                                                self.backup._scan_local()):
+            if key_filter.active and not key_filter.wants_copies(item, entry):
+                continue
+            self.checked += 1
+            batch.append((key, item, entry))
+            if len(batch) >= self.BATCH:
+                yield from self._check(batch)
+                batch = []
+        yield from self._check(batch)
+
+    def _check(self, batch):
+        """
+        hash the files of the batch that need it, all at once, then report
+        the mismatches of the batch in order
+        """
+        local_hashes = self.hashes.hash_many(
+            (entry[1], entry[2]) for _, item, entry in batch
+            if item is not None and entry is not None
+            and item.get('hash') is not None
+            and item['fsize'] == entry[2].st_size)
+        for key, item, entry in batch:
+            mismatch = {'key': key, 'problem': None,
+                        'path': entry and entry[1],
+                        'remote_size': item and item['fsize'],
+                        'local_size': entry and entry[2].st_size,
+                        'remote_hash': item and item.get('hash'),
+                        'local_hash': entry and local_hashes.get(entry[1])}
+            if entry is None:
+                mismatch['problem'] = MISSING
+            elif item is None:
+                mismatch['problem'] = EXTRA
+            elif item['fsize'] != entry[2].st_size:
+                mismatch['problem'] = SIZE
+            elif mismatch['remote_hash'] is not None and \
+                    mismatch['local_hash'] != mismatch['remote_hash']:
+                mismatch['problem'] = HASH
+            else:
+                continue
+            self.mismatches += 1
+            yield mismatch
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Continuous upload of the local changes of a bucket (Linux only).
+
+Instead of synching the whole bucket to find a few new files, `Watcher`
+keeps an inotify watch on the local folder. A file that is created,
+written or moved in is uploaded a few seconds after its last event, so a
+burst of writes to the same file costs a single upload.
+
+On startup, the local folder is compared with the manifest of the scaled
+engine, without listing the bucket, and the files that changed since the
+last run are uploaded. Every `sweep_interval` seconds a full synch brings
+the remote changes down.
+"""
+
+import threading
+import time
+
+from qiniu import BucketManager
+
+from qbackup.hashcache import HashCache
+from qbackup.inotify import Inotify, IN_CLOSE_WRITE, IN_CREATE, IN_ISDIR, \
+    IN_MODIFY, IN_MOVED_TO, IN_Q_OVERFLOW
+from qbackup.manifest import SyncManifest
+from qbackup.qbackup import QiniuBackup, SynchError
+from qbackup.qbackup_scaled import QiniuBackupScaled
+from qbackup.relocate import Relocator
+from qbackup.retry import HTTPStatusError
+
+
+class Watcher:
+    EVENTS = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MODIFY | IN_CREATE
+    DEBOUNCE = 2  # sec without event before a file is uploaded
+    MAX_DELAY = 10  # debounce periods a busy file can be held back
+    # a file that failed for a local reason is tried again after this many
+    # debounce periods
+    RETRY_DELAY = 10
+    SWEEP_INTERVAL = 3600  # sec between two full synchs
+    POLL = 1  # sec, how often the stop event is checked
+
+    def __init__(self, backup, options, stop=None):
+        """
+        :param backup: QiniuBackupScaled of the bucket, without snapshots
+        :param options: options of the bucket
+        :param stop: threading.Event that ends the watch
+        :except SynchError: the engine of the bucket has no manifest
+        """
+        if not isinstance(backup, QiniuBackupScaled) or backup.snapshots:
+            raise SynchError('watch needs the scaled engine, without '
+                             'snapshots')
+        self.backup = backup
+        self.logger = backup.logger
+        self.debounce = options.get('watch_debounce', self.DEBOUNCE)
+        self.sweep_interval = options.get('sweep_interval',
+                                          self.SWEEP_INTERVAL)
+        self.stop = stop if stop is not None else threading.Event()
+        self.manifest_path = SyncManifest.path_for(backup.manifest_dir,
+                                                   backup.bucketname)
+        self.bucket = BucketManager(backup.auth)
+        self.due = {}  # file name -> (first event, time to upload it)
+        self.uploaded = 0
+
+    def run(self):
+        """
+        watch the local folder until `stop` is set
+        """
+        self.backup.validate_local_folder()
+        with Inotify() as inotify:
+            # watch first, so nothing written during the reconciliation is
+            # missed
+            inotify.add_watch(self.backup.localdir, self.EVENTS)
+            self.reconcile()
+            next_sweep = time.monotonic() + self.sweep_interval \
+                if self.sweep_interval else None
+            self.logger('INFO', 'watching ' + str(self.backup.localdir))
+            while not self.stop.is_set():
+                for event in inotify.read(self._timeout(next_sweep)):
+                    if event.mask & IN_Q_OVERFLOW:
+                        self.logger('WARNING', 'too many events, checking '
+                                    'the whole folder')
+                        self.reconcile()
+                    elif event.name and not event.mask & IN_ISDIR:
+                        self._touch(event.name)
+                self.flush()
+                if next_sweep is not None and \
+                        time.monotonic() >= next_sweep:
+                    self.sweep()
+                    next_sweep = time.monotonic() + self.sweep_interval
+        self.logger('INFO', 'stopped watching ' + str(self.backup.localdir)
+                    + ', ' + str(self.uploaded) + ' files uploaded')
+
+    def reconcile(self):
+        """
+        queue every local file that changed since the manifest last
+        recorded it, without listing the bucket
+        """
+        now = time.monotonic()
+        with SyncManifest(self.manifest_path) as manifest:
+            for name, stat in self.backup._scan_local_files().items():
+                entry = manifest.get(self.backup.decoding(name))
+                if not SyncManifest.local_unchanged(entry, stat):
+                    self.due[name] = (now, now)
+        if self.due:
+            self.logger('INFO', str(len(self.due)) + ' local files changed '
+                        'since the last run')
+
+    def sweep(self):
+        """
+        full synch of the bucket, the keys it uploads are recorded in the
+        manifest and not uploaded again
+        """
+        self.logger('INFO', 'sweeping ' + self.backup.bucketname)
+        try:
+            self.backup.synch()
+        except (SynchError, ConnectionError) as e:
+            self.logger('ERROR', 'sweep of ' + self.backup.bucketname
+                        + ' failed: ' + str(e))
+
+    def flush(self):
+        """
+        upload the files whose debounce period is over, or copy them within
+        the bucket when their content is already there (a renamed file)
+        """
+        now = time.monotonic()
+        ready = sorted(name for name, (_, due) in self.due.items()
+                       if due <= now)
+        if not ready:
+            return
+        with SyncManifest(self.manifest_path) as manifest, \
+                HashCache(self.backup.hash_cache, 1, self.backup.tracer,
+                          self.logger) as hashes:
+            if self.backup.server_side_copy:
+                try:
+                    Relocator(self.backup, manifest, hashes).run(
+                        self._stat_files(ready))
+                except Exception as e:
+                    self.logger('WARNING', 'server-side copies skipped ('
+                                + repr(e) + ')')
+            for name in ready:
+                del self.due[name]
+                try:
+                    self._upload(manifest, hashes, name)
+                except ConnectionError as e:
+                    self.logger('ERROR', 'upload of ' + name + ' failed ('
+                                + str(e) + '), it is left to the next sweep')
+                except Exception as e:
+                    # say the file is still being written: one bad file
+                    # must not stop the watch
+                    self.logger('ERROR', 'upload of ' + name + ' failed ('
+                                + repr(e) + '), it will be tried again')
+                    now = time.monotonic()
+                    self.due[name] = (now,
+                                      now + self.debounce * self.RETRY_DELAY)
+
+    def _touch(self, name):
+        if name.endswith(QiniuBackup.PART_SUFFIX):
+            return
+        now = time.monotonic()
+        first = self.due.get(name, (now, None))[0]
+        # a file written without pause is still uploaded now and then
+        self.due[name] = (first, min(now + self.debounce,
+                                     first + self.debounce * self.MAX_DELAY))
+
+    def _stat_files(self, names):
+        """
+        :return: dict mapping the names of the files still there to their
+                 stat result
+        """
+        files = {}
+        for name in names:
+            try:
+                files[name] = (self.backup.localdir / name).stat()
+            except FileNotFoundError:
+                pass
+        return files
+
+    def _timeout(self, next_sweep):
+        wake = [time.monotonic() + self.POLL]
+        wake.extend(due for _, due in self.due.values())
+        if next_sweep is not None:
+            wake.append(next_sweep)
+        return max(0, min(wake) - time.monotonic())
+
+    def _upload(self, manifest, hashes, name):
+        """
+        upload a local file, unless the manifest shows it is already in the
+        bucket (a download of the sweep, say), or the bucket has a newer
+        copy that was never synched
+        """
+        backup = self.backup
+        key = backup.decoding(name)
+        path = backup.localdir / name
+        try:
+            stat = path.stat()
+        except FileNotFoundError:  # gone again, or renamed
+            return
+        if not backup.filter.wants_key(key) or \
+                not backup.filter.wants_stat(stat):
+            return
+        entry = manifest.get(key)
+        if SyncManifest.local_unchanged(entry, stat):
+            return
+        local_hash = hashes.hash_file(path, stat)
+        if entry is not None and entry.hash == local_hash:
+            manifest.record_local(key, stat.st_mtime, stat.st_size)
+            return
+        if entry is None:
+            remote = backup.retry.call('stat of ' + key, self._stat, key)
+            if remote is not None and remote.get('hash') == local_hash:
+                manifest.record_remote(key, remote['fsize'],
+                                       remote['putTime'], local_hash)
+                manifest.record_local(key, stat.st_mtime, stat.st_size)
+                return
+            if remote is not None and QiniuBackup.compare_timestamp(
+                    remote['putTime'], stat.st_mtime) > 0:
+                self.logger('INFO', key + ' is newer in the bucket, it is '
+                            'left to the next sweep')
+                return
+
+        token = backup.auth.upload_token(backup.bucketname, key)
+        with backup.metrics.phase('upload'):
+            ret = backup.retry.call('upload of ' + key, backup._upload_file,
+                                    token, key, name, {'x:a': 'a'})
+        manifest.record_remote(key, stat.st_size, int(time.time() * 10e6),
+                               ret.get('hash'))
+        manifest.record_local(key, stat.st_mtime, stat.st_size)
+        manifest.clear_pending(key)
+        self.uploaded += 1
+
+    def _stat(self, key):
+        """
+        :return: the metadata of key in the bucket, None if it is not there
+        """
+        ret, info = self.bucket.stat(self.backup.bucketname, key)
+        if ret is None:
+            status = info.status_code if info is not None else -1
+            if status == 612:  # no such key
+                return None
+            raise HTTPStatusError(status, 'stat of ' + key + ' failed')
+        return ret
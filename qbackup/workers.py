@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+A small bounded thread pool used to run transfers concurrently.
+
+The producer (usually the bucket listing loop) only enqueues work. Because the
+queue is bounded, `submit` blocks when the workers fall behind, so the number
+of pending items never exceeds `queue_limit` no matter how large the bucket is.
+The order in which the workers take the items is up to a TransferScheduler,
+see qbackup.scheduler.
+"""
+
+import threading
+
+from qbackup.scheduler import TransferScheduler
+
+
+class WorkerPool:
+    def __init__(self, func, workers, queue_limit, logger, scheduler=None):
+        """
+        :param func: callable run by the workers, called as func(*args)
+        :param workers: number of worker threads
+        :param queue_limit: maximum number of pending (not yet started) items
+        :param logger: EventLogger used to report failures
+        :param scheduler: TransferScheduler of the items, in the order they
+                          are submitted if None
+        """
+        self.func = func
+        self.logger = logger
+        self.failed = 0  # jobs that raised, read it after join
+        self.lock = threading.Lock()
+        self.scheduler = scheduler if scheduler is not None else \
+            TransferScheduler(queue_limit, workers, large_workers=workers)
+        self.threads = [threading.Thread(target=self._run,
+                                         name='qbackup-worker-' + str(i),
+                                         daemon=True)
+                        for i in range(max(1, workers))]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, *args, key='', size=0, put_time=0):
+        """
+        enqueue a job, blocks while the queue is full (backpressure)
+        :param key: remote key, size and put_time of the file transferred,
+                    for the scheduler
+        """
+        self.scheduler.put(args, key, size, put_time)
+
+    def join(self):
+        """
+        wait for every submitted job to finish, then stop the workers
+        """
+        self.scheduler.close()
+        for thread in self.threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            taken = self.scheduler.get()
+            if taken is None:
+                return
+            args, size = taken
+            try:
+                self.func(*args)
+            except Exception as e:
+                # one bad file should never take a worker down with it
+                self.logger('ERROR', 'worker failed on ' + str(args[0])
+                            + ': ' + repr(e))
+                with self.lock:
+                    self.failed += 1
+            finally:
+                self.scheduler.done(size)
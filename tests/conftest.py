@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Fixtures of the tests: a FakeQiniu server and engines synching it with a
+temporary folder.
+
+usage, from the root of the repository:
+    python -m pytest tests
+"""
+
+import qiniu
+import pytest
+
+from bench.fakeqiniu import FakeBucket, FakeQiniu
+
+
+class RecordingLogger:
+    """
+    EventLogger stand-in that keeps the messages
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def __call__(self, tag, msg, **kwargs):
+        self.messages.append((tag, msg))
+
+    def tagged(self, tag):
+        return [msg for t, msg in self.messages if t == tag]
+
+
+@pytest.fixture
+def fake():
+    with FakeQiniu(FakeBucket()) as server:
+        server.configure_sdk()
+        yield server
+
+
+@pytest.fixture
+def local(tmp_path):
+    folder = tmp_path / 'local'
+    folder.mkdir()
+    return folder
+
+
+@pytest.fixture
+def make_backup(fake, local, tmp_path):
+    """
+    :return: function (engine class, **options) -> engine synching the
+             bucket of fake with local, with a RecordingLogger
+    """
+    def make(engine, **options):
+        settings = {'bucketname': 'b',
+                    'bucketurl': fake.bucketurl,
+                    'localdir': str(local),
+                    'manifest_dir': str(tmp_path / 'manifest'),
+                    'hash_cache': str(tmp_path / 'hashes.sqlite'),
+                    'upload_state_dir': str(tmp_path / 'uploads'),
+                    'metrics_dir': '',
+                    'breaker_threshold': 0,
+                    'retry_delay': 0}
+        settings.update(options)
+        logger = RecordingLogger()
+        return engine(settings, qiniu.Auth('access', 'secret'), logger)
+    return make
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Tests of the decision taken for each key, see qbackup.diff.
+"""
+
+import os
+
+import pytest
+
+from qbackup import diff
+
+OLD = 1000000000  # sec
+NEW = OLD + 3600
+
+
+def item(hash, put_time):
+    return {'key': 'k', 'fsize': 1, 'hash': hash,
+            'putTime': put_time * 10 ** 7}
+
+
+def entry(mtime):
+    return 'k', '/local/k', os.stat_result((0o100644, 1, 1, 1, 0, 0, 1, mtime,
+                                            mtime, mtime))
+
+
+def decide(remote, local, local_hash='local', synched=None):
+    return diff.decide(remote, local, lambda path, stat: local_hash,
+                       lambda path: synched)
+
+
+def test_one_side_only():
+    assert diff.decide(item('h', OLD), None) == diff.DOWNLOAD
+    assert diff.decide(None, entry(OLD)) == diff.UPLOAD
+
+
+def test_same_content_is_skipped():
+    assert decide(item('same', NEW), entry(OLD), 'same') == diff.SKIP
+
+
+@pytest.mark.parametrize('remote_time, local_time, expected', [
+    (NEW, OLD, diff.CONFLICT),  # never download over unknown local content
+    (OLD, NEW, diff.UPLOAD),
+])
+def test_without_history(remote_time, local_time, expected):
+    assert decide(item('remote', remote_time), entry(local_time)) == expected
+
+
+def test_the_side_that_changed_wins():
+    # edited locally, even with an older mtime
+    assert decide(item('base', NEW), entry(OLD), 'local', 'base') \
+        == diff.UPLOAD
+    # changed remotely, even with an older upload time
+    assert decide(item('remote', OLD), entry(NEW), 'base', 'base') \
+        == diff.DOWNLOAD
+
+
+def test_both_sides_changed():
+    assert decide(item('remote', NEW), entry(OLD), 'local', 'base') \
+        == diff.CONFLICT
+    assert decide(item('remote', OLD), entry(NEW), 'local', 'base') \
+        == diff.CONFLICT
+
+
+def test_without_hashes_timestamps_decide():
+    assert diff.decide(item(None, NEW), entry(OLD)) == diff.DOWNLOAD
+    assert diff.decide(item(None, OLD), entry(NEW)) == diff.SKIP
+
+
+def test_merge_join():
+    remote = [{'key': k} for k in ('a', 'b', 'd')]
+    local = [(k, None, None) for k in ('b', 'c', 'd')]
+    joined = [(key, r is not None, l is not None)
+              for key, r, l in diff.merge_join(remote, local)]
+    assert joined == [('a', True, False), ('b', True, True),
+                      ('c', False, True), ('d', True, True)]
+
+
+def test_merge_join_refuses_unsorted_streams():
+    with pytest.raises(ValueError):
+        list(diff.merge_join([{'key': 'b'}, {'key': 'a'}], []))
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Tests of the resumable downloads: a part file left by an interrupted run is
+continued with a Range request, and discarded if its content is wrong.
+"""
+
+import os
+
+import pytest
+
+from qbackup import qbackup
+from qbackup.qbackup import QiniuFlatBackup
+
+DATA = os.urandom(300 * 1024)
+
+
+@pytest.fixture
+def ranges(monkeypatch):
+    """
+    :return: the Range headers of the downloads, None for a whole file
+    """
+    sent = []
+    get = qbackup.req.get
+
+    def recording_get(url, headers=None, **kwargs):
+        if '/cdn/' in url:  # the SDK lists the bucket with requests too
+            sent.append((headers or {}).get('Range'))
+        return get(url, headers=headers, **kwargs)
+    monkeypatch.setattr(qbackup.req, 'get', recording_get)
+    return sent
+
+
+@pytest.mark.parametrize('chunk_size', [None, 64])
+def test_part_file_is_resumed(fake, local, make_backup, ranges, chunk_size):
+    fake.bucket.put('big', DATA)
+    (local / 'big.qbackup.part').write_bytes(DATA[:100000])
+    options = {'chunk_size': chunk_size, 'size_threshold': 128} \
+        if chunk_size else {}
+    make_backup(QiniuFlatBackup, **options).synch()
+    assert ranges == ['bytes=100000-']
+    assert (local / 'big').read_bytes() == DATA
+    assert not (local / 'big.qbackup.part').exists()
+
+
+def test_corrupted_part_file_is_downloaded_again(fake, local, make_backup,
+                                                  ranges):
+    fake.bucket.put('big', DATA)
+    (local / 'big.qbackup.part').write_bytes(b'x' * 100000)
+    make_backup(QiniuFlatBackup).synch()
+    assert ranges == ['bytes=100000-', None]
+    assert (local / 'big').read_bytes() == DATA
+
+
+def test_part_file_longer_than_the_remote_file(fake, local, make_backup,
+                                                ranges):
+    fake.bucket.put('small', DATA[:1000])
+    (local / 'small.qbackup.part').write_bytes(DATA[:2000])
+    make_backup(QiniuFlatBackup).synch()
+    assert ranges == [None]
+    assert (local / 'small').read_bytes() == DATA[:1000]
+
+
+def test_failed_download_keeps_its_part_file(fake, local, make_backup):
+    fake.bucket.put('big', DATA)
+    (local / 'big.qbackup.part').write_bytes(DATA[:100000])
+    fake.error_rate = 1.0
+    backup = make_backup(QiniuFlatBackup, max_attempt=1)
+    with pytest.raises(qbackup.SynchError):
+        backup.synch()
+    assert (local / 'big.qbackup.part').read_bytes() == DATA[:100000]
+    assert not (local / 'big').exists()
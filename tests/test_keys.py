@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Tests of the translation between keys and local paths.
+"""
+
+import pytest
+
+from qbackup.qbackup import QiniuBackup, QiniuFlatBackup
+
+KEYS = ['plain', 'a/b/c', '/leading', 'trailing/', 'a//b', '@', 'a@b/@@',
+        '.', '..', 'a/./b', 'a/../b', '@.', 'dir/@', u'unicode/中文',
+        'with space/and%2Fpercent']
+
+encode = QiniuBackup._QiniuBackup__encode_spec_character
+decode = QiniuBackup._QiniuBackup__decode_spec_characters
+
+
+@pytest.mark.parametrize('key', KEYS)
+def test_round_trip(key):
+    assert decode(encode(key)) == key
+
+
+@pytest.mark.parametrize('key', KEYS)
+def test_no_segment_escapes_the_folder(key):
+    assert all(segment not in ('', '.', '..')
+               for segment in encode(key).split('/'))
+
+
+def test_distinct_keys_have_distinct_paths():
+    assert len({encode(key) for key in KEYS}) == len(KEYS)
+
+
+def test_synch_round_trip(fake, local, make_backup):
+    """
+    keys downloaded into the nested layout are listed back from the local
+    folder under the same keys
+    """
+    for key in ('plain', 'a/b/c', '/leading', 'trailing/', 'a//b', '@',
+                'a@b/@@', '@.', 'dir/@', u'unicode/中文', 'with space'):
+        fake.bucket.put(key, key.encode('utf-8'))
+    backup = make_backup(QiniuBackup)
+    backup.synch()
+    assert sorted(key for key, _, _ in backup._scan_local()) \
+        == sorted(fake.bucket.objects)
+
+
+def test_flat_layout(make_backup):
+    backup = make_backup(QiniuFlatBackup)
+    for key in ('a/b/c', 'plain', '/x/'):
+        assert '/' not in backup.encoding(key)
+        assert backup.decoding(backup.encoding(key)) == key
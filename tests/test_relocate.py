@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Tests of the server-side copies and moves of the scaled engine, see
+qbackup.relocate.
+"""
+
+import os
+
+from qbackup.qbackup_scaled import QiniuBackupScaled
+
+DATA = os.urandom(5000)
+
+
+def synched(fake, make_backup, **options):
+    """
+    :return: an engine, after a first synch of the bucket with 'a' and 'b'
+    """
+    fake.bucket.put('a', DATA)
+    fake.bucket.put('b', b'other content')
+    make_backup(QiniuBackupScaled, **options).synch()
+    fake.reset_counters()
+    return make_backup(QiniuBackupScaled, **options)
+
+
+def test_renamed_file_is_moved(fake, local, make_backup):
+    backup = synched(fake, make_backup)
+    (local / 'a').rename(local / 'renamed')
+    backup.synch()
+    assert sorted(fake.bucket.objects) == ['b', 'renamed']
+    assert fake.bucket.get('renamed')[0] == DATA
+    assert fake.requests['batch'] >= 1
+    assert fake.requests['form'] == fake.requests['get'] == 0
+    assert backup.counters['moved'] == 1
+    assert not (local / 'a').exists()
+
+
+def test_duplicated_file_is_copied(fake, local, make_backup):
+    backup = synched(fake, make_backup)
+    (local / 'copy').write_bytes(DATA)
+    backup.synch()
+    assert fake.bucket.get('a')[0] == fake.bucket.get('copy')[0] == DATA
+    assert fake.requests['form'] == 0
+    assert backup.counters['copied'] == 1
+
+
+def test_source_changed_remotely_is_uploaded(fake, local, make_backup):
+    backup = synched(fake, make_backup)
+    (local / 'copy').write_bytes(DATA)
+    fake.bucket.put('a', b'changed since the last synch')
+    backup.synch()
+    assert fake.bucket.get('copy')[0] == DATA
+    assert backup.counters['copied'] == 0
+    assert backup.counters['uploaded'] == 1
+
+
+def test_disabled(fake, local, make_backup):
+    backup = synched(fake, make_backup, server_side_copy=False)
+    (local / 'copy').write_bytes(DATA)
+    backup.synch()
+    assert fake.requests['batch'] == 0
+    assert backup.counters['uploaded'] == 1
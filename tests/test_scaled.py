@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Tests that the scaled engine never downloads over a local edit: it uploads
+edits made on one side only and reports a conflict when both sides changed.
+"""
+
+import os
+import shutil
+
+import pytest
+
+from qbackup.qbackup_scaled import QiniuBackupScaled
+
+
+@pytest.fixture
+def synch(fake, make_backup):
+    fake.bucket.put('a', b'one')
+    fake.bucket.put('b', b'two')
+    fake.bucket.put('c', b'three')
+    fake.bucket.put('d', b'four')
+
+    def run(workers=1):
+        backup = make_backup(QiniuBackupScaled, download_workers=workers)
+        backup.synch()
+        return backup
+    return run
+
+
+def warnings(backup):
+    return [message for tag, message in backup.logger.messages
+            if tag == 'WARNING']
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_one_side_changed(fake, local, synch, workers):
+    synch(workers)
+    (local / 'a').write_bytes(b'edited')
+    os.utime(str(local / 'a'), (1, 1))
+    fake.bucket.put('b', b'remote')
+    synch(workers)
+    assert fake.bucket.get('a')[0] == b'edited'
+    assert (local / 'b').read_bytes() == b'remote'
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_both_sides_changed(fake, local, synch, workers):
+    synch(workers)
+    (local / 'c').write_bytes(b'local')
+    fake.bucket.put('c', b'remote')
+    backup = synch(workers)
+    assert (local / 'c').read_bytes() == b'local'
+    assert fake.bucket.get('c')[0] == b'remote'
+    assert any('c' in message for message in warnings(backup))
+
+
+def test_conflict_without_history(fake, local, tmp_path, synch):
+    synch()
+    shutil.rmtree(str(tmp_path / 'manifest'))
+    os.remove(str(tmp_path / 'hashes.sqlite'))
+    (local / 'd').write_bytes(b'local')
+    os.utime(str(local / 'd'), (1, 1))
+    backup = synch()
+    assert (local / 'd').read_bytes() == b'local'
+    assert fake.bucket.get('d')[0] == b'four'
+    assert any('d' in message for message in warnings(backup))
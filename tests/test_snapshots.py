@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+__author__ = 'nykh'
+
+"""
+Tests of the snapshot mode of the scaled engine: unchanged files and
+duplicate content are hard-linked instead of downloaded.
+"""
+
+import os
+
+import pytest
+
+from qbackup.qbackup_scaled import QiniuBackupScaled
+
+SAME = os.urandom(20000)
+
+
+def snapshots(local):
+    return sorted(path for path in local.iterdir() if path.is_dir())
+
+
+@pytest.fixture
+def snapshot(make_backup):
+    def run(**options):
+        options.setdefault('keep_daily', 0)
+        options.setdefault('keep_weekly', 0)
+        options.setdefault('keep_monthly', 0)
+        backup = make_backup(QiniuBackupScaled, snapshots=True, **options)
+        backup.synch()
+        return backup
+    return run
+
+
+def test_unchanged_files_are_linked(fake, local, snapshot):
+    fake.bucket.put('kept', b'kept')
+    fake.bucket.put('changed', b'before')
+    fake.bucket.put('deleted', b'deleted')
+    snapshot()
+    fake.bucket.put('changed', b'after')
+    with fake.bucket.lock:
+        del fake.bucket.objects['deleted']
+    fake.reset_counters()
+    snapshot()
+    first, second = snapshots(local)
+    assert fake.requests['get'] == 1
+    assert (second / 'kept').stat().st_ino == (first / 'kept').stat().st_ino
+    assert (first / 'changed').read_bytes() == b'before'
+    assert (second / 'changed').read_bytes() == b'after'
+    assert (first / 'deleted').exists()
+    assert not (second / 'deleted').exists()
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_duplicate_content_is_downloaded_once(fake, local, snapshot,
+                                              workers):
+    for i in range(8):
+        fake.bucket.put('same%d' % i, SAME)
+    fake.bucket.put('other', b'other')
+    backup = snapshot(download_workers=workers)
+    folder, = snapshots(local)
+    assert fake.requests['get'] == 2
+    assert backup.counters['reused'] == 7
+    assert len({(folder / ('same%d' % i)).stat().st_ino
+                for i in range(8)}) == 1
+    assert (folder / 'same7').read_bytes() == SAME
+